@@ -0,0 +1,207 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import itertools
+import threading
+import subprocess
+import statistics
+
+# Initialize logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STREAMER = os.path.join(REPO_DIR, "streamer", "app", "video_streamer.py")
+RECEIVER = os.path.join(REPO_DIR, "receiver-transcoder", "app", "video_receiver_transcoder.py")
+
+STREAM_NAME = "bench"
+
+# Log lines written by the receiver's MetricsReporter
+PROBE_LINE = re.compile(
+    r"\[(?P<stream>[^/\]]+)/(?P<probe>\w+)\] (?P<rate>[\d.]+) buf/s (?P<mbps>[\d.]+) Mbps \| "
+    r"interval p50=(?P<i50>[\d.]+) ms p99=(?P<i99>[\d.]+) ms"
+)
+LATENCY_LINE = re.compile(r"\[(?P<stream>[^/\]]+)/latency\] ms: (?P<points>.*?) \| clock offset")
+LATENCY_POINT = re.compile(r"(?P<point>\w+) p50=(?P<p50>[\d.]+) p99=(?P<p99>[\d.]+)")
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process in seconds, from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+class LogCollector(threading.Thread):
+    """Reads the receiver's output and keeps the probe and latency samples seen while recording."""
+
+    def __init__(self, stream):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.recording = False
+        self.probes = {}
+        self.latency = {}
+
+    def run(self):
+        for raw in self.stream:
+            line = raw.decode("utf-8", errors="replace")
+            if not self.recording:
+                continue
+            match = PROBE_LINE.search(line)
+            if match:
+                self.probes.setdefault(match["probe"], []).append(
+                    (float(match["rate"]), float(match["mbps"]), float(match["i50"]), float(match["i99"])))
+                continue
+            match = LATENCY_LINE.search(line)
+            if match:
+                for point in LATENCY_POINT.finditer(match["points"]):
+                    self.latency.setdefault(point["point"], []).append((float(point["p50"]), float(point["p99"])))
+
+def start_process(args, env, capture=False):
+    return subprocess.Popen(
+        args, env={**os.environ, **env},
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+        stderr=subprocess.STDOUT if capture else subprocess.DEVNULL,
+    )
+
+def stop_process(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def run_case(case, args):
+    """Run one streamer -> receiver -> SRT stand-in case and return its results."""
+    width, height = (int(v) for v in case["resolution"].split("x"))
+    use_h264 = "true" if case["codec"] == "h264" else "false"
+
+    # SRT stand-in: a listener that discards everything the receiver publishes
+    srt_sink = start_process([
+        "gst-launch-1.0", "-q", "srtsrc", f"uri=srt://:{args.srt_port}?mode=listener", "!", "fakesink", "sync=false",
+    ], {})
+
+    receiver = start_process([sys.executable, "-u", RECEIVER], {
+        "RECEIVER_PORT": str(args.port),
+        "WIDTH": str(width),
+        "HEIGHT": str(height),
+        "BITRATE": str(case["bitrate"]),
+        "SPEED_PRESET": case["preset"],
+        "SRT_IP": "127.0.0.1",
+        "SRT_PORT": str(args.srt_port),
+        "STREAM_NAME": STREAM_NAME,
+        "USE_H264": use_h264,
+        "ENABLE_MONITORING": "true",
+        "LATENCY_MODE": "true",
+        "CONTROL_PORT": "0",
+        # Same size in and out would pass H.264 through, leaving the decoder and encoder stages unmeasured
+        "H264_PASSTHROUGH": "off",
+    }, capture=True)
+    collector = LogCollector(receiver.stdout)
+    collector.start()
+    time.sleep(1.0)
+
+    streamer = start_process([sys.executable, "-u", STREAMER], {
+        "DEVICE": "videotestsrc",
+        "TEST_PATTERN": args.pattern,
+        "WIDTH": str(width),
+        "HEIGHT": str(height),
+        "FRAMERATE": str(case["framerate"]),
+        "RECEIVER_IP": "127.0.0.1",
+        "RECEIVER_PORT": str(args.port),
+        "USE_H264": use_h264,
+        "BITRATE": str(case["bitrate"]),
+        "LATENCY_MODE": "true",
+    })
+
+    try:
+        time.sleep(args.warmup)
+        cpu_start = {"streamer": cpu_seconds(streamer.pid), "receiver": cpu_seconds(receiver.pid)}
+        collector.recording = True
+        wall_start = time.perf_counter()
+        time.sleep(args.duration)
+        collector.recording = False
+        elapsed = time.perf_counter() - wall_start
+        cpu_end = {"streamer": cpu_seconds(streamer.pid), "receiver": cpu_seconds(receiver.pid)}
+        alive = streamer.poll() is None and receiver.poll() is None
+    finally:
+        stop_process(streamer)
+        stop_process(receiver)
+        stop_process(srt_sink)
+
+    cpu = {}
+    for name in cpu_start:
+        if cpu_start[name] is not None and cpu_end[name] is not None:
+            cpu[f"{name}_cpu_percent"] = round(100 * (cpu_end[name] - cpu_start[name]) / elapsed, 1)
+
+    decoded = [sample[0] for sample in collector.probes.get("decoder", [])]
+    fps = statistics.mean(decoded) if decoded else 0.0
+    result = {
+        **case,
+        "ok": alive and fps > 0,
+        "fps": round(fps, 2),
+        "dropped_frame_ratio": round(max(0.0, 1 - fps / case["framerate"]), 4),
+        **cpu,
+        "stages": {},
+        "latency_ms": {},
+    }
+    for probe, samples in collector.probes.items():
+        result["stages"][probe] = {
+            "buffers_per_s": round(statistics.mean(s[0] for s in samples), 2),
+            "mbps": round(statistics.mean(s[1] for s in samples), 3),
+            "interval_p50_ms": round(statistics.median(s[2] for s in samples), 2),
+            "interval_p99_ms": round(max(s[3] for s in samples), 2),
+        }
+    for point, samples in collector.latency.items():
+        result["latency_ms"][point] = {
+            "p50": round(statistics.median(s[0] for s in samples), 2),
+            "p99": round(max(s[1] for s in samples), 2),
+        }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Localhost streamer -> receiver-transcoder -> SRT benchmark.")
+    parser.add_argument("--resolutions", default="640x480,1280x720,1920x1080")
+    parser.add_argument("--framerates", default="30")
+    parser.add_argument("--codecs", default="mjpeg,h264")
+    parser.add_argument("--presets", default="ultrafast")
+    parser.add_argument("--bitrate", type=int, default=4000, help="Encoder bitrate in kbps")
+    parser.add_argument("--pattern", default="ball", help="videotestsrc pattern (e.g. ball, smpte, snow)")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=5554)
+    parser.add_argument("--srt-port", type=int, default=8890)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    cases = [
+        {"resolution": resolution, "framerate": int(framerate), "codec": codec, "preset": preset,
+         "bitrate": args.bitrate}
+        for resolution, framerate, codec, preset in itertools.product(
+            args.resolutions.split(","), args.framerates.split(","), args.codecs.split(","), args.presets.split(","))
+    ]
+
+    results = []
+    for i, case in enumerate(cases, 1):
+        logger.info(f"[{i}/{len(cases)}] {case}")
+        results.append(run_case(case, args))
+        logger.info(f"  fps={results[-1]['fps']} latency={results[-1]['latency_ms'].get('srtsink')}")
+
+    report = json.dumps({"pattern": args.pattern, "duration_s": args.duration, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+        logger.info(f"Report written to {args.output}")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
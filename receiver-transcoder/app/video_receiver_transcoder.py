@@ -1,205 +1,2294 @@
 import gi
 import os
+import json
+import signal
 import time
+import gzip
+import queue
+import socket
+import struct
+import collections
+import threading
 import traceback
 import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass, asdict, replace
 from functools import partial
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst, GLib
+gi.require_version('GstVideo', '1.0')
+gi.require_version('GstNet', '1.0')
+from gi.repository import Gst, GstVideo, GstNet, GLib
 
-# Bandwidth and FPS calculation variables
-bw_start_time = time.perf_counter()
-fps_start_time = time.perf_counter()
-accumulated_bytes = 0
-frame_count = 0  
+from pipeline_graph import PipelineGraph, PipelineError
+
+# Metrics reporting interval (seconds)
 MONITOR_INTERVAL = 1.0
+# Jitter buffer adaptation interval (seconds)
+JITTER_ADAPT_INTERVAL = 2
 
-# Global InfluxDB writer/client
-influx_writer = None
-influx_client = None
+# Global InfluxDB exporter
+influx_exporter = None
 
 # Initialize logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def on_message(bus, message, loop):
-    """Handles GStreamer bus messages."""
+def on_message(bus, message, stop):
+    """Handles GStreamer bus messages; stop(message) is called on EOS or ERROR."""
     msg_type = message.type
 
     if msg_type == Gst.MessageType.EOS:
         logger.info("End of stream received.")
-        loop.quit()
+        stop(message)
     elif msg_type == Gst.MessageType.ERROR:
         err, debug = message.parse_error()
         logger.error(f"{err.message}")
         logger.info(f"{debug}")
-        loop.quit()
+        stop(message)
     elif msg_type == Gst.MessageType.WARNING:
         warn, debug = message.parse_warning()
         logger.warning(f"{warn.message}")
         logger.info(f"{debug}")
 
-def init_influx_writer():
-    """Initialize the InfluxDB writer from environment variables."""
-    global influx_writer, influx_client
-    try:
-        influxdb_url = os.environ["INFLUXDB_URL"]
-        influxdb_token = os.environ["INFLUXDB_TOKEN"]
-        influxdb_org = os.environ["INFLUXDB_ORG"]
-        influxdb_bucket = os.environ["INFLUXDB_BUCKET"]
+def _escape_lp(value, chars):
+    value = str(value)
+    for char in chars:
+        value = value.replace(char, "\\" + char)
+    return value
+
+def _format_lp_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def to_line_protocol(measurement, tags, fields, timestamp_ns):
+    """Encode one point as an InfluxDB line protocol line."""
+    line = _escape_lp(measurement, ", ")
+    for key, value in sorted(tags.items()):
+        line += f",{_escape_lp(key, ',= ')}={_escape_lp(value, ',= ')}"
+    line += " " + ",".join(f"{_escape_lp(key, ',= ')}={_format_lp_field(value)}" for key, value in fields.items())
+    return f"{line} {timestamp_ns}"
+
+class InfluxExporter(threading.Thread):
+    """Background InfluxDB v2 exporter.
+
+    submit() only encodes a line and does a non-blocking put on a bounded queue;
+    when the queue is full the sample is dropped and counted, so a slow server
+    can never stall a streaming thread. The exporter thread batches lines by
+    count and time and POSTs them to /api/v2/write. Batches that cannot be
+    delivered are appended to a local spool file, which is replayed once the
+    server accepts writes again. Batches the server rejects with a 4xx status
+    would be rejected again, so they are logged and dropped instead.
+    """
+
+    def __init__(self, url, token, org, bucket, batch_size=500, flush_interval=1.0, queue_size=10000,
+                 spool_path=None, spool_max_bytes=50 * 1024 * 1024, timeout=2.0, retry_interval=5.0):
+        super().__init__(name="influx-exporter", daemon=True)
+        query = urllib.parse.urlencode({"org": org, "bucket": bucket, "precision": "ns"})
+        self.write_url = f"{url.rstrip('/')}/api/v2/write?{query}"
+        self.token = token
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.spool_max_bytes = spool_max_bytes
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.dropped = 0
+        self.sent = 0
+        self.spooled = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._retry_at = 0.0
+
+    def submit(self, measurement, tags, fields, timestamp_ns=None):
+        """Queue a point for export; returns False if it had to be dropped."""
+        line = to_line_protocol(measurement, tags, fields, timestamp_ns or time.time_ns())
+        try:
+            self._queue.put_nowait(line)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
 
-        influx_client = InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
-        influx_writer = influx_client.write_api(write_options=SYNCHRONOUS)
+    def _post(self, lines):
+        """POST a batch; returns False only if it should be retried later."""
+        body = gzip.compress("\n".join(lines).encode("utf-8"))
+        request = urllib.request.Request(self.write_url, data=body, method="POST", headers={
+            "Authorization": f"Token {self.token}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip",
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                if not 200 <= response.status < 300:
+                    return False
+            self.sent += len(lines)
+            return True
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                logger.error(f"InfluxDB rejected {len(lines)} lines, dropping them: {e}")
+                self.dropped += len(lines)
+                return True
+            logger.warning(f"InfluxDB write failed: {e}")
+            return False
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"InfluxDB write failed: {e}")
+            return False
+
+    def _spool(self, lines):
+        if not self.spool_path:
+            self.dropped += len(lines)
+            return
+        try:
+            if os.path.exists(self.spool_path) and os.path.getsize(self.spool_path) >= self.spool_max_bytes:
+                self.dropped += len(lines)
+                return
+            with open(self.spool_path, "a", encoding="utf-8") as spool:
+                spool.write("\n".join(lines) + "\n")
+            self.spooled += len(lines)
+        except OSError as e:
+            logger.warning(f"Failed to spool InfluxDB metrics to {self.spool_path}: {e}")
+            self.dropped += len(lines)
+
+    def _replay_spool(self):
+        """Send spooled lines in batches; the spool is removed only once all of it is delivered."""
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return True
+        with open(self.spool_path, encoding="utf-8") as spool:
+            batch = []
+            for line in spool:
+                batch.append(line.rstrip("\n"))
+                if len(batch) >= self.batch_size:
+                    if not self._post(batch):
+                        return False
+                    batch = []
+            if batch and not self._post(batch):
+                return False
+        os.remove(self.spool_path)
+        logger.info("Replayed spooled InfluxDB metrics.")
+        return True
+
+    def _flush(self, lines):
+        if not lines:
+            return
+        # While the server is known to be down, spool without paying the connect timeout
+        if time.monotonic() >= self._retry_at and self._replay_spool() and self._post(lines):
+            return
+        self._retry_at = time.monotonic() + self.retry_interval
+        self._spool(lines)
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stop_event.is_set() or not self._queue.empty():
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+        self._flush(batch)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=self.timeout + 1.0)
+
+def init_influx_exporter():
+    """Initialize and start the InfluxDB exporter from environment variables."""
+    global influx_exporter
+    try:
+        influx_exporter = InfluxExporter(
+            url=os.environ["INFLUXDB_URL"],
+            token=os.environ["INFLUXDB_TOKEN"],
+            org=os.environ["INFLUXDB_ORG"],
+            bucket=os.environ["INFLUXDB_BUCKET"],
+            batch_size=int(os.getenv("INFLUXDB_BATCH_SIZE", 500)),
+            flush_interval=float(os.getenv("INFLUXDB_FLUSH_INTERVAL", 1.0)),
+            spool_path=os.getenv("INFLUXDB_SPOOL", "/tmp/influxdb_spool.lp") or None,
+        )
+        influx_exporter.start()
         logger.info("InfluxDB monitoring export ENABLED.")
     except KeyError as e:
         logger.error(f"Missing required InfluxDB environment variable: {e}")
-        influx_writer = None
+        influx_exporter = None
 
-def export_to_influx(metric: str, value: float):
-    """Send a metric point to InfluxDB if enabled."""
-    global influx_writer
-    if influx_writer is None:
+def export_to_influx(metric: str, value: float, stream_name: str = None):
+    """Queue a metric point for InfluxDB if enabled; never blocks."""
+    if influx_exporter is None:
         return
-    try:
-        point = Point("video_metrics") \
-            .tag("stream", os.getenv("STREAM_NAME", "my_stream")) \
-            .field(metric, value) \
-            .time(time.time_ns(), WritePrecision.NS)
+    stream = stream_name or os.getenv("STREAM_NAME", "my_stream")
+    influx_exporter.submit("video_metrics", {"stream": stream}, {metric: float(value)})
 
-        influx_writer.write(
-            bucket=os.environ["INFLUXDB_BUCKET"],
-            org=os.environ["INFLUXDB_ORG"],
-            record=point
-        )
-    except Exception as e:
-        logger.warning(f"Failed to export {metric} to InfluxDB: {e}")
+class Histogram:
+    """HDR-style log-linear histogram of non-negative integers.
+
+    Each power-of-two range is split into 2**SUB_BITS linear sub-buckets, which
+    keeps the relative error around 6% with a few hundred counters. record() is
+    a couple of integer ops and a list increment, cheap enough for a pad probe.
+    """
+
+    SUB_BITS = 4
+
+    def __init__(self, max_value):
+        self.counts = [0] * (self._index(max_value) + 1)
+
+    @classmethod
+    def _index(cls, value):
+        if value < (1 << cls.SUB_BITS):
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return ((shift + 1) << cls.SUB_BITS) + (value >> shift) - (1 << cls.SUB_BITS)
+
+    @classmethod
+    def _midpoint(cls, index):
+        if index < (1 << cls.SUB_BITS):
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        mantissa = (index & ((1 << cls.SUB_BITS) - 1)) + (1 << cls.SUB_BITS)
+        return ((mantissa << shift) + ((mantissa + 1) << shift) - 1) / 2
+
+    def record(self, value):
+        index = self._index(max(0, int(value)))
+        self.counts[min(index, len(self.counts) - 1)] += 1
+
+    def snapshot(self):
+        return list(self.counts)
+
+    @classmethod
+    def percentiles(cls, counts, quantiles):
+        """Return the value at each quantile (0..1) for a list of bucket counts."""
+        total = sum(counts)
+        if total == 0:
+            return [0.0 for _ in quantiles]
+        results = []
+        for q in quantiles:
+            target = q * total
+            cumulative = 0
+            for index, count in enumerate(counts):
+                cumulative += count
+                if count and cumulative >= target:
+                    results.append(cls._midpoint(index))
+                    break
+        return results
+
+    @classmethod
+    def cumulative(cls, counts, bounds, scale=1.0):
+        """Fold bucket counts onto fixed upper bounds (values multiplied by scale).
+
+        Returns (cumulative count per bound, total count, approximate sum), the
+        shape of a Prometheus histogram.
+        """
+        per_bound = [0] * len(bounds)
+        total = 0
+        value_sum = 0.0
+        for index, count in enumerate(counts):
+            if not count:
+                continue
+            value = cls._midpoint(index) * scale
+            total += count
+            value_sum += value * count
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    per_bound[i] += count
+                    break
+        cumulative = []
+        running = 0
+        for count in per_bound:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, value_sum
 
-def monitoring_probe(pad, info, export_to_influxdb, is_fps):
-    global bw_start_time, fps_start_time, accumulated_bytes, frame_count
+class ProbeMetrics:
+    """Counters and histograms for one probe point in the pipeline.
 
+    Only the streaming thread of the probed pad writes to an instance; the
+    reporter reads cumulative values and works with deltas, so no locking is
+    needed on the hot path.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.buffers = 0
+        self.bytes = 0
+        self.last_ns = None
+        self.interval_us = Histogram(60_000_000)
+        self.size_bytes = Histogram(64 * 1024 * 1024)
+
+    def on_buffer(self, size):
+        now_ns = time.perf_counter_ns()
+        self.buffers += 1
+        self.bytes += size
+        if self.last_ns is not None:
+            self.interval_us.record((now_ns - self.last_ns) // 1000)
+        self.size_bytes.record(size)
+        self.last_ns = now_ns
+
+def monitoring_probe(pad, info, metrics):
+    """Pad probe that only records the buffer into its ProbeMetrics."""
     buffer = info.get_buffer()
-    if not buffer:
+    if buffer:
+        metrics.on_buffer(buffer.get_size())
+    return Gst.PadProbeReturn.OK
+
+# Latency side channel, must match the streamer: per-frame timing and clock-offset ping/pong
+LATENCY_TIMING = struct.Struct("!4sIIQ")  # b"TIME", frame seq, RTP timestamp, capture time (ns, wall clock)
+LATENCY_PING = struct.Struct("!4sQ")      # b"PING", t0 (receiver clock)
+LATENCY_PONG = struct.Struct("!4sQQQ")    # b"PONG", t0, t1 (streamer receive), t2 (streamer send)
+
+# Latency points after udpsrc: (point name, element name, pad name); the last one is the total
+LATENCY_POINTS = [
+    ("decoder", "decoder", "src"),
+    ("encoder", "my_enc", "src"),
+    ("srtsink", "out_parse", "src"),  # last element before mpegtsmux ! srtsink
+]
+
+class LatencyMonitor:
+    """Glass-to-glass latency from capture timestamps sent by the streamer.
+
+    Timing messages map each frame's RTP timestamp to its capture time. The
+    udpsrc probe records network arrival per frame; a probe on the depayloader
+    input remembers the buffer PTS of each frame's first and last packet, and
+    later points look the frame up by PTS, which the depayloader, decoder and
+    encoder carry through.
+    Every point records latency since capture and since the previous point.
+    The clock offset to the streamer is estimated NTP-style from PING/PONG
+    exchanges, keeping the sample with the lowest round-trip time.
+    """
+
+    def __init__(self, port, max_frames=512, ping_interval=1.0):
+        self.port = port
+        self.max_frames = max_frames
+        self.ping_interval = ping_interval
+        self.offset_ns = 0
+        self.rtt_ns = None
+        self.timing_received = 0
+        self.timing_lost = 0
+        self.histograms = {}
+        self._previous = {}
+        self._frames = collections.OrderedDict()      # rtp_ts -> [capture_ns, last point time]
+        self._pts_to_rtp = collections.OrderedDict()  # buffer PTS -> rtp_ts
+        self._last_rtp_ts = None
+        self._last_depay_ts = None
+        self._last_seq = None
+        self._streamer = None
+        self._offset_samples = collections.deque(maxlen=8)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("0.0.0.0", port))
+        self._sock.settimeout(ping_interval)
+
+    def start(self):
+        threading.Thread(target=self._receive_loop, name="latency-receiver", daemon=True).start()
+        threading.Thread(target=self._ping_loop, name="latency-ping", daemon=True).start()
+        logger.info(f"Latency mode: listening for capture timestamps on UDP port {self.port}")
+
+    def stop(self):
+        """Stop both threads and release the UDP port, so a rebuilt stream can bind it again."""
+        self._stop_event.set()
+        try:
+            # Wakes a recvfrom() blocked on the socket; Linux raises ENOTCONN for UDP but still shuts down
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def _receive_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                data, address = self._sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self._stop_event.is_set():
+                    logger.error(f"Latency receiver on UDP port {self.port} failed: {e}")
+                return
+            now_ns = time.time_ns()
+            if len(data) == LATENCY_TIMING.size and data[:4] == b"TIME":
+                _, seq, rtp_ts, capture_ns = LATENCY_TIMING.unpack(data)
+                self._streamer = address
+                self.timing_received += 1
+                if self._last_seq is not None and seq > self._last_seq + 1:
+                    self.timing_lost += seq - self._last_seq - 1
+                self._last_seq = seq
+                with self._lock:
+                    self._frames[rtp_ts] = [capture_ns, None]
+                    while len(self._frames) > self.max_frames:
+                        self._frames.popitem(last=False)
+            elif len(data) == LATENCY_PONG.size and data[:4] == b"PONG":
+                _, t0, t1, t2 = LATENCY_PONG.unpack(data)
+                rtt = (now_ns - t0) - (t2 - t1)
+                offset = ((t1 - t0) + (t2 - now_ns)) // 2
+                self._offset_samples.append((rtt, offset))
+                self.rtt_ns, self.offset_ns = min(self._offset_samples)
+
+    def _ping_loop(self):
+        while not self._stop_event.wait(self.ping_interval):
+            if self._streamer:
+                try:
+                    self._sock.sendto(LATENCY_PING.pack(b"PING", time.time_ns()), self._streamer)
+                except OSError:
+                    pass
+
+    def _record(self, point, rtp_ts, now_ns):
+        with self._lock:
+            frame = self._frames.get(rtp_ts)
+        if frame is None:
+            return
+        capture_ns, last_ns = frame
+        # offset_ns is streamer clock minus receiver clock
+        self._histogram(point).record((now_ns + self.offset_ns - capture_ns) // 1000)
+        if last_ns is not None:
+            self._histogram(f"{point}_stage").record((now_ns - last_ns) // 1000)
+        frame[1] = now_ns
+
+    def _histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(60_000_000)
+        return histogram
+
+    def udpsrc_probe(self, pad, info):
+        """Record network arrival of the first packet of each frame."""
+        buffer = info.get_buffer()
+        if not buffer or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        header = buffer.extract_dup(0, 8)
+        rtp_ts = struct.unpack_from("!I", header, 4)[0]
+        if rtp_ts != self._last_rtp_ts and header[1] & 0x7F != RTX_PT:
+            self._last_rtp_ts = rtp_ts
+            self._record("udpsrc", rtp_ts, time.time_ns())
         return Gst.PadProbeReturn.OK
 
-    current_time = time.perf_counter()
+    def depay_probe(self, pad, info):
+        """Remember the PTS of the first and last packet of each frame as they enter the depayloader."""
+        buffer = info.get_buffer()
+        if not buffer or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        header = buffer.extract_dup(0, 8)
+        rtp_ts = struct.unpack_from("!I", header, 4)[0]
+        if rtp_ts != self._last_depay_ts or header[1] & 0x80:
+            self._last_depay_ts = rtp_ts
+            self._pts_to_rtp[buffer.pts] = rtp_ts
+            while len(self._pts_to_rtp) > self.max_frames * 2:
+                self._pts_to_rtp.popitem(last=False)
+        return Gst.PadProbeReturn.OK
 
-    if is_fps:
-        frame_count += 1
-        if current_time - fps_start_time >= MONITOR_INTERVAL:
-            fps = frame_count / (current_time - fps_start_time)
-            logger.info(f"FPS: {fps:.2f}")
-            if export_to_influxdb:
-                export_to_influx("fps", fps)
-            frame_count = 0
-            fps_start_time = current_time
-    else:
-        accumulated_bytes += buffer.get_size()
-        if current_time - bw_start_time >= MONITOR_INTERVAL:
-            bandwidth_mbps = (accumulated_bytes * 8) / ((current_time - bw_start_time) * 1_000_000)
-            logger.info(f"Bandwidth: {bandwidth_mbps:.2f} Mbps")
+    def point_probe(self, pad, info, point):
+        buffer = info.get_buffer()
+        if buffer:
+            rtp_ts = self._pts_to_rtp.get(buffer.pts)
+            if rtp_ts is not None:
+                self._record(point, rtp_ts, time.time_ns())
+        return Gst.PadProbeReturn.OK
+
+    def attach(self, pipeline, latency_points=LATENCY_POINTS):
+        udpsrc = pipeline.get_by_name("source")
+        udpsrc.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.udpsrc_probe)
+        # The jitter buffer re-stamps PTS, so map PTS to frames where packets enter the depayloader
+        pipeline.get_by_name("depay").get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.depay_probe)
+        for point, element_name, pad_name in latency_points:
+            element = pipeline.get_by_name(element_name)
+            if element and element.get_static_pad(pad_name):
+                element.get_static_pad(pad_name).add_probe(Gst.PadProbeType.BUFFER, partial(self.point_probe, point=point))
+
+    def report(self, export_to_influxdb, stream_name=None):
+        parts = []
+        for name in list(self.histograms):
+            counts = self.histograms[name].snapshot()
+            previous = self._previous.get(name)
+            self._previous[name] = counts
+            if previous is not None:
+                counts = [c - p for c, p in zip(counts, previous)]
+            p50, p99 = (v / 1000 for v in Histogram.percentiles(counts, (0.5, 0.99)))
+            parts.append(f"{name} p50={p50:.1f} p99={p99:.1f}")
             if export_to_influxdb:
-                export_to_influx("bandwidth_mbps", bandwidth_mbps)
-            accumulated_bytes = 0
-            bw_start_time = current_time
+                export_to_influx(f"latency_{name}_p50_ms", p50, stream_name)
+                export_to_influx(f"latency_{name}_p99_ms", p99, stream_name)
+                if name == LATENCY_POINTS[-1][0]:
+                    export_to_influx("latency_total_p50_ms", p50, stream_name)
+                    export_to_influx("latency_total_p99_ms", p99, stream_name)
 
-    return Gst.PadProbeReturn.OK
+        rtt = f"{self.rtt_ns / 1e6:.2f} ms" if self.rtt_ns is not None else "n/a (assuming synchronized clocks)"
+        logger.info(
+            f"[{stream_name or 'stream'}/latency] ms: {' | '.join(parts) or 'no frames'} | clock offset={self.offset_ns / 1e6:.2f} ms "
+            f"rtt={rtt} timing lost={self.timing_lost}/{self.timing_received + self.timing_lost}"
+        )
+        if export_to_influxdb:
+            export_to_influx("clock_offset_ms", self.offset_ns / 1e6, stream_name)
 
-def start_receiver(port, width, height, bitrate, speed_preset, srt_ip, srt_port, stream_name, enable_monitoring, use_h264, export_to_influxdb, is_fps=False):
-    """Sets up the GStreamer pipeline for video reception and transcoding."""
-    Gst.init(None)
+def rtp_payload_offset(header):
+    """Offset of the RTP payload given at least the fixed header (+ CSRCs and extension if present)."""
+    offset = 12 + 4 * (header[0] & 0x0F)
+    if header[0] & 0x10 and len(header) >= offset + 4:
+        offset += 4 + 4 * struct.unpack_from("!H", header, offset + 2)[0]
+    return offset
+
+def h264_packet_info(payload):
+    """Return (starts_nal, is_keyframe) for an RTP H.264 payload (RFC 6184)."""
+    nal_type = payload[0] & 0x1F
+    if nal_type == 28 and len(payload) > 1:  # FU-A
+        return bool(payload[1] & 0x80), (payload[1] & 0x1F) in (5, 7)
+    if nal_type == 24 and len(payload) > 3:  # STAP-A, first aggregated NAL
+        return True, (payload[3] & 0x1F) in (5, 7)
+    return True, nal_type in (5, 7)
+
+class RtpLinkMonitor:
+    """Per-stream RTP link health and protection for lossy radio links.
+
+    - Sequence-number statistics at udpsrc: received, lost, reordered and
+      duplicate packets, before the jitter buffer hides them.
+    - rtpjitterbuffer statistics (lost, late, average jitter) and, when a
+      maximum above the initial latency is configured, an adaptive latency
+      target: about three times the measured jitter, raised quickly when
+      packets arrive too late and lowered slowly.
+    - Packets rebuilt by ULPFEC or retransmitted after a NACK.
+    - Optionally drops every frame that is still missing a packet when it
+      reaches the depayloader instead of handing a broken frame to the
+      decoder; for H.264 everything up to the next keyframe is dropped as well.
+    """
+
+    def __init__(self, pipeline, use_h264, max_latency_ms, drop_incomplete):
+        self.pipeline = pipeline
+        self.use_h264 = use_h264
+        self.jitterbuffer = pipeline.get_by_name("jitter")
+        rtpbin = pipeline.get_by_name("rtpbin")
+        if rtpbin:
+            # rtpbin creates its jitter buffer once the stream arrives
+            rtpbin.connect("new-jitterbuffer", self._new_jitterbuffer)
+        latency_source = self.jitterbuffer or rtpbin
+        self.latency_ms = latency_source.get_property("latency") if latency_source else 0
+        self.min_latency_ms = self.latency_ms
+        self.max_latency_ms = max(self.latency_ms, max_latency_ms)
+        self.drop_incomplete = drop_incomplete
+        # udpsrc sequence statistics
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self._highest_seq = None
+        # jitterbuffer statistics
+        self.jb_lost = 0
+        self.jb_late = 0
+        self.jitter_ms = 0.0
+        self._last_late = 0
+        # incomplete frame filter
+        self.dropped_frames = 0
+        self.dropped_packets = 0
+        self._last_seq = None
+        self._last_ts = None
+        self._damaged_ts = None
+        self._last_dropped_ts = None
+        self._wait_keyframe = False
+        self._lost_pending = False
+        self._previous = {}
+        # Called with a reason when an H.264 frame was lost; see KeyframeRequester
+        self.on_keyframe_needed = None
+        # Sees every media packet when congestion control is on
+        self.estimator = None
+
+        pipeline.get_by_name("source").get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._sequence_probe)
+        # ULPFEC packets share the media sequence numbers and rtpulpfecdec removes them, so behind it a
+        # sequence gap is normal; real losses are the GstRTPPacketLost events it could not repair
+        self._fec = pipeline.get_by_name("fec") is not None
+        if drop_incomplete:
+            depay = pipeline.get_by_name("depay")
+            depay.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._filter_probe)
+            if self._fec:
+                depay.get_static_pad("sink").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self._lost_probe)
+            if depay.find_property("wait-for-keyframe"):
+                depay.set_property("wait-for-keyframe", True)
+
+    def _new_jitterbuffer(self, rtpbin, jitterbuffer, session, ssrc):
+        self.jitterbuffer = jitterbuffer
 
-    if use_h264:
-        # pipeline_desc = (
-        #     f'udpsrc name=source port={port} ! '
-        #     'application/x-rtp, encoding-name=H264, payload=96 ! '
-        #     'rtph264depay ! '
-        #     'h264parse ! '  # No decoding or re-encoding
-        #     'mpegtsmux alignment=7 ! '  # Directly mux H.264 into MPEG-TS
-        #     f'srtsink uri="srt://{srt_ip}:{srt_port}?streamid=publish:{stream_name}" sync=false'
-        # )
-        pipeline_desc = (
-            f'udpsrc name=source port={port} ! '
-            'application/x-rtp, encoding-name=H264, payload=96 ! '
-            'rtph264depay ! '
-            'h264parse ! '
-            'avdec_h264 ! '  # H.264 decoder
-            'videoconvert ! '
-            'videoscale ! '
-            f'video/x-raw, width={width}, height={height} ! '
-            f'x264enc name=my_enc bitrate={bitrate} '
-            f'speed-preset={speed_preset} key-int-max=10 '
-            'bframes=0 tune=zerolatency ! '
-            'h264parse ! '
-            'mpegtsmux alignment=7 ! '
-            f'srtsink uri="srt://{srt_ip}:{srt_port}?streamid=publish:{stream_name}" sync=false'
+    def recovered_packets(self):
+        """Packets rebuilt by ULPFEC or recovered by retransmission so far."""
+        fec = self.pipeline.get_by_name("fec")
+        if fec:
+            return fec.get_property("recovered")
+        rtx = self.pipeline.get_by_name("rtx")
+        if rtx:
+            return rtx.get_property("num-rtx-assoc-packets")
+        return 0
+
+    def _sequence_probe(self, pad, info):
+        buffer = info.get_buffer()
+        if not buffer or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        header = buffer.extract_dup(0, 8)
+        if header[1] & 0x7F == RTX_PT:
+            # Retransmissions have their own SSRC and sequence numbers
+            return Gst.PadProbeReturn.OK
+        seq, rtp_ts = struct.unpack_from("!HI", header, 2)
+        if self.estimator:
+            self.estimator.on_packet(buffer, rtp_ts)
+        self.received += 1
+        if self._highest_seq is None:
+            self._highest_seq = seq
+            return Gst.PadProbeReturn.OK
+        delta = (seq - self._highest_seq) & 0xFFFF
+        if delta == 0:
+            self.duplicates += 1
+        elif delta < 0x8000:
+            self.lost += delta - 1
+            self._highest_seq = seq
+        else:
+            # An older packet: it was counted as lost when the gap appeared
+            self.reordered += 1
+            self.lost = max(0, self.lost - 1)
+        return Gst.PadProbeReturn.OK
+
+    def _lost_probe(self, pad, info):
+        event = info.get_event()
+        structure = event.get_structure() if event.type == Gst.EventType.CUSTOM_DOWNSTREAM else None
+        if structure and structure.has_name("GstRTPPacketLost"):
+            self._lost_pending = True
+        return Gst.PadProbeReturn.OK
+
+    def _filter_probe(self, pad, info):
+        buffer = info.get_buffer()
+        if not buffer or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        header = buffer.extract_dup(0, min(buffer.get_size(), 64))
+        seq, rtp_ts = struct.unpack_from("!HI", header, 2)
+        payload = header[rtp_payload_offset(header):]
+        if self._fec:
+            gap, self._lost_pending = self._lost_pending, False
+        else:
+            gap = self._last_seq is not None and seq != (self._last_seq + 1) & 0xFFFF
+        new_frame = rtp_ts != self._last_ts
+        self._last_seq, self._last_ts = seq, rtp_ts
+
+        if self.use_h264 and payload:
+            starts_nal, keyframe = h264_packet_info(payload)
+        else:
+            # RFC 2435: a JPEG frame starts at fragment offset 0
+            starts_nal = len(payload) >= 4 and payload[1:4] == b"\x00\x00\x00"
+            keyframe = True
+
+        if gap:
+            if not (new_frame and starts_nal):
+                self._damaged_ts = rtp_ts
+            # Later H.264 frames reference the damaged one
+            self._wait_keyframe = self.use_h264
+            if self.use_h264 and self.on_keyframe_needed:
+                self.on_keyframe_needed("loss")
+        if self._wait_keyframe and new_frame and keyframe and rtp_ts != self._damaged_ts:
+            self._wait_keyframe = False
+
+        if rtp_ts == self._damaged_ts or self._wait_keyframe:
+            if rtp_ts != self._last_dropped_ts:
+                self._last_dropped_ts = rtp_ts
+                self.dropped_frames += 1
+            self.dropped_packets += 1
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+    def adapt(self):
+        """Read jitterbuffer stats and move its latency towards the target; run on the main loop."""
+        if not self.jitterbuffer:
+            return GLib.SOURCE_CONTINUE
+        stats = self.jitterbuffer.get_property("stats")
+        self.jb_lost = stats.get_uint64("num-lost")[1]
+        self.jb_late = stats.get_uint64("num-late")[1]
+        self.jitter_ms = stats.get_uint64("avg-jitter")[1] / 1e6
+        late = self.jb_late - self._last_late
+        self._last_late = self.jb_late
+
+        if self.max_latency_ms > self.min_latency_ms:
+            target = max(self.min_latency_ms, 3 * self.jitter_ms + 5)
+            if late > 0:
+                target = max(target, self.latency_ms * 1.5)
+            elif target < self.latency_ms:
+                target = max(target, self.latency_ms * 0.9)
+            target = int(min(self.max_latency_ms, target))
+            if abs(target - self.latency_ms) >= 5:
+                logger.info(f"Jitter buffer latency {self.latency_ms} -> {target} ms "
+                            f"(jitter {self.jitter_ms:.1f} ms, {late} late packets)")
+                self.latency_ms = target
+                self.jitterbuffer.set_property("latency", target)
+        return GLib.SOURCE_CONTINUE
+
+    def report(self, export_to_influxdb, stream_name=None):
+        counters = {"received": self.received, "lost": self.lost, "reordered": self.reordered,
+                    "duplicates": self.duplicates, "late": self.jb_late, "dropped_frames": self.dropped_frames,
+                    "recovered": self.recovered_packets()}
+        deltas = {key: value - self._previous.get(key, 0) for key, value in counters.items()}
+        self._previous = counters
+        expected = deltas["received"] + deltas["lost"]
+        loss_pct = 100 * deltas["lost"] / expected if expected else 0.0
+        logger.info(
+            f"[{stream_name or 'stream'}/rtp] loss={loss_pct:.2f}% lost={deltas['lost']} "
+            f"reordered={deltas['reordered']} duplicates={deltas['duplicates']} late={deltas['late']} "
+            f"jitter={self.jitter_ms:.2f} ms jitterbuffer={self.latency_ms if self.jitterbuffer else 0} ms "
+            f"recovered={deltas['recovered']} dropped_frames={deltas['dropped_frames']}"
+        )
+        if export_to_influxdb:
+            export_to_influx("packet_loss_pct", loss_pct, stream_name)
+            export_to_influx("packets_reordered", deltas["reordered"], stream_name)
+            export_to_influx("packets_late", deltas["late"], stream_name)
+            export_to_influx("jitter_ms", self.jitter_ms, stream_name)
+            export_to_influx("incomplete_frames_dropped", deltas["dropped_frames"], stream_name)
+            export_to_influx("packets_recovered", deltas["recovered"], stream_name)
+
+# Congestion feedback to the streamer: magic, sequence, delay-based estimate (kbps),
+# received rate (kbps), jitter (us), loss (1/1000), overuse signal (must match the streamer)
+CC_REPORT = struct.Struct("!4sIIIIHB")
+CC_SIGNALS = {"normal": 0, "overuse": 1, "underuse": 2}
+
+class BandwidthEstimator:
+    """Receiver side of a GCC-style congestion controller (draft-ietf-rmcat-gcc).
+
+    Packets are grouped by RTP timestamp (one group per frame). For each new
+    group, the change in one-way delay is the arrival gap minus the send gap
+    from the RTP clock. A trendline over the smoothed accumulated delay
+    separates queue build-up (overuse) from jitter. Its threshold adapts so a
+    competing TCP flow does not starve the stream.
+
+    On overuse the estimate drops to 85% of the received rate. Otherwise it
+    grows by about 8% per second, up to 1.5 times what is actually received.
+    Every report_interval a report with the estimate, received rate, loss
+    fraction and jitter goes to the streamer's feedback_port, at the address
+    the RTP comes from. The streamer combines it with its loss-based rate.
+    """
+
+    WINDOW = 20
+    SMOOTHING = 0.9
+    THRESHOLD_GAIN = 4.0
+    OVERUSE_TIME_MS = 10.0
+    DECREASE_FACTOR = 0.85
+    INCREASE_PER_S = 1.08
+
+    def __init__(self, link, feedback_port, report_interval=0.2):
+        self.link = link
+        self.feedback_port = feedback_port
+        self.report_interval = report_interval
+        self.estimate_kbps = None
+        self.incoming_kbps = 0.0
+        self.signal = "normal"
+        self.reports = 0
+        self._lock = threading.Lock()
+        self._address = None
+        self._refresh_address = True
+        self._arrivals = collections.deque()
+        self._window_bytes = 0
+        # Current and previous packet group: [rtp_ts, first arrival, last arrival]
+        self._group = None
+        self._previous = None
+        self._first_arrival = None
+        self._accumulated_ms = 0.0
+        self._smoothed_ms = 0.0
+        self._history = collections.deque(maxlen=self.WINDOW)
+        self._threshold_ms = 12.5
+        self._last_detect = None
+        self._overuse_since = None
+        self._jitter_s = 0.0
+        self._last_transit = None
+        self._hold = False
+        self._last_update = None
+        self._counts = (0, 0)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def on_packet(self, buffer, rtp_ts):
+        """Account one media packet; runs on the udpsrc streaming thread."""
+        now = time.monotonic()
+        if self._refresh_address:
+            meta = GstNet.buffer_get_net_address_meta(buffer)
+            if meta:
+                self._address = (meta.addr.get_address().to_string(), self.feedback_port)
+                self._refresh_address = False
+        with self._lock:
+            size = buffer.get_size()
+            self._arrivals.append((now, size))
+            self._window_bytes += size
+            while now - self._arrivals[0][0] > 1.0:
+                self._window_bytes -= self._arrivals.popleft()[1]
+
+            # RFC 3550 interarrival jitter
+            transit = now - rtp_ts / 90000
+            if self._last_transit is not None:
+                self._jitter_s += (abs(transit - self._last_transit) - self._jitter_s) / 16
+            self._last_transit = transit
+
+            if self._group is None or rtp_ts == self._group[0]:
+                if self._group is None:
+                    self._group = [rtp_ts, now, now]
+                self._group[2] = now
+                return
+            send_gap = ((rtp_ts - self._group[0]) & 0xFFFFFFFF) / 90000
+            if send_gap > 2 ** 31 / 90000:
+                return  # A packet of an older frame, reordered
+            if self._previous is not None:
+                group_send_gap = ((self._group[0] - self._previous[0]) & 0xFFFFFFFF) / 90000
+                delta_ms = ((self._group[2] - self._previous[2]) - group_send_gap) * 1000
+                self._update_trend(delta_ms, self._group[2])
+            self._previous = self._group
+            self._group = [rtp_ts, now, now]
+
+    def _update_trend(self, delta_ms, arrival):
+        if self._first_arrival is None:
+            self._first_arrival = arrival
+        self._accumulated_ms += delta_ms
+        self._smoothed_ms = self.SMOOTHING * self._smoothed_ms + (1 - self.SMOOTHING) * self._accumulated_ms
+        self._history.append(((arrival - self._first_arrival) * 1000, self._smoothed_ms))
+        if len(self._history) < self.WINDOW:
+            return
+        # Least-squares slope of delay over time
+        mean_x = sum(x for x, _ in self._history) / self.WINDOW
+        mean_y = sum(y for _, y in self._history) / self.WINDOW
+        denominator = sum((x - mean_x) ** 2 for x, _ in self._history)
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in self._history) / denominator if denominator else 0.0
+        self._detect(slope * self.WINDOW * self.THRESHOLD_GAIN, arrival)
+
+    def _detect(self, trend, arrival):
+        elapsed_ms = (arrival - self._last_detect) * 1000 if self._last_detect else 0.0
+        self._last_detect = arrival
+        if trend > self._threshold_ms:
+            if self._overuse_since is None:
+                self._overuse_since = arrival
+            if (arrival - self._overuse_since) * 1000 >= self.OVERUSE_TIME_MS:
+                self.signal = "overuse"
+        elif trend < -self._threshold_ms:
+            self._overuse_since = None
+            self.signal = "underuse"
+        else:
+            self._overuse_since = None
+            self.signal = "normal"
+        # Adaptive threshold; outliers far above it are ignored
+        if abs(trend) < self._threshold_ms + 15:
+            gain = 0.039 if abs(trend) < self._threshold_ms else 0.0087
+            self._threshold_ms += gain * (abs(trend) - self._threshold_ms) * min(elapsed_ms, 100)
+            self._threshold_ms = min(600.0, max(6.0, self._threshold_ms))
+
+    def _update_rate(self, now):
+        elapsed = now - self._last_update if self._last_update else 0.0
+        self._last_update = now
+        self.incoming_kbps = self._window_bytes * 8 / 1000
+        if self.incoming_kbps <= 0:
+            return
+        if self.estimate_kbps is None:
+            self.estimate_kbps = self.incoming_kbps
+        if self.signal == "overuse":
+            if not self._hold:
+                self.estimate_kbps = min(self.estimate_kbps, self.DECREASE_FACTOR * self.incoming_kbps)
+                self._hold = True
+        elif self.signal == "underuse":
+            # Queues are draining; wait for them to empty before probing upwards
+            self._hold = True
+        else:
+            self._hold = False
+            self.estimate_kbps *= self.INCREASE_PER_S ** elapsed
+            self.estimate_kbps = min(self.estimate_kbps, 1.5 * self.incoming_kbps + 10)
+
+    def report(self):
+        """Update the estimate and send a report to the streamer; runs on the main loop."""
+        with self._lock:
+            self._update_rate(time.monotonic())
+            estimate, incoming, signal = self.estimate_kbps, self.incoming_kbps, self.signal
+            jitter_us = int(self._jitter_s * 1e6)
+        received, lost = self.link.received, self.link.lost
+        delta_received, delta_lost = received - self._counts[0], lost - self._counts[1]
+        self._counts = (received, lost)
+        expected = delta_received + delta_lost
+        loss_permille = int(1000 * delta_lost / expected) if expected > 0 else 0
+        self._refresh_address = True
+        if estimate is None or self._address is None:
+            return GLib.SOURCE_CONTINUE
+        packet = CC_REPORT.pack(b"RATE", self.reports & 0xFFFFFFFF, int(estimate), int(incoming),
+                                jitter_us, max(0, min(1000, loss_permille)), CC_SIGNALS[signal])
+        try:
+            self._sock.sendto(packet, self._address)
+            self.reports += 1
+        except OSError as e:
+            logger.warning(f"Could not send congestion feedback to {self._address[0]}:{self.feedback_port}: {e}")
+        return GLib.SOURCE_CONTINUE
+
+    def close(self):
+        self._sock.close()
+
+class MetricsReporter(threading.Thread):
+    """Aggregates ProbeMetrics off the streaming threads and logs/exports them."""
+
+    def __init__(self, probes, export_to_influxdb, interval=MONITOR_INTERVAL, fps_probe="decoder",
+                 bandwidth_probe="udpsrc", extras=(), stream_name=None):
+        super().__init__(name=f"metrics-reporter-{stream_name}", daemon=True)
+        self.probes = probes
+        self.stream_name = stream_name
+        # Other monitors with a report(export_to_influxdb, stream_name) method
+        self.extras = [extra for extra in extras if extra]
+        self.export_to_influxdb = export_to_influxdb
+        self.interval = interval
+        self.fps_probe = fps_probe
+        self.bandwidth_probe = bandwidth_probe
+        self._stop_event = threading.Event()
+        self._previous = {}
+
+    def _delta(self, probe):
+        current = (probe.buffers, probe.bytes, probe.interval_us.snapshot(), probe.size_bytes.snapshot())
+        previous = self._previous.get(probe.name)
+        self._previous[probe.name] = current
+        if previous is None:
+            return current
+        return (
+            current[0] - previous[0],
+            current[1] - previous[1],
+            [c - p for c, p in zip(current[2], previous[2])],
+            [c - p for c, p in zip(current[3], previous[3])],
         )
+
+    def report(self, elapsed):
+        for name, probe in self.probes.items():
+            buffers, nbytes, intervals, sizes = self._delta(probe)
+            rate = buffers / elapsed
+            mbps = (nbytes * 8) / (elapsed * 1_000_000)
+            i50, i99 = (v / 1000 for v in Histogram.percentiles(intervals, (0.5, 0.99)))
+            s50, s99 = Histogram.percentiles(sizes, (0.5, 0.99))
+            logger.info(
+                f"[{self.stream_name}/{name}] {rate:.2f} buf/s {mbps:.2f} Mbps | "
+                f"interval p50={i50:.2f} ms p99={i99:.2f} ms | size p50={s50:.0f} B p99={s99:.0f} B"
+            )
+
+            if not self.export_to_influxdb:
+                continue
+            if name == self.fps_probe:
+                export_to_influx("fps", rate, self.stream_name)
+            if name == self.bandwidth_probe:
+                export_to_influx("bandwidth_mbps", mbps, self.stream_name)
+            export_to_influx(f"{name}_interval_p50_ms", i50, self.stream_name)
+            export_to_influx(f"{name}_interval_p99_ms", i99, self.stream_name)
+
+        for extra in self.extras:
+            extra.report(self.export_to_influxdb, self.stream_name)
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            self.report(now - last)
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+
+def attach_probes(graph):
+    """Attach a monitoring probe with its own ProbeMetrics to each tap of the pipeline graph."""
+    probes = {}
+    for probe_name in graph.taps:
+        metrics = ProbeMetrics(probe_name)
+        graph.add_probe(probe_name, partial(monitoring_probe, metrics=metrics))
+        probes[probe_name] = metrics
+    return probes
+
+class H264Router:
+    """Switches a received H.264 stream between passthrough and transcoding.
+
+    A probe on the input h264parse reads the negotiated caps: when the incoming
+    resolution already matches the output, the output-selector sends the stream
+    directly to the muxer and the decoder/encoder branch stays idle. The input
+    bitrate is measured over a sliding window, and passthrough falls back to
+    transcoding when it exceeds the configured bitrate. New caps (for example
+    a resolution change at the streamer) are evaluated again.
+    """
+
+    def __init__(self, pipeline, width, height, bitrate, mode="auto", tolerance=1.1, window=2.0):
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self.mode = mode
+        self.tolerance = tolerance
+        self.window = window
+        self.route = pipeline.get_by_name("route")
+        self.join = pipeline.get_by_name("join")
+        self.passthrough = False
+        self.input_size = None
+        # Called when the output switches to passthrough, mid-GOP of the streamer's stream
+        self.on_passthrough = None
+        self._bytes = 0
+        self._window_start = None
+
+        # Identify the branches by what each output-selector pad is linked to
+        self._routes = {}
+        for src_pad in self.route.srcpads:
+            peer = src_pad.get_peer()
+            if peer.get_parent_element() == self.join:
+                self._routes[True] = (src_pad, peer)
+            else:
+                transcode_src = src_pad
+        transcode_sink = next(pad for pad in self.join.sinkpads if pad != self._routes[True][1])
+        self._routes[False] = (transcode_src, transcode_sink)
+
+        self._select(False)
+        pipeline.get_by_name("in_parse").get_static_pad("src").add_probe(
+            Gst.PadProbeType.EVENT_DOWNSTREAM | Gst.PadProbeType.BUFFER, self._probe)
+
+    def set_target(self, width, height, bitrate=None):
+        """Update the output settings and re-evaluate passthrough against the last input caps."""
+        self.width, self.height = width, height
+        if bitrate is not None:
+            self.bitrate = bitrate
+        passthrough = self.mode == "auto" and self.input_size == (width, height)
+        if passthrough != self.passthrough:
+            self._select(passthrough)
+            logger.info(f"Output set to {width}x{height}: {'passthrough' if passthrough else 'transcoding'}.")
+
+    def _select(self, passthrough):
+        src_pad, sink_pad = self._routes[passthrough]
+        self.join.set_property("active-pad", sink_pad)
+        self.route.set_property("active-pad", src_pad)
+        if passthrough and not self.passthrough and self.on_passthrough:
+            self.on_passthrough()
+        self.passthrough = passthrough
+
+    def _probe(self, pad, info):
+        if info.type & Gst.PadProbeType.BUFFER:
+            buffer = info.get_buffer()
+            now = time.perf_counter()
+            if self._window_start is None:
+                self._window_start = now
+            self._bytes += buffer.get_size()
+            if now - self._window_start >= self.window:
+                kbps = self._bytes * 8 / ((now - self._window_start) * 1000)
+                self._bytes = 0
+                self._window_start = now
+                if self.passthrough and kbps > self.bitrate * self.tolerance:
+                    logger.info(f"Input bitrate {kbps:.0f} kbps exceeds {self.bitrate} kbps, switching to transcoding.")
+                    self._select(False)
+            return Gst.PadProbeReturn.OK
+
+        event = info.get_event()
+        if event.type != Gst.EventType.CAPS:
+            return Gst.PadProbeReturn.OK
+        structure = event.parse_caps().get_structure(0)
+        _, in_width = structure.get_int("width")
+        _, in_height = structure.get_int("height")
+        self.input_size = (in_width, in_height)
+        passthrough = self.mode == "auto" and (in_width, in_height) == (self.width, self.height)
+        self._bytes = 0
+        self._window_start = None
+        if passthrough != self.passthrough:
+            self._select(passthrough)
+        logger.info(f"Incoming H.264 {in_width}x{in_height}: {'passthrough' if passthrough else 'transcoding'}.")
+        return Gst.PadProbeReturn.OK
+
+# H.264 encoders in order of preference: (factory, bitrate property, bitrate scale to kbps, key-int property, extra properties)
+H264_ENCODERS = [
+    ("nvh264enc", "bitrate", 1, "gop-size", "preset=low-latency-hp rc-mode=cbr"),
+    ("vah264enc", "bitrate", 1, "key-int-max", "b-frames=0 rate-control=cbr"),
+    ("vaapih264enc", "bitrate", 1, "keyframe-period", "max-bframes=0 rate-control=cbr"),
+    ("v4l2h264enc", None, 1000, None, ""),
+    ("x264enc", "bitrate", 1, "key-int-max", "bframes=0 tune=zerolatency speed-preset={speed_preset}"),
+    ("openh264enc", "bitrate", 1000, "gop-size", "complexity={complexity} rate-control=bitrate usage-type=camera"),
+]
+
+# x264 speed presets mapped onto openh264enc complexity
+OPENH264_COMPLEXITY = {"ultrafast": "low", "superfast": "low", "veryfast": "low", "faster": "medium",
+                       "fast": "medium", "medium": "medium"}
+
+_h264_encoder = None
+
+def encoder_available(factory_name):
+    """Check that an encoder is registered and can actually open (e.g. has a device)."""
+    factory = Gst.ElementFactory.find(factory_name)
+    if factory is None:
+        return False
+    element = factory.create(None)
+    if element is None:
+        return False
+    available = element.set_state(Gst.State.READY) != Gst.StateChangeReturn.FAILURE
+    element.set_state(Gst.State.NULL)
+    return available
+
+def select_h264_encoder():
+    """Pick the H.264 encoder once: H264_ENCODER if set, else the first usable one, else x264enc."""
+    global _h264_encoder
+    if _h264_encoder:
+        return _h264_encoder
+
+    Gst.init(None)
+    requested = os.getenv("H264_ENCODER", "auto").lower()
+    candidates = [entry for entry in H264_ENCODERS if requested in ("auto", entry[0])]
+    for entry in candidates:
+        if encoder_available(entry[0]):
+            _h264_encoder = entry
+            break
     else:
-        pipeline_desc = (
-            f'udpsrc name=source port={port} ! '
-            'application/x-rtp, encoding-name=JPEG, payload=26 ! '
-            'rtpjpegdepay ! '
-            'jpegdec name=jpeg_decoder ! '  # Named for FPS probe
-            'videoconvert ! '
-            'videoscale ! '
-            f'video/x-raw, width={width}, height={height} ! '
-            f'x264enc name=my_enc bitrate={bitrate} '
-            f'speed-preset={speed_preset} key-int-max=10 '
-            'bframes=0 tune=zerolatency ! '
-            'h264parse ! '
-            'mpegtsmux alignment=7 ! '
-            f'srtsink uri="srt://{srt_ip}:{srt_port}?streamid=publish:{stream_name}" sync=false'
+        logger.warning(f"No usable H.264 encoder for H264_ENCODER={requested}, falling back to x264enc.")
+        _h264_encoder = next(entry for entry in H264_ENCODERS if entry[0] == "x264enc")
+
+    logger.info(f"H.264 encoder: {_h264_encoder[0]}")
+    return _h264_encoder
+
+def h264_encoder_props(bitrate, key_int, speed_preset="ultrafast"):
+    """(factory, properties) for the selected H.264 encoder with common settings mapped on.
+
+    bitrate is in kbps, key_int in frames; the encoder runs without B-frames in
+    its low-latency mode where it has one.
+    """
+    factory, bitrate_prop, scale, key_int_prop, extra = select_h264_encoder()
+    if factory == "v4l2h264enc":
+        return factory, {"extra-controls": f"controls,video_bitrate={bitrate * scale},h264_i_frame_period={key_int}"}
+    props = {bitrate_prop: bitrate * scale, key_int_prop: key_int}
+    for prop in extra.format(speed_preset=speed_preset,
+                             complexity=OPENH264_COMPLEXITY.get(speed_preset, "high")).split():
+        key, value = prop.split("=", 1)
+        props[key] = value
+    return factory, props
+
+def keyframe_interval():
+    """GOP length of the receiver's encoders in frames (KEY_INT, default 10).
+
+    Viewers joining get a keyframe on request only if MediaMTX calls
+    POST /streams/<name>/keyframe from a runOnRead hook. Until then the GOP
+    bounds join time, so a longer KEY_INT is opt-in for setups with the hook.
+    """
+    return int(os.getenv("KEY_INT", 10))
+
+def set_encoder_bitrate(encoder, bitrate):
+    """Change the bitrate (kbps) of a running encoder created from h264_encoder_props()."""
+    factory = encoder.get_factory().get_name()
+    entry = next((entry for entry in H264_ENCODERS if entry[0] == factory), None)
+    if entry is None:
+        raise ValueError(f"Unsupported encoder {factory}")
+    _, bitrate_prop, scale, _, _ = entry
+    if factory == "v4l2h264enc":
+        encoder.set_property("extra-controls", Gst.Structure.new_from_string(f"controls,video_bitrate={bitrate * scale}"))
+    else:
+        encoder.set_property(bitrate_prop, bitrate * scale)
+
+# RTP payload types for ULPFEC and retransmission packets (must match the streamer)
+FEC_PT = 122
+RTX_PT = 97
+# Recovery needs a jitter buffer to wait for repair packets (ms)
+MIN_PROTECTED_LATENCY = 50
+
+def add_rtp_input(graph, port, use_h264, jitter_latency, protection="none", multicast_group=None):
+    """Add the elements from udpsrc 'source' up to (not including) the depayloader.
+
+    Returns the element the depayloader links to. With multicast_group the
+    media udpsrc joins that group (on MULTICAST_IFACE if set); RTCP stays unicast.
+    - none: optional rtpjitterbuffer 'jitter'.
+    - fec: rtpstorage keeps recent packets and rtpulpfecdec 'fec' rebuilds the
+      ones the jitter buffer reports lost from the ULPFEC packets.
+    - rtx: only the udpsrc and the RTCP elements, and None is returned;
+      attach_rtx_session() adds the rtpbin that sends NACKs and links it to the
+      depayloader.
+    """
+    pt = 96 if use_h264 else 26
+    rtp_caps = f"application/x-rtp, media=video, clock-rate=90000, encoding-name={'H264' if use_h264 else 'JPEG'}"
+    source_props = {"port": port}
+    if multicast_group:
+        source_props.update({"address": multicast_group, "auto-multicast": True})
+        if os.getenv("MULTICAST_IFACE"):
+            source_props["multicast-iface"] = os.environ["MULTICAST_IFACE"]
+    if protection == "rtx":
+        graph.add("udpsrc", "source", source_props, caps=f"{rtp_caps}, payload={pt}")
+        graph.add("udpsrc", "rtcp_in", port=port + 1)
+        graph.add("udpsink", "rtcp_out", {"async": False}, host="127.0.0.1", sync=False)
+        return None
+    source = graph.add("udpsrc", "source", source_props)
+    if protection == "fec":
+        # FEC packets carry their own payload type in the same stream, so the caps must not pin one
+        latency = max(jitter_latency, MIN_PROTECTED_LATENCY)
+        storage = graph.add("rtpstorage", "storage", size_time=(latency + 200) * Gst.MSECOND)
+        fec = graph.add("rtpulpfecdec", "fec", pt=FEC_PT)
+        fec.set_property("storage", storage.get_property("internal-storage"))
+        return graph.chain(
+            source, graph.capsfilter(rtp_caps), storage,
+            graph.add("rtpjitterbuffer", "jitter", latency=latency, do_lost=True, drop_on_latency=True),
+            fec,
         )
+    last = graph.chain(source, graph.capsfilter(f"{rtp_caps}, payload={pt}"))
+    if jitter_latency > 0:
+        # Reorder packets and emit lost-packet events so the depayloader discards broken frames
+        last = graph.chain(last, graph.add("rtpjitterbuffer", "jitter", latency=jitter_latency,
+                                           do_lost=True, drop_on_latency=True))
+    return last
 
-    logger.info("Pipeline description:")
-    print(pipeline_desc)
+def attach_rtx_session(graph, use_h264, jitter_latency, feedback_port):
+    """Add an rtpbin with NACK-based retransmission between 'source' and 'depay'.
 
-    pipeline = Gst.parse_launch(pipeline_desc)
-    if not pipeline:
-        logger.error("Failed to create GStreamer pipeline.")
-        return
+    The RTX receiver is created in rtpbin's request-aux-receiver callback, which
+    fires when the session is created, so the callbacks are connected before
+    any session pad is requested. RTCP feedback goes to the address the
+    streamer's sender reports come from, on feedback_port.
+    """
+    pt = 96 if use_h264 else 26
+    rtpbin = graph.add("rtpbin", "rtpbin", latency=max(jitter_latency, MIN_PROTECTED_LATENCY),
+                       do_retransmission=True, do_lost=True, drop_on_latency=True, rtp_profile="avpf")
 
-    bus = pipeline.get_bus()
-    bus.add_signal_watch()
-    loop = GLib.MainLoop()
-    bus.connect("message", on_message, loop)
+    def request_aux_receiver(rtpbin, session_id):
+        rtx = Gst.ElementFactory.make("rtprtxreceive", "rtx")
+        rtx.set_property("payload-type-map",
+                         Gst.Structure.new_from_string(f"application/x-rtp-pt-map, {pt}=(uint){RTX_PT}"))
+        aux = Gst.Bin.new(f"rtx_receive_{session_id}")
+        aux.add(rtx)
+        aux.add_pad(Gst.GhostPad.new(f"sink_{session_id}", rtx.get_static_pad("sink")))
+        aux.add_pad(Gst.GhostPad.new(f"src_{session_id}", rtx.get_static_pad("src")))
+        return aux
 
-    # Attach probes if monitoring is enabled
-    if enable_monitoring:
-        logger.info("Bandwidth and FPS monitoring is ENABLED.")
+    depay_sink = graph.get("depay").get_static_pad("sink")
 
-        # Bandwidth probe (before decoding)
-        udpsrc = pipeline.get_by_name("source")
-        if udpsrc:
-            src_pad = udpsrc.get_static_pad("src")
-            if src_pad:
-                src_pad.add_probe(Gst.PadProbeType.BUFFER, partial(monitoring_probe, export_to_influxdb=export_to_influxdb, is_fps=False))
-
-        # FPS probe (after decoding)
-        jpegdec = pipeline.get_by_name("jpeg_decoder")
-        if jpegdec:
-            src_pad = jpegdec.get_static_pad("src")
-            if src_pad:
-                src_pad.add_probe(Gst.PadProbeType.BUFFER, partial(monitoring_probe, export_to_influxdb=export_to_influxdb, is_fps=True))
+    def pad_added(rtpbin, pad):
+        if pad.get_name().startswith("recv_rtp_src_0_") and not depay_sink.is_linked():
+            pad.link(depay_sink)
+
+    rtpbin.connect("request-aux-receiver", request_aux_receiver)
+    rtpbin.connect("pad-added", pad_added)
+
+    rtcp_out = graph.get("rtcp_out")
+    rtcp_out.set_property("port", feedback_port)
+
+    def learn_streamer_address(pad, info):
+        meta = GstNet.buffer_get_net_address_meta(info.get_buffer())
+        if meta:
+            host = meta.addr.get_address().to_string()
+            if host != rtcp_out.get_property("host"):
+                logger.info(f"Sending RTCP feedback to {host}:{feedback_port}")
+                rtcp_out.set_property("host", host)
+        return Gst.PadProbeReturn.OK
+
+    rtcp_in = graph.get("rtcp_in")
+    rtcp_in.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, learn_streamer_address)
+    graph.link(graph.get("source"), rtpbin, sink_pad="recv_rtp_sink_0")
+    graph.link(rtcp_in, rtpbin, sink_pad="recv_rtcp_sink_0")
+    graph.link(rtpbin, rtcp_out, src_pad="send_rtcp_src_0")
+    return rtpbin
+
+# RTCP payload-specific feedback (RFC 4585): Picture Loss Indication
+RTCP_PSFB = 206
+PSFB_PLI = 1
+
+class KeyframeRequester:
+    """Asks the streamer for an H.264 keyframe, at most once per min_interval.
+
+    Requests come from packet loss (rtph264depay's own loss detection and the
+    incomplete-frame filter), from the control API (a viewer joined a
+    passthrough stream) and from switching to passthrough.
+
+    - rtx: the request is an upstream force-key-unit event at the depayloader;
+      rtpbin sends it as a PLI in its RTCP feedback.
+    - otherwise: a PLI goes straight to the streamer's feedback_port, at the
+      address of the next RTP packet, where KeyframeRequestListener waits.
+
+    Merging requests within min_interval keeps a burst of losses from turning
+    into a burst of keyframes on the link that just lost packets.
+    """
+
+    def __init__(self, pipeline, feedback_port, min_interval=0.5):
+        self.feedback_port = feedback_port
+        self.min_interval = min_interval
+        self.requests = collections.Counter()
+        self.sent = 0
+        self.depay = pipeline.get_by_name("depay")
+        self.source = pipeline.get_by_name("source")
+        self.rtpbin = pipeline.get_by_name("rtpbin")
+        self._last = 0.0
+        self._own_seqnum = None
+        self._pending = False
+        self._ssrc = int.from_bytes(os.urandom(4), "big")
+        self._sock = None if self.rtpbin else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.depay.find_property("request-keyframe"):
+            self.depay.set_property("request-keyframe", True)
+        self.depay.get_static_pad("sink").add_probe(Gst.PadProbeType.EVENT_UPSTREAM, self._depay_event_probe)
+
+    def _depay_event_probe(self, pad, info):
+        event = info.get_event()
+        if not GstVideo.video_event_is_force_key_unit(event) or event.get_seqnum() == self._own_seqnum:
+            return Gst.PadProbeReturn.OK
+        if self.rtpbin:
+            # rtpbin sends the PLI; only count it
+            self.requests["loss"] += 1
+            return Gst.PadProbeReturn.OK
+        self.request("loss")
+        return Gst.PadProbeReturn.DROP
+
+    def request(self, reason):
+        """Ask for a keyframe; returns False when merged into a request sent less than min_interval ago."""
+        self.requests[reason] += 1
+        now = time.monotonic()
+        if now - self._last < self.min_interval:
+            return False
+        self._last = now
+        self.sent += 1
+        if self.rtpbin:
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            self._own_seqnum = event.get_seqnum()
+            self.depay.get_static_pad("sink").push_event(event)
+        elif not self._pending:
+            self._pending = True
+            self.source.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._send_pli)
+        logger.info(f"Keyframe requested from the streamer ({reason}).")
+        return True
+
+    def _send_pli(self, pad, info):
+        buffer = info.get_buffer()
+        meta = GstNet.buffer_get_net_address_meta(buffer)
+        if meta is None or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        media_ssrc = struct.unpack_from("!I", buffer.extract_dup(8, 4))[0]
+        packet = struct.pack("!BBHII", 0x80 | PSFB_PLI, RTCP_PSFB, 2, self._ssrc, media_ssrc)
+        host = meta.addr.get_address().to_string()
+        try:
+            self._sock.sendto(packet, (host, self.feedback_port))
+        except OSError as e:
+            logger.warning(f"Could not send PLI to {host}:{self.feedback_port}: {e}")
+        self._pending = False
+        return Gst.PadProbeReturn.REMOVE
 
+    def close(self):
+        if self._sock:
+            self._sock.close()
+
+def add_output(graph, srt_uri, suffix="", record=False):
+    """Add h264parse ! mpegtsmux ! srtsink, with a tee 'record_tee' after h264parse when recording."""
+    output = [graph.add("h264parse", f"out_parse{suffix}")]
+    if record:
+        output.append(graph.add("tee", f"record_tee{suffix}", allow_not_linked=True))
+    output += [
+        graph.add("mpegtsmux", alignment=7),
+        graph.add("srtsink", f"srt_sink{suffix}", uri=srt_uri, sync=False),
+    ]
+    return output
+
+def add_encoder_output(graph, head, width, height, bitrate, speed_preset, srt_uri, suffix="", record=False):
+    """Add videoscale ! capsfilter ! encoder and add_output() after `head`.
+
+    Element names get `suffix` (e.g. "_720p") so each rendition can be found
+    by name. Returns (scale elements, output elements) for tapping and linking.
+    """
+    encoder_factory, encoder_props = h264_encoder_props(bitrate, keyframe_interval(), speed_preset)
+    scale = [
+        graph.add("videoscale"),
+        graph.capsfilter(f"video/x-raw, width={width}, height={height}", f"scale_caps{suffix}"),
+        graph.add(encoder_factory, f"my_enc{suffix}", encoder_props),
+    ]
+    output = add_output(graph, srt_uri, suffix, record)
+    if head is not None:
+        graph.chain(head, *scale, *output)
+    return scale, output
+
+def build_receiver_pipeline(port, width, height, bitrate, speed_preset, srt_ip, srt_port, stream_name, use_h264,
+                            jitter_latency=0, protection="none", renditions=(), record=False, multicast_group=None):
+    """Build the PipelineGraph for receiving and transcoding one stream.
+
+    With renditions, the stream is decoded and converted once and a tee feeds
+    one scaler/encoder branch per rendition, published as
+    {stream_name}_{rendition}. Each branch starts with a leaky queue so a slow
+    encoder drops its own frames instead of stalling the others.
+
+    With record, a tee 'record_tee' (of the first rendition for a ladder) sits
+    after the output h264parse for a SegmentRecorder branch.
+
+    Taps for the monitoring probes: udpsrc, depayloader, decoder, and encoder
+    and srtsink (encoder_<rendition> and srtsink_<rendition> for a ladder).
+    """
+    graph = PipelineGraph(f"receiver-{stream_name}")
+    rtp_input = add_rtp_input(graph, port, use_h264, jitter_latency, protection, multicast_group)
+    depay = graph.add("rtph264depay" if use_h264 else "rtpjpegdepay", "depay")
+    if rtp_input:
+        graph.link(rtp_input, depay)
+    decoder = graph.add("avdec_h264" if use_h264 else "jpegdec", "decoder")
+    convert = graph.add("videoconvert")
+
+    if renditions:
+        if use_h264:
+            graph.chain(depay, graph.add("h264parse", "in_parse"), decoder)
+        else:
+            graph.link(depay, decoder)
+        tee = graph.chain(decoder, convert, graph.add("tee", "renditions"))
+        for index, rendition in enumerate(renditions):
+            suffix = f"_{rendition.name}"
+            queue = graph.add("queue", f"queue{suffix}", max_size_buffers=2, max_size_bytes=0, max_size_time=0,
+                              leaky="downstream")
+            scale, output = add_encoder_output(
+                graph, None, rendition.width, rendition.height, rendition.bitrate, speed_preset,
+                f"srt://{srt_ip}:{srt_port}?streamid=publish:{stream_name}{suffix}", suffix, record and index == 0)
+            graph.add_branch(rendition.name, tee, queue, *scale, *output)
+            graph.tap(f"encoder{suffix}", scale[-1])
+            graph.tap(f"srtsink{suffix}", output[-1], "sink")
     else:
-        logger.info("Monitoring is DISABLED.")
+        srt_uri = f"srt://{srt_ip}:{srt_port}?streamid=publish:{stream_name}"
+        if use_h264:
+            # The output-selector 'route' sends H.264 either through the transcoder or straight
+            # to the input-selector 'join'; H264Router picks the branch from the incoming caps.
+            route = graph.add("output-selector", "route", pad_negotiation_mode="active")
+            join = graph.add("input-selector", "join", sync_streams=False)
+            graph.chain(depay, graph.add("h264parse", "in_parse"), route)
+            scale, output = add_encoder_output(graph, None, width, height, bitrate, speed_preset, srt_uri,
+                                               record=record)
+            graph.chain(route, decoder, convert, *scale, join)
+            graph.link(route, join)
+            graph.chain(join, *output)
+        else:
+            scale, output = add_encoder_output(graph, graph.chain(depay, decoder, convert), width, height,
+                                               bitrate, speed_preset, srt_uri, record=record)
+        graph.tap("encoder", scale[-1])
+        graph.tap("srtsink", output[-1], "sink")
 
-    try:
-        logger.info("Starting video receiver and transcoder:")
-        pipeline.set_state(Gst.State.PLAYING)
-        loop.run()
-    except KeyboardInterrupt:
-        logger.info("\nInterrupted by user, stopping...")
-    except Exception as e:
-        logger.error(f"Exception occurred: {e}")
-        traceback.print_exc()
-    finally:
-        pipeline.set_state(Gst.State.NULL)
-        loop.quit()
-        logger.info("Pipeline stopped.")
+    graph.tap("udpsrc", graph.get("source"))
+    graph.tap("depayloader", depay)
+    graph.tap("decoder", decoder)
+
+    if protection == "rtx":
+        # The streamer listens for RTCP feedback three ports above the media port
+        attach_rtx_session(graph, use_h264, jitter_latency, port + 3)
+
+    logger.info(f"Pipeline for '{stream_name}':")
+    print(graph.describe())
+    return graph
+
+@dataclass
+class RecordingSettings:
+    """Where and how streams are recorded; limits apply to each stream's segments."""
+    directory: str = "/recordings"
+    format: str = "ts"
+    segment_s: int = 60
+    max_bytes: int = 10 * 1024 ** 3
+    max_age_s: int = 24 * 3600
+
+class SegmentRecorder(threading.Thread):
+    """Records a stream's encoded H.264 into rolling, indexed segments.
+
+    The branch hangs off the tee after the output h264parse, so recording
+    costs a muxer and file writes, never a second encode. It starts with a
+    leaky queue: when the disk is slow, recorded frames are dropped instead
+    of holding up srtsink. splitmuxsink cuts segments at keyframes every
+    `segment_s` seconds into MPEG-TS or fragmented MP4 files.
+
+    Next to each segment, <segment>.idx.json lists [pts_s, byte_offset] for
+    every keyframe so a player can seek without scanning the file. The thread
+    deletes this stream's oldest segments beyond max_age_s or max_bytes.
+    """
+
+    CLEANUP_INTERVAL = 10.0
+
+    def __init__(self, graph, tee, stream_name, settings):
+        super().__init__(name=f"recorder-{stream_name}", daemon=True)
+        self.graph = graph
+        self.stream_name = stream_name
+        self.settings = settings
+        self.extension = "mp4" if settings.format == "mp4" else "ts"
+        self.failed = False
+        self._segment = None
+        self._keyframes = []
+        self._offset = 0
+        self._first_pts = None
+        self._stop_event = threading.Event()
+        os.makedirs(settings.directory, exist_ok=True)
+
+        filesink = Gst.ElementFactory.make("filesink", None)
+        filesink.set_property("async", False)
+        filesink.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._index_probe)
+        muxer_props = {"muxer_factory": "mp4mux", "muxer_properties": "properties,fragment-duration=1000"} \
+            if self.extension == "mp4" else {"muxer_factory": "mpegtsmux"}
+        self.splitmux = graph.add("splitmuxsink", f"recorder_{stream_name}", sink=filesink,
+                                  max_size_time=settings.segment_s * Gst.SECOND, **muxer_props)
+        self.splitmux.connect("format-location-full", self._format_location)
+        queue = graph.add("queue", f"record_queue_{stream_name}", max_size_buffers=0, max_size_bytes=0,
+                          max_size_time=2 * Gst.SECOND, leaky="downstream")
+        graph.add_branch("record", tee, queue, self.splitmux)
+        self._elements = (queue, self.splitmux)
+
+    def _format_location(self, splitmux, fragment_id, first_sample):
+        self._write_index()
+        name = f"{self.stream_name}_{time.strftime('%Y%m%d-%H%M%S')}_{fragment_id:05d}.{self.extension}"
+        self._segment = os.path.join(self.settings.directory, name)
+        logger.info(f"Recording '{self.stream_name}' to {self._segment}")
+        return self._segment
+
+    def _index_probe(self, pad, info):
+        buffer = info.get_buffer()
+        if not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT) and not buffer.has_flags(Gst.BufferFlags.HEADER):
+            pts = buffer.pts if buffer.pts != Gst.CLOCK_TIME_NONE else None
+            if pts is not None and self._first_pts is None:
+                self._first_pts = pts
+            pts_s = round((pts - self._first_pts) / Gst.SECOND, 3) if pts is not None else None
+            self._keyframes.append([pts_s, self._offset])
+        self._offset += buffer.get_size()
+        return Gst.PadProbeReturn.OK
+
+    def _write_index(self):
+        """Write the keyframe index of the segment just finished (runs on the recording thread)."""
+        if self._segment:
+            try:
+                with open(f"{self._segment}.idx.json", "w", encoding="utf-8") as f:
+                    json.dump({"segment": os.path.basename(self._segment), "keyframes": self._keyframes}, f)
+            except OSError as e:
+                logger.warning(f"Could not write index for {self._segment}: {e}")
+        self._keyframes = []
+        self._offset = 0
+        self._first_pts = None
+
+    def owns(self, element):
+        """True if element is part of the recording branch (used to keep its errors off the live path)."""
+        return any(element == own or element.has_as_ancestor(own) for own in self._elements)
+
+    def fail(self, message):
+        """Drop the recording branch after an error (e.g. disk full); streaming continues."""
+        if self.failed:
+            return
+        self.failed = True
+        err, _ = message.parse_error()
+        logger.error(f"Recording of '{self.stream_name}' stopped: {err.message}")
+        self.graph.remove_branch("record")
+
+    def cleanup(self):
+        """Delete this stream's oldest segments (and their indexes) beyond the age and size limits."""
+        prefix = f"{self.stream_name}_"
+        segments = []
+        for name in os.listdir(self.settings.directory):
+            if name.startswith(prefix) and name.endswith(f".{self.extension}"):
+                path = os.path.join(self.settings.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                segments.append((stat.st_mtime, stat.st_size, path))
+        segments.sort()
+        total = sum(size for _, size, _ in segments)
+        now = time.time()
+        # The newest segment is still being written
+        for mtime, size, path in segments[:-1]:
+            if now - mtime <= self.settings.max_age_s and total <= self.settings.max_bytes:
+                break
+            for victim in (path, f"{path}.idx.json"):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Could not delete {victim}: {e}")
+            total -= size
+            logger.info(f"Deleted recording {os.path.basename(path)}")
+
+    def run(self):
+        while not self._stop_event.wait(self.CLEANUP_INTERVAL):
+            try:
+                self.cleanup()
+            except OSError as e:
+                logger.warning(f"Recording cleanup for '{self.stream_name}' failed: {e}")
+
+    def stop(self):
+        """Called after the pipeline is shut down: index the last segment and stop cleaning up."""
+        self._stop_event.set()
+        self._write_index()
+        self._segment = None
+
+@dataclass(frozen=True)
+class Rendition:
+    """One output of an ABR ladder, published as {stream_name}_{name}."""
+    name: str
+    width: int
+    height: int
+    bitrate: int
+
+def parse_renditions(value):
+    """Parse a rendition ladder into a tuple of Renditions.
+
+    Accepts "1080p=1920x1080@4000,720p=1280x720@2000" (name=WIDTHxHEIGHT@kbps)
+    or a list of {"name", "width", "height", "bitrate"} dicts, where
+    "resolution": "1280x720" may replace width and height.
+    """
+    if not value:
+        return ()
+    if isinstance(value, str):
+        entries = []
+        for item in value.split(","):
+            name, _, spec = item.strip().partition("=")
+            resolution, _, bitrate = spec.partition("@")
+            entries.append({"name": name, "resolution": resolution, "bitrate": bitrate})
+        value = entries
+    renditions = []
+    for entry in value:
+        if "resolution" in entry:
+            width, height = (int(v) for v in str(entry["resolution"]).lower().split("x"))
+        else:
+            width, height = int(entry["width"]), int(entry["height"])
+        name = str(entry["name"])
+        if not name.replace("_", "").replace("-", "").isalnum():
+            raise ValueError(f"Rendition name '{name}' may only contain letters, digits, '_' and '-'")
+        renditions.append(Rendition(name, width, height, int(entry["bitrate"])))
+    if len({rendition.name for rendition in renditions}) != len(renditions):
+        raise ValueError("Rendition names must be unique")
+    return tuple(renditions)
+
+@dataclass
+class StreamConfig:
+    """Settings for one received stream."""
+    port: int
+    stream_name: str
+    use_h264: bool = False
+    width: int = 640
+    height: int = 480
+    bitrate: int = 2000
+    speed_preset: str = "medium"
+    latency_port: int = None
+    jitter_latency: int = 0
+    jitter_max_latency: int = 200
+    drop_incomplete: bool = False
+    protection: str = "none"
+    renditions: tuple = ()
+    record: bool = False
+    congestion_control: bool = False
+    multicast_group: str = None
+
+def parse_stream_configs(entries, defaults, latency_mode=False):
+    """Build StreamConfigs from a list of dicts, filling gaps from the defaults StreamConfig.
+
+    Each entry needs 'port' and 'stream_name'; 'codec' is 'h264' or 'mjpeg', and the
+    resolution is given as 'width'/'height' or as 'resolution': '1280x720'.
+    'renditions' takes the formats parse_renditions() accepts.
+    """
+    configs = []
+    for entry in entries:
+        width, height = defaults.width, defaults.height
+        if "resolution" in entry:
+            width, height = (int(v) for v in str(entry["resolution"]).lower().split("x"))
+        port = int(entry["port"])
+        codec = str(entry.get("codec", "h264" if defaults.use_h264 else "mjpeg")).lower()
+        configs.append(StreamConfig(
+            port=port,
+            stream_name=entry["stream_name"],
+            use_h264=codec in ("h264", "h.264"),
+            width=int(entry.get("width", width)),
+            height=int(entry.get("height", height)),
+            bitrate=int(entry.get("bitrate", defaults.bitrate)),
+            speed_preset=entry.get("speed_preset", defaults.speed_preset),
+            latency_port=int(entry.get("latency_port", port + 2)) if latency_mode else None,
+            jitter_latency=int(entry.get("jitter_latency", defaults.jitter_latency)),
+            jitter_max_latency=int(entry.get("jitter_max_latency", defaults.jitter_max_latency)),
+            drop_incomplete=bool(entry.get("drop_incomplete", defaults.drop_incomplete)),
+            protection=entry.get("protection", defaults.protection).lower(),
+            renditions=parse_renditions(entry["renditions"]) if "renditions" in entry else defaults.renditions,
+            record=bool(entry.get("record", defaults.record)),
+            congestion_control=bool(entry.get("congestion_control", defaults.congestion_control)),
+            multicast_group=entry.get("multicast_group", defaults.multicast_group),
+        ))
+    return configs
+
+def load_stream_configs(defaults, latency_mode=False):
+    """Read the stream list from STREAMS_FILE or STREAMS (JSON), else the single-stream defaults."""
+    streams_file = os.getenv("STREAMS_FILE")
+    if streams_file:
+        with open(streams_file, encoding="utf-8") as f:
+            return parse_stream_configs(json.load(f), defaults, latency_mode)
+    if os.getenv("STREAMS"):
+        return parse_stream_configs(json.loads(os.environ["STREAMS"]), defaults, latency_mode)
+    return [defaults]
+
+class Backoff:
+    """Exponential restart delay plus the bookkeeping for recovery time.
+
+    The delay doubles on every failure up to max_delay and starts over once
+    the stream has run for reset_after seconds without failing.
+    """
+
+    def __init__(self, initial_delay=0.25, max_delay=10.0, reset_after=30.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.restarts = 0
+        self.last_recovery_s = None
+        self.failed_at = None
+        self._delay = initial_delay
+        self._last_failure = 0.0
+
+    def next_delay(self):
+        """Record a failure and return how long to wait before restarting."""
+        now = time.monotonic()
+        if now - self._last_failure > self.reset_after:
+            self._delay = self.initial_delay
+        self._last_failure = now
+        if self.failed_at is None:
+            self.failed_at = now
+        delay = self._delay
+        self._delay = min(self.max_delay, self._delay * 2)
+        self.restarts += 1
+        return delay
+
+    def recovered(self):
+        """Mark the stream as flowing again; return the seconds since the failure, or None."""
+        if self.failed_at is None:
+            return None
+        self.last_recovery_s = time.monotonic() - self.failed_at
+        self.failed_at = None
+        return self.last_recovery_s
+
+class ReceiverStream:
+    """One received stream running as its own pipeline, with its router and monitoring."""
+
+    def __init__(self, config, srt_ip, srt_port, enable_monitoring, export_to_influxdb, passthrough_mode, on_stop,
+                 backoff=None, recording=None):
+        self.config = config
+        self.name = config.stream_name
+        self.export_to_influxdb = export_to_influxdb
+        # Kept across rebuilds so restarts back off and recovery time spans the whole outage
+        self.backoff = backoff or Backoff()
+        self.restart_pending = False
+        self.reporter = None
+        self.latency = None
+        self.recorder = None
+        record = config.record and recording is not None
+        self.graph = build_receiver_pipeline(
+            config.port, config.width, config.height, config.bitrate, config.speed_preset,
+            srt_ip, srt_port, config.stream_name, config.use_h264, config.jitter_latency, config.protection,
+            config.renditions, record, config.multicast_group)
+        self.pipeline = self.graph.pipeline
+        if record:
+            self.recorder = SegmentRecorder(self.graph, self.graph.get(f"record_tee{self._outputs()[0]}"),
+                                            config.stream_name, recording)
+
+        self.link = RtpLinkMonitor(self.pipeline, config.use_h264, config.jitter_max_latency, config.drop_incomplete)
+        self._adapt_source = None
+
+        self.estimator = None
+        self._report_source = None
+        if config.congestion_control:
+            # The streamer's congestion controller listens four ports above the media port
+            self.estimator = BandwidthEstimator(self.link, config.port + 4,
+                                                float(os.getenv("CC_REPORT_INTERVAL_MS", 200)) / 1000)
+            self.link.estimator = self.estimator
+
+        self.keyframes = None
+        if config.use_h264:
+            # The streamer listens for RTCP feedback three ports above the media port
+            self.keyframes = KeyframeRequester(self.pipeline, config.port + 3,
+                                               float(os.getenv("KEYFRAME_MIN_INTERVAL_MS", 500)) / 1000)
+            self.link.on_keyframe_needed = self.keyframes.request
+
+        self.router = None
+        if config.use_h264 and not config.renditions:
+            self.router = H264Router(self.pipeline, config.width, config.height, config.bitrate, passthrough_mode)
+            self.router.on_passthrough = partial(self.keyframes.request, "passthrough")
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect("message", on_message, partial(on_stop, self.name))
+
+        # Attach probes if monitoring is enabled
+        if enable_monitoring:
+            probes = attach_probes(self.graph)
+            logger.info(f"Monitoring probes for '{self.name}': {', '.join(probes)}")
+            if config.latency_port:
+                self.latency = LatencyMonitor(config.latency_port)
+                # With a ladder, encoder and srtsink latency are measured on the first rendition
+                suffix = self._outputs()[0]
+                points = [(point, element if point == "decoder" else element + suffix, pad)
+                          for point, element, pad in LATENCY_POINTS]
+                self.latency.attach(self.pipeline, points)
+            self.reporter = MetricsReporter(probes, export_to_influxdb, extras=[self.link, self.latency],
+                                            stream_name=self.name)
+
+    def start(self):
+        if self.recorder:
+            self.recorder.start()
+        if self.latency:
+            self.latency.start()
+        if self.reporter:
+            self.reporter.start()
+        if self.link.latency_ms:
+            self._adapt_source = GLib.timeout_add_seconds(JITTER_ADAPT_INTERVAL, self.link.adapt)
+        if self.estimator:
+            self._report_source = GLib.timeout_add(int(self.estimator.report_interval * 1000), self.estimator.report)
+        self._play()
+        logger.info(f"Stream '{self.name}' receiving on UDP port {self.config.port}.")
+
+    def _outputs(self, rendition=None):
+        """Element name suffixes of the outputs addressed: the single output, one rendition, or all."""
+        names = [r.name for r in self.config.renditions]
+        if rendition is None:
+            return [f"_{name}" for name in names] or [""]
+        if rendition not in names:
+            raise ValueError(f"unknown rendition '{rendition}'" + (f" (have {', '.join(names)})" if names else ""))
+        return [f"_{rendition}"]
+
+    def _rendition_output(self, rendition):
+        if self.config.renditions and rendition is None:
+            raise ValueError("stream has renditions; pass 'rendition'")
+        return self._outputs(rendition)[0]
+
+    def _update_rendition(self, name, **changes):
+        self.config = replace(self.config, renditions=tuple(
+            replace(r, **changes) if r.name == name else r for r in self.config.renditions))
+
+    def _play(self):
+        if self.backoff.failed_at is not None:
+            self.pipeline.get_by_name(f"srt_sink{self._outputs()[0]}").get_static_pad("sink").add_probe(
+                Gst.PadProbeType.BUFFER, self._recovery_probe)
+        return self.pipeline.set_state(Gst.State.PLAYING) != Gst.StateChangeReturn.FAILURE
+
+    def _recovery_probe(self, pad, info):
+        seconds = self.backoff.recovered()
+        if seconds is not None:
+            logger.info(f"Stream '{self.name}' recovered in {seconds:.2f} s (restart #{self.backoff.restarts}).")
+            if self.export_to_influxdb:
+                export_to_influx("recovery_time_s", seconds, self.name)
+        return Gst.PadProbeReturn.REMOVE
+
+    def restart(self):
+        """Restart the existing pipeline in place, e.g. after the SRT server dropped the connection.
+
+        Elements, encoder, router and monitoring are kept; srtsink reconnects
+        when it goes from NULL back to PLAYING.
+        """
+        self.pipeline.set_state(Gst.State.NULL)
+        # Errors queued by the failed run must not trigger another restart
+        self.bus.set_flushing(True)
+        self.bus.set_flushing(False)
+        return self._play()
+
+    def set_bitrate(self, bitrate, rendition=None):
+        """Change the encoder bitrate (kbps) live, of one rendition for a ladder."""
+        set_encoder_bitrate(self.pipeline.get_by_name(f"my_enc{self._rendition_output(rendition)}"), bitrate)
+        if rendition:
+            self._update_rendition(rendition, bitrate=bitrate)
+        else:
+            self.config = replace(self.config, bitrate=bitrate)
+        if self.router:
+            self.router.set_target(self.config.width, self.config.height, bitrate)
+        logger.info(f"Stream '{self.name}{'/' + rendition if rendition else ''}': bitrate set to {bitrate} kbps.")
+
+    def set_resolution(self, width, height, rendition=None):
+        """Renegotiate the scaler output; the encoder restarts on the new caps with a keyframe."""
+        caps = Gst.Caps.from_string(f"video/x-raw, width={width}, height={height}")
+        self.pipeline.get_by_name(f"scale_caps{self._rendition_output(rendition)}").set_property("caps", caps)
+        if rendition:
+            self._update_rendition(rendition, width=width, height=height)
+        else:
+            self.config = replace(self.config, width=width, height=height)
+        if self.router:
+            self.router.set_target(width, height)
+        logger.info(f"Stream '{self.name}{'/' + rendition if rendition else ''}': resolution set to {width}x{height}.")
+
+    def force_keyframe(self, rendition=None):
+        """Ask the encoder (or every rendition's encoder) for an immediate keyframe (with SPS/PPS).
+
+        In passthrough the output is the streamer's H.264, so the streamer is asked instead.
+        """
+        if self.router and self.router.passthrough:
+            self.keyframes.request("api")
+            return
+        for suffix in self._outputs(rendition):
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            if not self.pipeline.get_by_name(f"my_enc{suffix}").get_static_pad("src").send_event(event):
+                raise ValueError("encoder did not accept the force-key-unit event")
+        logger.info(f"Stream '{self.name}': keyframe requested.")
+
+    def status(self):
+        status = asdict(self.config)
+        if self.router:
+            status["passthrough"] = self.router.passthrough
+        status["restarts"] = self.backoff.restarts
+        status["last_recovery_s"] = self.backoff.last_recovery_s
+        if self.keyframes:
+            status["keyframe_requests"] = dict(self.keyframes.requests)
+        if self.estimator and self.estimator.estimate_kbps is not None:
+            status["bandwidth_estimate_kbps"] = round(self.estimator.estimate_kbps)
+        if self.recorder:
+            status["recording"] = not self.recorder.failed
+        return status
+
+    def stop(self):
+        if self.reporter:
+            self.reporter.stop()
+        if self.latency:
+            self.latency.stop()
+        if self._adapt_source:
+            GLib.source_remove(self._adapt_source)
+        if self._report_source:
+            GLib.source_remove(self._report_source)
+        self.bus.remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        if self.keyframes:
+            self.keyframes.close()
+        if self.estimator:
+            self.estimator.close()
+        if self.recorder:
+            self.recorder.stop()
+        logger.info(f"Stream '{self.name}' stopped.")
+
+class MultiStreamReceiver:
+    """Runs any number of independent ReceiverStreams in one process and GLib main loop.
+
+    Streams can be added and removed at runtime without touching the others.
+    A failing stream is restarted on its own with exponential backoff: an SRT
+    error only cycles the existing pipeline, anything else rebuilds that one
+    stream's pipeline. The process, the plugin registry and the other streams
+    stay up. The loop exits when no stream is left, unless the last one was
+    removed through the control API.
+    """
+
+    def __init__(self, srt_ip, srt_port, enable_monitoring, export_to_influxdb, passthrough_mode="auto",
+                 recording=None):
+        self.srt_ip = srt_ip
+        self.srt_port = srt_port
+        self.enable_monitoring = enable_monitoring
+        self.export_to_influxdb = export_to_influxdb
+        self.passthrough_mode = passthrough_mode
+        self.recording = recording
+        # Defaults and latency mode for streams added through the control API, as at startup
+        self.stream_defaults = StreamConfig(0, "")
+        self.latency_mode = False
+        self.streams = {}
+        self.loop = GLib.MainLoop()
+
+    def add_stream(self, config):
+        if config.stream_name in self.streams:
+            raise ValueError(f"Stream '{config.stream_name}' already exists")
+        for name, stream in self.streams.items():
+            # Each stream owns port..port+4 (RTP, RTCP, latency, feedback, reports).
+            if abs(stream.config.port - config.port) <= 4:
+                raise ValueError(f"UDP ports {config.port}-{config.port + 4} overlap stream '{name}'")
+        stream = ReceiverStream(config, self.srt_ip, self.srt_port, self.enable_monitoring,
+                                self.export_to_influxdb, self.passthrough_mode, self._stream_stopped,
+                                recording=self.recording)
+        self.streams[config.stream_name] = stream
+        stream.start()
+
+    def remove_stream(self, stream_name, quit_when_empty=True):
+        stream = self.streams.pop(stream_name, None)
+        if stream:
+            stream.stop()
+        if not self.streams and quit_when_empty:
+            self.loop.quit()
+
+    def reload(self, configs):
+        """Apply a new stream list: remove streams that are gone or changed, add new ones.
+
+        The receiver keeps running while streams are replaced; it exits only
+        when the new list is empty.
+        """
+        wanted = {config.stream_name: config for config in configs}
+        for name, stream in list(self.streams.items()):
+            if wanted.get(name) != stream.config:
+                self.remove_stream(name, quit_when_empty=False)
+        for name, config in wanted.items():
+            if name not in self.streams:
+                try:
+                    self.add_stream(config)
+                except (ValueError, GLib.Error, OSError, PipelineError) as e:
+                    logger.error(f"Could not add stream '{name}': {e}")
+        if not wanted:
+            self.loop.quit()
+
+    def _stream_stopped(self, stream_name, message):
+        stream = self.streams.get(stream_name)
+        # A failure usually posts several errors; schedule one restart for all of them
+        if not stream or stream.restart_pending:
+            return
+        if stream.recorder and message.type == Gst.MessageType.ERROR and stream.recorder.owns(message.src):
+            stream.recorder.fail(message)
+            return
+        stream.restart_pending = True
+        sink_only = message.src.get_name().startswith("srt_sink")
+        delay = stream.backoff.next_delay()
+        logger.warning(f"Stream '{stream_name}' failed; {'restarting' if sink_only else 'rebuilding'} "
+                       f"in {delay:.2f} s (restart #{stream.backoff.restarts}).")
+        # Bus callbacks run in the main loop; the restart happens outside the signal handler
+        GLib.timeout_add(int(delay * 1000), self._restart_stream, stream, sink_only)
+
+    def _restart_stream(self, stream, sink_only):
+        if self.streams.get(stream.name) is not stream:
+            return GLib.SOURCE_REMOVE  # Removed or replaced meanwhile
+        stream.restart_pending = False
+        if sink_only:
+            if not stream.restart():
+                self._stream_failed_to_start(stream)
+            return GLib.SOURCE_REMOVE
+
+        stream.stop()
+        try:
+            rebuilt = ReceiverStream(stream.config, self.srt_ip, self.srt_port, self.enable_monitoring,
+                                     self.export_to_influxdb, self.passthrough_mode, self._stream_stopped,
+                                     stream.backoff, self.recording)
+        except (GLib.Error, OSError, PipelineError) as e:
+            logger.error(f"Could not rebuild stream '{stream.name}': {e}")
+            stream.restart_pending = True
+            GLib.timeout_add(int(stream.backoff.next_delay() * 1000), self._restart_stream, stream, False)
+            return GLib.SOURCE_REMOVE
+        self.streams[stream.name] = rebuilt
+        rebuilt.start()
+        return GLib.SOURCE_REMOVE
+
+    def _stream_failed_to_start(self, stream):
+        # A failed state change normally posts an ERROR; make sure a retry is scheduled either way
+        if not stream.restart_pending:
+            stream.restart_pending = True
+            GLib.timeout_add(int(stream.backoff.next_delay() * 1000), self._restart_stream, stream, True)
+
+    def run(self):
+        try:
+            logger.info("Starting video receiver and transcoder:")
+            self.loop.run()
+        except KeyboardInterrupt:
+            logger.info("\nInterrupted by user, stopping...")
+        except Exception as e:
+            logger.error(f"Exception occurred: {e}")
+            traceback.print_exc()
+        finally:
+            for name in list(self.streams):
+                self.streams.pop(name).stop()
+            if influx_exporter:
+                influx_exporter.stop()
+            self.loop.quit()
+            logger.info("Pipeline stopped.")
+
+def call_in_main_loop(func, *args, timeout=5.0):
+    """Run func(*args) on the GLib main loop and return its result (or raise its exception)."""
+    done = threading.Event()
+    result = {}
+
+    def run():
+        try:
+            result["value"] = func(*args)
+        except Exception as e:
+            result["error"] = e
+        done.set()
+        return GLib.SOURCE_REMOVE
+
+    GLib.idle_add(run)
+    if not done.wait(timeout):
+        raise TimeoutError("main loop did not respond")
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+# Prometheus histogram bounds in seconds
+INTERVAL_BUCKETS = (0.001, 0.005, 0.01, 0.02, 0.035, 0.05, 0.1, 0.25, 0.5, 1.0)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0)
+
+def _prom_labels(labels):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+class PrometheusMetrics:
+    """Renders the Prometheus text format from the receiver's in-memory aggregates.
+
+    Everything read here is already kept by the probes, link and latency
+    monitors and the restart backoff; a scrape copies counters and histogram
+    buckets and never waits on a streaming thread.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _add(self, name, kind, help_text, labels, value):
+        family = self._families.setdefault(name, (kind, help_text, []))
+        family[2].append(f"{name}{_prom_labels(labels)} {value}")
+
+    def _histogram(self, name, help_text, labels, counts, bounds, scale):
+        cumulative, total, value_sum = Histogram.cumulative(counts, bounds, scale)
+        family = self._families.setdefault(name, ("histogram", help_text, []))
+        for bound, count in zip(bounds, cumulative):
+            family[2].append(f"{name}_bucket{_prom_labels({**labels, 'le': bound})} {count}")
+        family[2].append(f"{name}_bucket{_prom_labels({**labels, 'le': '+Inf'})} {total}")
+        family[2].append(f"{name}_sum{_prom_labels(labels)} {value_sum}")
+        family[2].append(f"{name}_count{_prom_labels(labels)} {total}")
+
+    def _collect_stream(self, stream):
+        labels = {"stream": stream.name}
+        _, state, _ = stream.pipeline.get_state(0)
+        self._add("receiver_pipeline_playing", "gauge", "1 while the stream pipeline is PLAYING.",
+                  labels, int(state == Gst.State.PLAYING))
+        self._add("receiver_restarts_total", "counter", "In-process restarts of the stream.",
+                  labels, stream.backoff.restarts)
+        if stream.backoff.last_recovery_s is not None:
+            self._add("receiver_last_recovery_seconds", "gauge", "Duration of the last recovery.",
+                      labels, stream.backoff.last_recovery_s)
+        if stream.router:
+            self._add("receiver_passthrough", "gauge", "1 while H.264 is passed through without transcoding.",
+                      labels, int(stream.router.passthrough))
+        if stream.keyframes:
+            for reason, count in list(stream.keyframes.requests.items()):
+                self._add("receiver_keyframe_requests_total", "counter", "Keyframe requests for the streamer.",
+                          {**labels, "reason": reason}, count)
+            self._add("receiver_keyframe_requests_sent_total", "counter",
+                      "Keyframe requests sent after merging those within the minimum interval.",
+                      labels, stream.keyframes.sent)
+
+        link = stream.link
+        for key, value in (("received", link.received), ("lost", link.lost), ("reordered", link.reordered),
+                           ("duplicate", link.duplicates), ("late", link.jb_late),
+                           ("recovered", link.recovered_packets())):
+            self._add("receiver_rtp_packets_total", "counter", "RTP packets by outcome.",
+                      {**labels, "kind": key}, value)
+        self._add("receiver_incomplete_frames_dropped_total", "counter", "Frames dropped for missing packets.",
+                  labels, link.dropped_frames)
+        self._add("receiver_jitter_seconds", "gauge", "Average RTP interarrival jitter.", labels, link.jitter_ms / 1000)
+        if stream.estimator and stream.estimator.estimate_kbps is not None:
+            self._add("receiver_bandwidth_estimate_bps", "gauge", "Delay-based estimate of the available bandwidth.",
+                      labels, int(stream.estimator.estimate_kbps * 1000))
+            self._add("receiver_incoming_bps", "gauge", "Received media rate over the last second.",
+                      labels, int(stream.estimator.incoming_kbps * 1000))
+        self._add("receiver_jitterbuffer_latency_seconds", "gauge", "Current jitter buffer latency.",
+                  labels, link.latency_ms / 1000 if link.jitterbuffer else 0)
+
+        if stream.reporter:
+            for name, probe in stream.reporter.probes.items():
+                probe_labels = {**labels, "probe": name}
+                self._add("receiver_buffers_total", "counter", "Buffers seen at each probe point.",
+                          probe_labels, probe.buffers)
+                self._add("receiver_bytes_total", "counter", "Bytes seen at each probe point.",
+                          probe_labels, probe.bytes)
+                self._histogram("receiver_buffer_interval_seconds", "Time between buffers at each probe point.",
+                                probe_labels, probe.interval_us.snapshot(), INTERVAL_BUCKETS, 1e-6)
+        if stream.latency:
+            for point, histogram in list(stream.latency.histograms.items()):
+                self._histogram("receiver_latency_seconds", "Latency since capture (or since the previous point).",
+                                {**labels, "point": point}, histogram.snapshot(), LATENCY_BUCKETS, 1e-6)
+
+    def render(self):
+        with self._lock:
+            self._families = {}
+            for stream in list(self.receiver.streams.values()):
+                self._collect_stream(stream)
+            if influx_exporter:
+                self._add("receiver_influx_dropped_total", "counter", "Points dropped by the InfluxDB exporter.",
+                          {}, influx_exporter.dropped)
+            lines = []
+            for name, (kind, help_text, samples) in self._families.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format."""
+
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(receiver, host, port):
+    """Serve Prometheus metrics for the receiver in a background thread."""
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"metrics": PrometheusMetrics(receiver)})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Prometheus metrics on http://{host}:{port}/metrics")
+    return server
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """Local HTTP control API for a MultiStreamReceiver.
+
+    GET    /streams                      list streams and their settings
+    POST   /streams                      add a stream (same fields as a STREAMS entry)
+    DELETE /streams/<name>               remove a stream (the receiver keeps running without streams)
+    POST   /streams/<name>/bitrate       {"bitrate": kbps}
+    POST   /streams/<name>/resolution    {"width": w, "height": h}
+    POST   /streams/<name>/keyframe      force a keyframe (in passthrough: ask the streamer)
+    The last three take "rendition" to address one output of a ladder; <name>
+    may also be a published {stream}_{rendition} path, as MediaMTX hooks pass it.
+    """
+
+    receiver = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _stream(self, name):
+        stream = self.receiver.streams.get(name)
+        if stream is None:
+            raise KeyError(name)
+        return stream
+
+    def _output(self, path):
+        """(stream, rendition) for a stream name or a published {stream}_{rendition} path."""
+        if path in self.receiver.streams:
+            return self.receiver.streams[path], None
+        for stream in list(self.receiver.streams.values()):
+            for rendition in stream.config.renditions:
+                if path == f"{stream.name}_{rendition.name}":
+                    return stream, rendition.name
+        raise KeyError(path)
+
+    def _handle(self, method):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        try:
+            if parts == ["streams"] and method == "GET":
+                return self._reply(200, {name: stream.status() for name, stream in self.receiver.streams.items()})
+            if parts == ["streams"] and method == "POST":
+                config = parse_stream_configs([self._read_json()], self.receiver.stream_defaults,
+                                              self.receiver.latency_mode)[0]
+                call_in_main_loop(self.receiver.add_stream, config)
+                return self._reply(201, self._stream(config.stream_name).status())
+            if len(parts) == 2 and parts[0] == "streams" and method == "DELETE":
+                self._stream(parts[1])
+                # The receiver keeps running with no streams so more can be added through the API
+                call_in_main_loop(partial(self.receiver.remove_stream, quit_when_empty=False), parts[1])
+                return self._reply(200, {"removed": parts[1]})
+            if len(parts) == 3 and parts[0] == "streams" and method == "POST":
+                (stream, rendition), action = self._output(parts[1]), parts[2]
+                body = self._read_json()
+                rendition = body.get("rendition", rendition)
+                if action == "bitrate":
+                    call_in_main_loop(stream.set_bitrate, int(body["bitrate"]), rendition)
+                elif action == "resolution":
+                    call_in_main_loop(stream.set_resolution, int(body["width"]), int(body["height"]), rendition)
+                elif action == "keyframe":
+                    call_in_main_loop(stream.force_keyframe, rendition)
+                else:
+                    return self._reply(404, {"error": f"unknown action {action}"})
+                return self._reply(200, stream.status())
+            self._reply(404, {"error": "not found"})
+        except KeyError as e:
+            self._reply(404, {"error": f"unknown stream or missing field {e}"})
+        except (ValueError, TypeError, TimeoutError, GLib.Error) as e:
+            self._reply(400, {"error": str(e)})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        logger.info(f"Control API: {format % args}")
+
+def start_control_server(receiver, host, port):
+    """Serve the control API for the receiver in a background thread."""
+    handler = type("BoundControlHandler", (ControlHandler,), {"receiver": receiver})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="control-api", daemon=True).start()
+    logger.info(f"Control API listening on http://{host}:{port}")
+    return server
 
 if __name__ == "__main__":
     # Read environment variables
@@ -215,21 +2304,92 @@ if __name__ == "__main__":
     
     enable_monitoring = os.getenv("ENABLE_MONITORING", "false").lower() == "true"
     export_to_influxdb = os.getenv("EXPORT_TO_INFLUXDB", "false").lower() == "true"
+    latency_mode = os.getenv("LATENCY_MODE", "false").lower() == "true"
+    passthrough_mode = os.getenv("H264_PASSTHROUGH", "auto").lower()
+    control_host = os.getenv("CONTROL_HOST", "127.0.0.1")
+    control_port = int(os.getenv("CONTROL_PORT", 8080))
+    metrics_host = os.getenv("METRICS_HOST", "0.0.0.0")
+    metrics_port = int(os.getenv("METRICS_PORT", 9100))
+    latency_port = int(os.getenv("LATENCY_PORT", port + 2)) if latency_mode else None
+    # Opt-in: a jitter buffer adds its latency to every frame; FEC and RTX add their own when enabled
+    jitter_latency = int(os.getenv("JITTER_LATENCY", 0))
+    jitter_max_latency = int(os.getenv("JITTER_MAX_LATENCY", 200))
+    drop_incomplete = os.getenv("DROP_INCOMPLETE_FRAMES", "false").lower() == "true"
+    protection = os.getenv("RTP_PROTECTION", "none").lower()
+    renditions = parse_renditions(os.getenv("RENDITIONS", ""))
+    record = os.getenv("RECORD", "false").lower() == "true"
+    congestion_control = os.getenv("CONGESTION_CONTROL", "false").lower() == "true"
+    multicast_group = os.getenv("MULTICAST_GROUP") or None
+    recording = RecordingSettings(
+        directory=os.getenv("RECORD_DIR", "/recordings"),
+        format=os.getenv("RECORD_FORMAT", "ts").lower(),
+        segment_s=int(os.getenv("RECORD_SEGMENT_S", 60)),
+        max_bytes=int(float(os.getenv("RECORD_MAX_GB", 10)) * 1024 ** 3),
+        max_age_s=int(float(os.getenv("RECORD_MAX_AGE_H", 24)) * 3600),
+    )
+
+    defaults = StreamConfig(port, stream_name, use_h264, width, height, bitrate, speed_preset, latency_port,
+                            jitter_latency, jitter_max_latency, drop_incomplete, protection, renditions, record,
+                            congestion_control, multicast_group)
+    stream_configs = load_stream_configs(defaults, latency_mode)
 
     logger.info("Video Receiver and Transcoder Configuration:")
-    print(f"  Listening port: {port}")
-    print(f"  Resolution: {width}x{height}")
-    print(f"  Bitrate: {bitrate}")
-    print(f"  Speed preset: {speed_preset}")
+    for config in stream_configs:
+        print(f"  Stream name: {config.stream_name}")
+        print(f"    Listening port: {config.port}")
+        if config.multicast_group:
+            print(f"    Multicast group: {config.multicast_group}")
+        print(f"    Codec: {'H.264' if config.use_h264 else 'MJPEG'}")
+        print(f"    Resolution: {config.width}x{config.height}")
+        print(f"    Bitrate: {config.bitrate}")
+        print(f"    Speed preset: {config.speed_preset}")
+        if config.latency_port:
+            print(f"    Latency port: {config.latency_port}")
+        if config.jitter_latency:
+            print(f"    Jitter buffer: {config.jitter_latency} ms (max {config.jitter_max_latency} ms)")
+        else:
+            print("    Jitter buffer: off")
+        print(f"    Drop incomplete frames: {config.drop_incomplete}")
+        print(f"    RTP protection: {config.protection}")
+        if config.congestion_control:
+            print(f"    Congestion feedback: UDP port {config.port + 4} at the streamer")
+        for rendition in config.renditions:
+            print(f"    Rendition {config.stream_name}_{rendition.name}: "
+                  f"{rendition.width}x{rendition.height} @ {rendition.bitrate} kbps")
+        if config.record:
+            print(f"    Recording: {recording.directory} ({recording.format}, {recording.segment_s} s segments)")
     print(f"  Mediamtx server: {srt_ip}:{srt_port}")
-    print(f"  Stream name: {stream_name}")
     print(f"  Monitoring: {'Enabled' if enable_monitoring else 'Disabled'}")
+    print(f"  H.264 passthrough: {passthrough_mode}")
+    if control_port:
+        print(f"  Control API: {control_host}:{control_port}")
+    if metrics_port:
+        print(f"  Prometheus metrics: {metrics_host}:{metrics_port}/metrics")
 
     if export_to_influxdb:
-        init_influx_writer()
-
-    if use_h264:
-        print("  Rceived stream is H.264 encoded.")
+        init_influx_exporter()
 
     # Start the receiver
-    start_receiver(port, width, height, bitrate, speed_preset, srt_ip, srt_port, stream_name, enable_monitoring, use_h264, export_to_influxdb=export_to_influxdb)
+    Gst.init(None)
+    receiver = MultiStreamReceiver(srt_ip, srt_port, enable_monitoring, export_to_influxdb, passthrough_mode,
+                                   recording)
+    receiver.stream_defaults = defaults
+    receiver.latency_mode = latency_mode
+    for config in stream_configs:
+        receiver.add_stream(config)
+
+    # SIGHUP re-reads STREAMS_FILE and adds/removes streams without touching the others
+    def reload_streams():
+        try:
+            receiver.reload(load_stream_configs(defaults, latency_mode))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to reload stream list: {e}")
+        return GLib.SOURCE_CONTINUE
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, reload_streams)
+
+    if control_port:
+        start_control_server(receiver, control_host, control_port)
+    if metrics_port:
+        start_metrics_server(receiver, metrics_host, metrics_port)
+    receiver.run()
@@ -11,6 +11,19 @@ SRT_PORT="8890"
 STREAM_NAME="test_stream"
 ENABLE_MONITORING="true"
 USE_H264="false"
+LATENCY_MODE="false"
+LATENCY_PORT="5556"
+JITTER_LATENCY="0"
+JITTER_MAX_LATENCY="200"
+DROP_INCOMPLETE_FRAMES="false"
+RTP_PROTECTION="none"
+METRICS_PORT="9100"
+RENDITIONS=""
+RECORD="false"
+RECORD_DIR="$(pwd)/recordings"
+RECORD_FORMAT="ts"
+CONGESTION_CONTROL="false"
+MULTICAST_GROUP=""
 
 # Parse optional arguments
 while [[ "$#" -gt 0 ]]; do
@@ -45,6 +58,45 @@ while [[ "$#" -gt 0 ]]; do
     --use-h264)
       USE_H264="true"
       shift ;;         
+    --latency-mode)
+      LATENCY_MODE="true"
+      shift ;;
+    --latency-port)
+      LATENCY_PORT="$2"
+      shift 2;;
+    --jitter-latency)
+      JITTER_LATENCY="$2"
+      shift 2;;
+    --jitter-max-latency)
+      JITTER_MAX_LATENCY="$2"
+      shift 2;;
+    --drop-incomplete-frames)
+      DROP_INCOMPLETE_FRAMES="true"
+      shift ;;
+    --rtp-protection)
+      RTP_PROTECTION="$2"
+      shift 2;;
+    --metrics-port)
+      METRICS_PORT="$2"
+      shift 2;;
+    --renditions)
+      RENDITIONS="$2"
+      shift 2;;
+    --record)
+      RECORD="true"
+      shift ;;
+    --record-dir)
+      RECORD_DIR="$2"
+      shift 2;;
+    --record-format)
+      RECORD_FORMAT="$2"
+      shift 2;;
+    --congestion-control)
+      CONGESTION_CONTROL="true"
+      shift ;;
+    --multicast-group)
+      MULTICAST_GROUP="$2"
+      shift 2;;
     --)
       shift
       break;;
@@ -58,6 +110,9 @@ done
 docker run --rm -it \
   --name video-receiver-transcoder \
   -p "${RECEIVER_PORT}:${RECEIVER_PORT}/udp" \
+  -p "${LATENCY_PORT}:${LATENCY_PORT}/udp" \
+  -p "$((RECEIVER_PORT + 1)):$((RECEIVER_PORT + 1))/udp" \
+  -p "${METRICS_PORT}:${METRICS_PORT}" \
   -e RECEIVER_PORT="$RECEIVER_PORT" \
   -e WIDTH="$WIDTH" \
   -e HEIGHT="$HEIGHT" \
@@ -68,5 +123,18 @@ docker run --rm -it \
   -e STREAM_NAME="$STREAM_NAME" \
   -e ENABLE_MONITORING="$ENABLE_MONITORING" \
   -e USE_H264="$USE_H264" \
+  -e LATENCY_MODE="$LATENCY_MODE" \
+  -e LATENCY_PORT="$LATENCY_PORT" \
+  -e JITTER_LATENCY="$JITTER_LATENCY" \
+  -e JITTER_MAX_LATENCY="$JITTER_MAX_LATENCY" \
+  -e DROP_INCOMPLETE_FRAMES="$DROP_INCOMPLETE_FRAMES" \
+  -e RTP_PROTECTION="$RTP_PROTECTION" \
+  -e METRICS_PORT="$METRICS_PORT" \
+  -e RENDITIONS="$RENDITIONS" \
+  -e RECORD="$RECORD" \
+  -e RECORD_FORMAT="$RECORD_FORMAT" \
+  -e CONGESTION_CONTROL="$CONGESTION_CONTROL" \
+  -e MULTICAST_GROUP="$MULTICAST_GROUP" \
   -v ./app:/app/ \
+  -v "${RECORD_DIR}:/recordings" \
   video-receiver-transcoder
@@ -0,0 +1,131 @@
+import gzip
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("gi")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from video_receiver_transcoder import InfluxExporter
+
+
+class FakeInflux:
+    """Stands in for the InfluxDB /api/v2/write endpoint and records each batch it receives."""
+
+    def __init__(self, status=204):
+        self.status = status
+        self.batches = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.batches.append(gzip.decompress(body).decode("utf-8").split("\n"))
+                self.send_response(fake.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def lines(self):
+        return [line for batch in self.batches for line in batch]
+
+
+@pytest.fixture
+def influx():
+    server = FakeInflux()
+    yield server
+    server.close()
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def make_exporter(url, **kwargs):
+    kwargs.setdefault("flush_interval", 10.0)
+    return InfluxExporter(url, "token", "org", "bucket", timeout=1.0, **kwargs)
+
+
+def submit(exporter, count, start=0):
+    for i in range(start, start + count):
+        assert exporter.submit("video_metrics", {"stream": "cam"}, {"fps": float(i)}, timestamp_ns=i + 1)
+
+
+def test_points_are_sent_in_batches(influx):
+    exporter = make_exporter(influx.url, batch_size=3)
+    exporter.start()
+    submit(exporter, 7)
+    exporter.stop()
+
+    assert [len(batch) for batch in influx.batches] == [3, 3, 1]
+    assert influx.lines[0] == "video_metrics,stream=cam fps=0.0 1"
+    assert exporter.sent == 7
+    assert exporter.dropped == 0
+
+
+def test_submit_drops_when_queue_is_full(influx):
+    exporter = make_exporter(influx.url, queue_size=2)
+    submit(exporter, 2)
+
+    assert not exporter.submit("video_metrics", {"stream": "cam"}, {"fps": 1.0})
+    assert exporter.dropped == 1
+
+
+def test_unreachable_server_spools_batches(tmp_path):
+    spool = tmp_path / "spool.lp"
+    exporter = make_exporter(closed_port_url(), batch_size=2, spool_path=str(spool))
+    exporter.start()
+    submit(exporter, 3)
+    exporter.stop()
+
+    assert spool.read_text().splitlines() == [f"video_metrics,stream=cam fps={float(i)} {i + 1}" for i in range(3)]
+    assert exporter.spooled == 3
+    assert exporter.sent == 0
+
+
+def test_spool_is_replayed_before_new_points(influx, tmp_path):
+    spool = tmp_path / "spool.lp"
+    spooled = [f"video_metrics,stream=cam fps={float(i)} {i + 1}" for i in range(3)]
+    spool.write_text("\n".join(spooled) + "\n")
+    exporter = make_exporter(influx.url, batch_size=2, spool_path=str(spool))
+    exporter.start()
+    submit(exporter, 1, start=3)
+    exporter.stop()
+
+    assert influx.lines == spooled + ["video_metrics,stream=cam fps=3.0 4"]
+    assert not spool.exists()
+    assert exporter.sent == 4
+
+
+def test_rejected_batches_are_dropped_not_spooled(tmp_path):
+    influx = FakeInflux(status=400)
+    spool = tmp_path / "spool.lp"
+    try:
+        exporter = make_exporter(influx.url, batch_size=2, spool_path=str(spool))
+        exporter.start()
+        submit(exporter, 4)
+        exporter.stop()
+    finally:
+        influx.close()
+
+    assert len(influx.batches) == 2
+    assert not spool.exists()
+    assert exporter.dropped == 4
+    assert exporter.sent == 0
@@ -0,0 +1,71 @@
+import os
+import sys
+from dataclasses import replace
+
+import pytest
+
+pytest.importorskip("gi")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+import video_receiver_transcoder as receiver_module
+
+
+class FakeStream:
+    """Stands in for ReceiverStream so reload() can be exercised without building pipelines."""
+
+    def __init__(self, config, *args, **kwargs):
+        self.config = config
+        self.name = config.stream_name
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+class FakeLoop:
+    def __init__(self):
+        self.quit_calls = 0
+
+    def quit(self):
+        self.quit_calls += 1
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    monkeypatch.setattr(receiver_module, "ReceiverStream", FakeStream)
+    receiver = receiver_module.MultiStreamReceiver("127.0.0.1", 8890, False, False)
+    receiver.loop = FakeLoop()
+    return receiver
+
+
+def test_reload_changed_single_stream_keeps_running(receiver):
+    config = receiver_module.StreamConfig(5554, "cam")
+    receiver.add_stream(config)
+
+    receiver.reload([replace(config, bitrate=4000)])
+
+    assert receiver.loop.quit_calls == 0
+    assert receiver.streams["cam"].config.bitrate == 4000
+    assert receiver.streams["cam"].running
+
+
+def test_reload_empty_list_quits(receiver):
+    receiver.add_stream(receiver_module.StreamConfig(5554, "cam"))
+
+    receiver.reload([])
+
+    assert receiver.loop.quit_calls == 1
+    assert not receiver.streams
+
+
+def test_add_stream_rejects_overlapping_ports(receiver):
+    receiver.add_stream(receiver_module.StreamConfig(5554, "cam"))
+
+    with pytest.raises(ValueError):
+        receiver.add_stream(receiver_module.StreamConfig(5558, "other"))
+    receiver.add_stream(receiver_module.StreamConfig(5559, "other"))
+
+    assert set(receiver.streams) == {"cam", "other"}
@@ -0,0 +1,206 @@
+import os
+import json
+import fcntl
+import struct
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+SYSFS_V4L = "/sys/class/video4linux"
+CACHE_PATH = os.getenv("CAMERA_CACHE", os.path.join(tempfile.gettempdir(), "video_streamer_cameras.json"))
+
+# V4L2 ioctl request numbers (linux/videodev2.h), built like the kernel's _IOR/_IOWR macros
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord("V") << 8) | number
+
+_IOC_READ = 2
+_IOC_READ_WRITE = 3
+
+V4L2_CAPABILITY = struct.Struct("16s32s32sIII12x")
+V4L2_FMTDESC = struct.Struct("III32sII12x")
+V4L2_FRMSIZEENUM = struct.Struct("IIIIIIIII8x")
+V4L2_FRMIVALENUM = struct.Struct("IIIIIIIIIII8x")
+
+VIDIOC_QUERYCAP = _ioc(_IOC_READ, 0, V4L2_CAPABILITY.size)
+VIDIOC_ENUM_FMT = _ioc(_IOC_READ_WRITE, 2, V4L2_FMTDESC.size)
+VIDIOC_ENUM_FRAMESIZES = _ioc(_IOC_READ_WRITE, 74, V4L2_FRMSIZEENUM.size)
+VIDIOC_ENUM_FRAMEINTERVALS = _ioc(_IOC_READ_WRITE, 75, V4L2_FRMIVALENUM.size)
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+# Formats the streamer can use, in order of preference
+COLOR_FORMATS = ("MJPG", "YUYV")
+
+def _read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _fourcc(value):
+    return struct.pack("<I", value).decode("ascii", errors="replace")
+
+def _enumerate(fd, request, layout, *fields):
+    """Yield unpacked structs for index = 0, 1, ... until the driver returns EINVAL.
+
+    `fields` fill the u32 members that follow the index (type, pixel format, size).
+    """
+    index = 0
+    while True:
+        buf = bytearray(layout.size)
+        struct.pack_into(f"{1 + len(fields)}I", buf, 0, index, *fields)
+        try:
+            fcntl.ioctl(fd, request, buf)
+        except OSError:
+            return
+        yield layout.unpack(buf)
+        index += 1
+
+def query_capabilities(device):
+    """Return {fourcc: [[width, height, [fps, ...]], ...]} for a V4L2 capture node, or None if it is not one."""
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        buf = bytearray(V4L2_CAPABILITY.size)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, buf)
+        _, _, _, _, capabilities, device_caps = V4L2_CAPABILITY.unpack(buf)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        if not capabilities & V4L2_CAP_VIDEO_CAPTURE:
+            return None
+
+        formats = {}
+        for _, _, _, _, pixelformat, _ in _enumerate(fd, VIDIOC_ENUM_FMT, V4L2_FMTDESC, V4L2_BUF_TYPE_VIDEO_CAPTURE):
+            modes = []
+            for size in _enumerate(fd, VIDIOC_ENUM_FRAMESIZES, V4L2_FRMSIZEENUM, pixelformat):
+                if size[2] != V4L2_FRMSIZE_TYPE_DISCRETE:
+                    continue  # UVC cameras, RealSense included, list discrete sizes
+                width, height = size[3], size[4]
+                rates = []
+                for interval in _enumerate(fd, VIDIOC_ENUM_FRAMEINTERVALS, V4L2_FRMIVALENUM,
+                                           pixelformat, width, height):
+                    if interval[4] == V4L2_FRMIVAL_TYPE_DISCRETE and interval[5]:
+                        rates.append(round(interval[6] / interval[5], 2))
+                modes.append([width, height, sorted(set(rates), reverse=True)])
+            formats[_fourcc(pixelformat)] = modes
+        return formats
+    finally:
+        os.close(fd)
+
+def scan_devices():
+    """List video nodes from sysfs with their USB identity; no device is opened."""
+    devices = []
+    if not os.path.isdir(SYSFS_V4L):
+        return devices
+    for entry in sorted(os.listdir(SYSFS_V4L), key=lambda name: int(name[5:]) if name[5:].isdigit() else 0):
+        if not entry.startswith("video"):
+            continue
+        sys_path = os.path.join(SYSFS_V4L, entry)
+        interface = os.path.realpath(os.path.join(sys_path, "device"))
+        usb_device = os.path.dirname(interface)
+        devices.append({
+            "device": f"/dev/{entry}",
+            "name": _read_sysfs(os.path.join(sys_path, "name")) or "",
+            "dev": _read_sysfs(os.path.join(sys_path, "dev")),
+            "usb_path": os.path.basename(usb_device),
+            "serial": _read_sysfs(os.path.join(usb_device, "serial")),
+            # busnum/devnum change whenever the device is re-plugged or reset
+            "busnum": _read_sysfs(os.path.join(usb_device, "busnum")),
+            "devnum": _read_sysfs(os.path.join(usb_device, "devnum")),
+        })
+    return devices
+
+def _cache_key(info):
+    return f"{info['serial'] or '-'}@{info['usb_path']}:{info['device']}"
+
+def _fingerprint(info):
+    return [info["dev"], info["busnum"], info["devnum"]]
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache, path=CACHE_PATH):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write camera cache {path}: {e}")
+
+def camera_table(cache_path=CACHE_PATH):
+    """Return the capability table for all video nodes, querying only those not cached.
+
+    Entries are keyed by USB serial, USB port path and node; an entry whose
+    device number or USB bus/dev number changed (hotplug, reset) is queried again.
+    """
+    cache = load_cache(cache_path)
+    table = []
+    changed = False
+    for info in scan_devices():
+        key = _cache_key(info)
+        cached = cache.get(key)
+        if cached and cached["fingerprint"] == _fingerprint(info):
+            info["formats"] = cached["formats"]
+        else:
+            try:
+                info["formats"] = query_capabilities(info["device"])
+            except OSError as e:
+                logger.warning(f"Could not query {info['device']}: {e}")
+                continue
+            cache[key] = {"fingerprint": _fingerprint(info), "formats": info["formats"]}
+            changed = True
+        table.append(info)
+
+    # Drop entries for devices that are gone
+    present = {_cache_key(info) for info in table}
+    for key in [key for key in cache if key not in present]:
+        del cache[key]
+        changed = True
+    if changed:
+        save_cache(cache, cache_path)
+    return table
+
+def choose_mode(formats, width, height, framerate, preferred=COLOR_FORMATS):
+    """Pick (fourcc, width, height, fps) closest to the request.
+
+    An exact match wins; otherwise the smallest mode at least as large and as
+    fast as requested, otherwise the mode with the nearest pixel count.
+    Earlier formats in `preferred` win ties.
+    """
+    best = None
+    for rank, fourcc in enumerate(preferred):
+        for mode_width, mode_height, rates in (formats or {}).get(fourcc, []):
+            for fps in rates or [0]:
+                covers = mode_width >= width and mode_height >= height and fps >= framerate
+                score = (
+                    (mode_width, mode_height, fps) != (width, height, framerate),
+                    not covers,
+                    abs(mode_width * mode_height - width * height),
+                    abs(fps - framerate),
+                    rank,
+                )
+                if best is None or score < best[0]:
+                    best = (score, (fourcc, mode_width, mode_height, fps))
+    return best[1] if best else None
+
+def find_camera(name_filter, width, height, framerate, preferred=COLOR_FORMATS):
+    """Return (device, mode) for the first capture node whose name contains name_filter
+    and offers one of the preferred formats, or (None, None)."""
+    for info in camera_table():
+        if name_filter.lower() not in info["name"].lower() or not info["formats"]:
+            continue
+        mode = choose_mode(info["formats"], width, height, framerate, preferred)
+        if mode:
+            return info["device"], mode
+    return None, None
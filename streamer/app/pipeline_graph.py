@@ -0,0 +1,161 @@
+import logging
+import threading
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GObject
+
+logger = logging.getLogger(__name__)
+
+class PipelineError(RuntimeError):
+    """An element, property value, caps string or link the pipeline cannot be built with."""
+
+def parse_caps(caps):
+    """Return Gst.Caps for a caps string (or Gst.Caps), raising PipelineError if it does not parse."""
+    if isinstance(caps, Gst.Caps):
+        return caps
+    parsed = Gst.Caps.from_string(caps)
+    if parsed is None:
+        raise PipelineError(f"Invalid caps '{caps}'")
+    return parsed
+
+class PipelineGraph:
+    """Builds a Gst.Pipeline element by element instead of from a launch string.
+
+    Every element, property name, caps and structure string is checked when
+    it is added, so a typo fails at build time with the element named instead
+    of being ignored with a warning. Links report the caps on both sides when they fail.
+    Named taps keep the pads that probes attach to, and tee branches can be
+    added and removed while the pipeline is PLAYING.
+    """
+
+    def __init__(self, name=None):
+        self.pipeline = Gst.Pipeline.new(name)
+        self.taps = {}
+        self.branches = {}
+        self._specs = []
+        self._links = []
+
+    def add(self, factory, name=None, props=None, **kwargs):
+        """Create an element, set its properties and add it to the pipeline.
+
+        Properties come from `props` (GStreamer names, e.g. {"async": False})
+        and keyword arguments (underscores become dashes). String values for
+        non-string properties (enums, flags, caps, structures) are parsed the
+        way gst-launch parses them.
+        """
+        element = Gst.ElementFactory.make(factory, name)
+        if element is None:
+            raise PipelineError(f"GStreamer element '{factory}' is not available")
+        props = {**(props or {}), **{key.replace("_", "-"): value for key, value in kwargs.items()}}
+        self.set_properties(element, props)
+        self.pipeline.add(element)
+        self._specs.append(" ".join([factory, f"name={element.get_name()}"] +
+                                    [f"{key}={value}" for key, value in props.items()]))
+        return element
+
+    def capsfilter(self, caps, name=None):
+        return self.add("capsfilter", name, caps=parse_caps(caps))
+
+    @staticmethod
+    def set_properties(element, props):
+        factory = element.get_factory().get_name()
+        for key, value in props.items():
+            pspec = element.find_property(key)
+            if pspec is None:
+                raise PipelineError(f"{factory} has no property '{key}'")
+            if isinstance(value, str) and pspec.value_type == Gst.Caps.__gtype__:
+                element.set_property(key, parse_caps(value))
+            elif isinstance(value, str) and pspec.value_type == Gst.Structure.__gtype__:
+                structure = Gst.Structure.new_from_string(value)
+                if structure is None:
+                    raise PipelineError(f"Invalid structure '{value}' for {factory}.{key}")
+                element.set_property(key, structure)
+            elif isinstance(value, str) and pspec.value_type != GObject.TYPE_STRING:
+                # Enums, flags and numbers given as text, parsed like gst-launch does
+                Gst.util_set_object_arg(element, key, value)
+            else:
+                element.set_property(key, value)
+
+    def get(self, name):
+        element = self.pipeline.get_by_name(name)
+        if element is None:
+            raise PipelineError(f"No element named '{name}'")
+        return element
+
+    def link(self, src, sink, src_pad=None, sink_pad=None):
+        """Link two elements, optionally by pad name (request pads are requested)."""
+        if not src.link_pads(src_pad, sink, sink_pad):
+            src_caps = self._pad_caps(src, src_pad, Gst.PadDirection.SRC)
+            sink_caps = self._pad_caps(sink, sink_pad, Gst.PadDirection.SINK)
+            raise PipelineError(f"Cannot link {src.get_name()}:{src_pad or 'src'} ({src_caps}) to "
+                                f"{sink.get_name()}:{sink_pad or 'sink'} ({sink_caps})")
+        self._links.append(f"{src.get_name()}{'.' + src_pad if src_pad else ''} ! "
+                           f"{sink.get_name()}{'.' + sink_pad if sink_pad else ''}")
+        return sink
+
+    def chain(self, *elements):
+        """Link elements in order; returns the last one."""
+        for src, sink in zip(elements, elements[1:]):
+            self.link(src, sink)
+        return elements[-1]
+
+    @staticmethod
+    def _pad_caps(element, pad_name, direction):
+        pad = element.get_static_pad(pad_name) if pad_name else None
+        if pad is None:
+            pad = next((p for p in element.pads if p.direction == direction), None)
+        if pad is not None:
+            return pad.query_caps(None).to_string()
+        templates = [t for t in element.get_pad_template_list() if t.direction == direction]
+        return templates[0].get_caps().to_string() if templates else "no pad"
+
+    def tap(self, name, element, pad_name="src"):
+        """Register element's pad under `name` for probes; returns the pad."""
+        pad = element.get_static_pad(pad_name)
+        if pad is None:
+            raise PipelineError(f"{element.get_name()} has no static pad '{pad_name}'")
+        self.taps[name] = pad
+        return pad
+
+    def add_probe(self, tap, callback, *args, probe_type=Gst.PadProbeType.BUFFER):
+        return self.taps[tap].add_probe(probe_type, callback, *args)
+
+    def add_branch(self, name, tee, *elements):
+        """Link `elements` (already added, starting with a queue) to a new tee pad.
+
+        Works on a running pipeline: the branch is brought to the pipeline's
+        state from sink to source before the tee pad is linked.
+        """
+        self.chain(*elements)
+        for element in reversed(elements):
+            element.sync_state_with_parent()
+        tee_pad = tee.request_pad_simple("src_%u")
+        if tee_pad.link(elements[0].get_static_pad("sink")) != Gst.PadLinkReturn.OK:
+            tee.release_request_pad(tee_pad)
+            raise PipelineError(f"Cannot link {tee.get_name()} to branch '{name}'")
+        self.branches[name] = (tee, tee_pad, elements)
+        logger.info(f"Branch '{name}' added to {tee.get_name()}")
+
+    def remove_branch(self, name):
+        """Unlink a branch once its tee pad is idle, then shut it down off the streaming thread."""
+        tee, tee_pad, elements = self.branches.pop(name)
+
+        def dispose():
+            for element in elements:
+                element.set_state(Gst.State.NULL)
+                self.pipeline.remove(element)
+            tee.release_request_pad(tee_pad)
+            logger.info(f"Branch '{name}' removed from {tee.get_name()}")
+
+        def unlink(pad, info):
+            pad.unlink(elements[0].get_static_pad("sink"))
+            threading.Thread(target=dispose, name=f"remove-{name}", daemon=True).start()
+            return Gst.PadProbeReturn.REMOVE
+
+        tee_pad.add_probe(Gst.PadProbeType.IDLE, unlink)
+
+    def describe(self):
+        """Elements with the properties they were given, then links, one per line."""
+        return "\n".join(self._specs + self._links)
@@ -3,8 +3,11 @@ import os
 import traceback
 import logging
 
+import shlex
 import subprocess
-import re
+
+from camera_discovery import camera_table, choose_mode, find_camera
+from pipeline_graph import PipelineGraph
 
 import pyrealsense2 as rs
 import cv2
@@ -12,51 +15,41 @@ import numpy as np
 import time
 import signal
 import sys
+import threading
+import collections
+import socket
+import struct
+import bisect
+import ipaddress
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst, GLib
+gi.require_version('GstBase', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstBase, GstVideo, GLib
 
 # Initialize logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def find_realsense_color_camera():
-    """Automatically identify the RealSense color camera device."""
+def find_realsense_color_camera(width, height, framerate):
+    """Identify the RealSense color camera node from the cached V4L2 capability table."""
     try:
-        result = subprocess.run(["v4l2-ctl", "--list-devices"], text=True, capture_output=True, check=True)
-        devices_output = result.stdout
-
-        realsense_devices = []
-        current_device = None
-        for line in devices_output.splitlines():
-            if "RealSense" in line:
-                current_device = []
-            elif current_device is not None:
-                match = re.search(r"/dev/video\d+", line)
-                if match:
-                    current_device.append(match.group(0))
-                if not line.strip():  # End of device section
-                    realsense_devices.extend(current_device)
-                    current_device = None
-
-        for device in realsense_devices:
-            try:
-                result = subprocess.run(
-                    ["v4l2-ctl", f"--device={device}", "--list-formats-ext"],
-                    text=True, capture_output=True, check=True,
-                )
-                if "YUYV" in result.stdout or "MJPEG" in result.stdout:
-                    # logger.info(f"Color camera found: {device}")
-                    return device
-            except subprocess.CalledProcessError:
-                pass
-
-        logger.error("No RealSense color camera with YUYV format found.")
-        return None
+        device, mode = find_camera("RealSense", width, height, framerate)
     except Exception as e:
         logger.error(f"An error occurred during detection: {e}")
         return None
-    
+    if not device:
+        logger.error("No RealSense color camera with YUYV or MJPEG format found.")
+        return None
+    fourcc, mode_width, mode_height, fps = mode
+    logger.info(f"Color camera found: {device} (best mode {fourcc} {mode_width}x{mode_height}@{fps})")
+    if (mode_width, mode_height, fps) != (width, height, framerate):
+        logger.warning(f"Requested {width}x{height}@{framerate} is not offered; closest is "
+                       f"{mode_width}x{mode_height}@{fps}.")
+    return device
+
 def on_message(bus, message, loop):
     """Callback for GStreamer bus messages."""
     msg_type = message.type
@@ -81,13 +74,659 @@ def on_message(bus, message, loop):
         logger.info(f"Message: {Gst.MessageType.get_name(msg_type)}")
 
 
+# H.264 encoders in order of preference: (factory, bitrate property, bitrate scale to kbps, key-int property, extra properties)
+H264_ENCODERS = [
+    ("nvh264enc", "bitrate", 1, "gop-size", "preset=low-latency-hp rc-mode=cbr"),
+    ("vah264enc", "bitrate", 1, "key-int-max", "b-frames=0 rate-control=cbr"),
+    ("vaapih264enc", "bitrate", 1, "keyframe-period", "max-bframes=0 rate-control=cbr"),
+    ("v4l2h264enc", None, 1000, None, ""),
+    ("x264enc", "bitrate", 1, "key-int-max", "bframes=0 tune=zerolatency speed-preset={speed_preset}"),
+    ("openh264enc", "bitrate", 1000, "gop-size", "complexity={complexity} rate-control=bitrate usage-type=camera"),
+]
+
+# x264 speed presets mapped onto openh264enc complexity
+OPENH264_COMPLEXITY = {"ultrafast": "low", "superfast": "low", "veryfast": "low", "faster": "medium",
+                       "fast": "medium", "medium": "medium"}
+
+_h264_encoder = None
+
+def encoder_available(factory_name):
+    """Check that an encoder (or decoder) is registered and can actually open (e.g. has a device)."""
+    factory = Gst.ElementFactory.find(factory_name)
+    if factory is None:
+        return False
+    element = factory.create(None)
+    if element is None:
+        return False
+    available = element.set_state(Gst.State.READY) != Gst.StateChangeReturn.FAILURE
+    element.set_state(Gst.State.NULL)
+    return available
+
+def select_h264_encoder():
+    """Pick the H.264 encoder once: H264_ENCODER if set, else the first usable one, else x264enc."""
+    global _h264_encoder
+    if _h264_encoder:
+        return _h264_encoder
+
+    Gst.init(None)
+    requested = os.getenv("H264_ENCODER", "auto").lower()
+    candidates = [entry for entry in H264_ENCODERS if requested in ("auto", entry[0])]
+    for entry in candidates:
+        if encoder_available(entry[0]):
+            _h264_encoder = entry
+            break
+    else:
+        logger.warning(f"No usable H.264 encoder for H264_ENCODER={requested}, falling back to x264enc.")
+        _h264_encoder = next(entry for entry in H264_ENCODERS if entry[0] == "x264enc")
+
+    logger.info(f"H.264 encoder: {_h264_encoder[0]}")
+    return _h264_encoder
+
+def h264_encoder_props(bitrate, key_int, speed_preset="ultrafast"):
+    """(factory, properties) for the selected H.264 encoder with common settings mapped on.
+
+    bitrate is in kbps, key_int in frames; the encoder runs without B-frames in
+    its low-latency mode where it has one.
+    """
+    factory, bitrate_prop, scale, key_int_prop, extra = select_h264_encoder()
+    if factory == "v4l2h264enc":
+        return factory, {"extra-controls": f"controls,video_bitrate={bitrate * scale},h264_i_frame_period={key_int}"}
+    props = {bitrate_prop: bitrate * scale, key_int_prop: key_int}
+    for prop in extra.format(speed_preset=speed_preset,
+                             complexity=OPENH264_COMPLEXITY.get(speed_preset, "high")).split():
+        key, value = prop.split("=", 1)
+        props[key] = value
+    return factory, props
+
+def set_encoder_bitrate(encoder, bitrate):
+    """Change the bitrate (kbps) of a running encoder created from h264_encoder_props()."""
+    factory = encoder.get_factory().get_name()
+    entry = next((entry for entry in H264_ENCODERS if entry[0] == factory), None)
+    if entry is None:
+        raise ValueError(f"Unsupported encoder {factory}")
+    _, bitrate_prop, scale, _, _ = entry
+    if factory == "v4l2h264enc":
+        encoder.set_property("extra-controls", Gst.Structure.new_from_string(f"controls,video_bitrate={bitrate * scale}"))
+    else:
+        encoder.set_property(bitrate_prop, bitrate * scale)
+
+# GOP length in frames when nothing can answer keyframe requests
+SHORT_KEY_INT = 10
+
+def keyframe_interval(framerate, on_request=True):
+    """GOP length in frames: KEY_INT_S seconds (default 2), or SHORT_KEY_INT without keyframes on request.
+
+    Viewers joining and losses are covered by keyframes on request, so the
+    regular interval only bounds recovery when a request is lost. Where
+    requests cannot be served, the short GOP is what bounds recovery.
+    """
+    if not on_request:
+        return SHORT_KEY_INT
+    return max(1, round(float(os.getenv("KEY_INT_S", 2)) * framerate))
+
+def h264_encoder_desc(bitrate, key_int, speed_preset="ultrafast"):
+    """h264_encoder_props() as a gst-launch fragment, for the gst-launch subprocess."""
+    factory, props = h264_encoder_props(bitrate, key_int, speed_preset)
+    return " ".join([factory] + [f"{key}={value}" for key, value in props.items()])
+
+# JPEG decoders in order of preference; the hardware ones can hand frames to a
+# hardware encoder without passing through system memory
+JPEG_DECODERS = ["v4l2jpegdec", "vajpegdec", "nvjpegdec", "jpegdec"]
+HARDWARE_PREFIXES = ("v4l2", "va", "nv")
+
+def select_jpeg_decoder():
+    """Pick the JPEG decoder: JPEG_DECODER if set, else the first usable one, else jpegdec."""
+    requested = os.getenv("JPEG_DECODER", "auto").lower()
+    for factory in JPEG_DECODERS:
+        if requested in ("auto", factory) and encoder_available(factory):
+            return factory
+    if requested != "auto":
+        logger.warning(f"JPEG decoder {requested} is not usable, falling back to jpegdec.")
+    return "jpegdec"
+
+# Interval for logging per-stage copy counts (seconds)
+COPY_STATS_INTERVAL = 10
+
+# RTP payload types for ULPFEC and retransmission packets
+FEC_PT = 122
+RTX_PT = 97
+
+def rtcp_feedback_port(port):
+    """UDP port the receiver sends RTCP feedback (NACK, PLI, FIR) to."""
+    return int(os.getenv("RTCP_FEEDBACK_PORT", port + 3))
+
+def rtp_mtu(host):
+    """Largest RTP packet for the payloaders: RTP_MTU, or with RTP_MTU=auto the path MTU to host.
+
+    The kernel's path MTU (the interface MTU until a smaller one is learned)
+    less the IPv4 and UDP headers, and room for the ULPFEC or RTX header that
+    wraps a protected packet, so no packet is fragmented on the way.
+    """
+    configured = os.getenv("RTP_MTU", "1400").lower()
+    if configured != "auto":
+        return int(configured)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((host, 9))
+            path_mtu = probe.getsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU", 14))
+    except OSError as e:
+        logger.warning(f"Could not read the path MTU to {host} ({e}), using 1400.")
+        return 1400
+    return max(548, path_mtu - 28 - 16)
+
+def parse_destination(destination):
+    """(host, port) for a 'host:port' string."""
+    host, _, port = destination.strip().rpartition(":")
+    if not host:
+        raise ValueError(f"Destination '{destination}' is not host:port")
+    return host, int(port)
+
+def destinations(host, port):
+    """RECEIVER_IP:RECEIVER_PORT followed by the extra receivers in DESTINATIONS (comma-separated host:port)."""
+    extra = [parse_destination(d) for d in os.getenv("DESTINATIONS", "").split(",") if d.strip()]
+    return [(host, port)] + [d for d in extra if d != (host, port)]
+
+def is_multicast(host):
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        return False
+
+def clients(targets, offset=0):
+    return ",".join(f"{host}:{port + offset}" for host, port in targets)
+
+def udp_sink_props(host, port):
+    """Properties of the media multiudpsink.
+
+    It sends every packet to all destinations(), so extra receivers cost a
+    sendto() each, not another capture and encode. UDP_SEND_BUFFER sets
+    SO_SNDBUF (bytes, 0 = system default). For multicast groups, packets are
+    sent with MULTICAST_TTL (default 1) on MULTICAST_IFACE and not looped back.
+    """
+    targets = destinations(host, port)
+    props = {"clients": clients(targets), "sync": False}
+    send_buffer = int(os.getenv("UDP_SEND_BUFFER", 0))
+    if send_buffer:
+        props["buffer-size"] = send_buffer
+    if any(is_multicast(h) for h, _ in targets):
+        props["ttl-mc"] = int(os.getenv("MULTICAST_TTL", 1))
+        props["loop"] = False
+        if os.getenv("MULTICAST_IFACE"):
+            props["multicast-iface"] = os.environ["MULTICAST_IFACE"]
+    return props
+
+def udp_sink_desc(host, port):
+    return " ".join(["multiudpsink"] + [f"{key}={str(value).lower() if isinstance(value, bool) else value}"
+                                        for key, value in udp_sink_props(host, port).items()])
+
+def rtp_sink_desc(host, port, pt):
+    """gst-launch tail after the RTP payloader, protected as selected by RTP_PROTECTION.
+
+    Used by the gst-launch subprocess; in-process pipelines use add_rtp_sink().
+
+    - none: plain udpsink.
+    - fec: rtpulpfecenc adds ULPFEC packets (FEC_PERCENTAGE overhead) to the
+      same RTP stream so the receiver can rebuild lost packets without a round trip.
+    - rtx: an rtpbin session sends RTCP to the receiver (port + 1) and listens for
+      NACKs on RTCP_FEEDBACK_PORT (default port + 3); rtprtxsend keeps recent
+      packets and resends the ones the receiver asks for.
+    """
+    protection = os.getenv("RTP_PROTECTION", "none").lower()
+    if protection == "fec":
+        percentage = int(os.getenv("FEC_PERCENTAGE", 20))
+        return (
+            f"rtpulpfecenc name=fec pt={FEC_PT} percentage={percentage} ! "
+            f"{udp_sink_desc(host, port)}"
+        )
+    if protection == "rtx":
+        feedback_port = rtcp_feedback_port(port)
+        return (
+            f'rtprtxsend name=rtx payload-type-map="application/x-rtp-pt-map,{pt}=(uint){RTX_PT}" '
+            "max-size-time=500 ! rtpbin.send_rtp_sink_0 "
+            "rtpbin name=rtpbin rtp-profile=avpf "
+            f"rtpbin.send_rtp_src_0 ! {udp_sink_desc(host, port)} "
+            f"rtpbin.send_rtcp_src_0 ! multiudpsink clients={clients(destinations(host, port), 1)} "
+            "sync=false async=false "
+            f"udpsrc port={feedback_port} ! rtpbin.recv_rtcp_sink_0"
+        )
+    if protection != "none":
+        logger.warning(f"Unknown RTP_PROTECTION '{protection}', sending unprotected RTP.")
+    return udp_sink_desc(host, port)
+
+def add_pacing(graph, payloader, framerate):
+    """With PACING on, add a leaky queue and an identity after the payloader; returns the element to link on from.
+
+    rtpjpegpay and rtph264pay push each frame as one buffer list, which
+    udpsink sends in one go. The identity after the queue splits the list into
+    single packets, and Pacer spaces them out at the sink, FEC and RTX packets
+    included. The queue sits before rtpulpfecenc and rtprtxsend, so every item
+    in it is a whole frame and a leak never drops part of one.
+    """
+    if os.getenv("PACING", "False").lower() != "true":
+        return payloader
+    # Frames wait here while the previous one is paced out. The limit is in time, because a buffer list counts
+    # as one buffer per packet; once the queued frames span three intervals the oldest is dropped.
+    queue = graph.add("queue", "pace_queue", max_size_buffers=0, max_size_bytes=0,
+                      max_size_time=int(3 * Gst.SECOND / framerate), leaky="downstream")
+    return graph.chain(payloader, queue, graph.add("identity", "pace_split", silent=True))
+
+def add_rtp_sink(graph, payloader, host, port, pt, framerate):
+    """Add and link the elements after the RTP payloader, as rtp_sink_desc() describes them, plus add_pacing()."""
+    payloader = add_pacing(graph, payloader, framerate)
+    protection = os.getenv("RTP_PROTECTION", "none").lower()
+    if protection == "fec":
+        fec = graph.add("rtpulpfecenc", "fec", pt=FEC_PT, percentage=int(os.getenv("FEC_PERCENTAGE", 20)))
+        graph.chain(payloader, fec, graph.add("multiudpsink", "sink", udp_sink_props(host, port)))
+        return
+    if protection == "rtx":
+        feedback_port = rtcp_feedback_port(port)
+        rtx = graph.add("rtprtxsend", "rtx", payload_type_map=f"application/x-rtp-pt-map,{pt}=(uint){RTX_PT}",
+                        max_size_time=500)
+        rtpbin = graph.add("rtpbin", "rtpbin", rtp_profile="avpf")
+        graph.chain(payloader, rtx)
+        graph.link(rtx, rtpbin, sink_pad="send_rtp_sink_0")
+        graph.link(rtpbin, graph.add("multiudpsink", "sink", udp_sink_props(host, port)), src_pad="send_rtp_src_0")
+        graph.link(rtpbin, graph.add("multiudpsink", "rtcp_sink", {"async": False},
+                                     clients=clients(destinations(host, port), 1), sync=False),
+                   src_pad="send_rtcp_src_0")
+        graph.link(graph.add("udpsrc", "rtcp_in", port=feedback_port), rtpbin, sink_pad="recv_rtcp_sink_0")
+        return
+    if protection != "none":
+        logger.warning(f"Unknown RTP_PROTECTION '{protection}', sending unprotected RTP.")
+    graph.chain(payloader, graph.add("multiudpsink", "sink", udp_sink_props(host, port)))
+
+class Destinations:
+    """The receivers an in-process pipeline sends to, changed while it runs.
+
+    multiudpsink adds and removes clients under its own lock, so this is
+    safe from any thread. With RTP_PROTECTION=rtx each receiver also gets
+    the sender's RTCP on port + 1.
+
+    get-stats takes the same lock as the streaming thread, so a background
+    thread refreshes `last_stats` every `stats_interval` seconds for the
+    metrics endpoint to read instead.
+    """
+
+    def __init__(self, gst_pipe, stats_interval=1.0):
+        self.sink = gst_pipe.get_by_name("sink")
+        self.rtcp_sink = gst_pipe.get_by_name("rtcp_sink")
+        self.stats_interval = stats_interval
+        self.last_stats = []
+        threading.Thread(target=self._poll_stats, name="destination-stats", daemon=True).start()
+
+    def _poll_stats(self):
+        while True:
+            self.last_stats = self.stats()
+            time.sleep(self.stats_interval)
+
+    def list(self):
+        return [parse_destination(d) for d in self.sink.get_property("clients").split(",") if d]
+
+    def add(self, host, port):
+        if (host, port) in self.list():
+            raise ValueError(f"{host}:{port} is already a destination")
+        self.sink.emit("add", host, port)
+        if self.rtcp_sink:
+            self.rtcp_sink.emit("add", host, port + 1)
+        logger.info(f"Sending to {host}:{port}")
+
+    def remove(self, host, port):
+        if (host, port) not in self.list():
+            raise KeyError(f"{host}:{port}")
+        self.sink.emit("remove", host, port)
+        if self.rtcp_sink:
+            self.rtcp_sink.emit("remove", host, port + 1)
+        logger.info(f"Stopped sending to {host}:{port}")
+
+    def stats(self):
+        """Per destination: {"destination", "packets_sent", "bytes_sent", "connected_s"}."""
+        now = time.time_ns()
+        result = []
+        for host, port in self.list():
+            stats = self.sink.emit("get-stats", host, port)
+            if stats is None:
+                continue
+            result.append({
+                "destination": f"{host}:{port}",
+                "packets_sent": stats.get_uint64("packets-sent")[1],
+                "bytes_sent": stats.get_uint64("bytes-sent")[1],
+                "connected_s": round((now - stats.get_uint64("connect-time")[1]) / 1e9, 1),
+            })
+        return result
+
+# Per-frame send duration buckets (seconds)
+SEND_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.1)
+
+class Pacer:
+    """Spreads each frame's RTP packets over the frame interval instead of sending them at line rate.
+
+    A token bucket in front of udpsink: up to `burst_bytes` leave at once,
+    the rest at the pacing rate. With rate_kbps=0 the rate follows the
+    frames: the average frame size over `spread` of the frame interval, so a
+    typical frame takes about 80% of the interval and the queue in front
+    drains between frames. The sleep happens on the pacing queue's thread,
+    never on the encoder's, and only once a millisecond of debt has built up.
+
+    Records how long each frame takes to send (first packet to the RTP
+    marker) and how many frames the pacing queue dropped.
+    """
+
+    def __init__(self, gst_pipe, framerate, rate_kbps=0, burst_bytes=15000, spread=0.8):
+        self.rate = rate_kbps * 125
+        self.burst = burst_bytes
+        self.frame_interval = 1 / framerate
+        self.spread = spread
+        self.send_seconds = PrometheusHistogram(SEND_BUCKETS)
+        self.frames_dropped = 0
+        self._tokens = burst_bytes
+        self._last = None
+        self._frame_start = None
+        self._frame_bytes = 0
+        self._average_frame_bytes = None
+        gst_pipe.get_by_name("sink").get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._probe)
+        gst_pipe.get_by_name("pace_queue").connect("overrun", self._overrun)
+        logger.info(f"Pacing RTP: {f'{rate_kbps} kbps' if rate_kbps else f'each frame over {spread:.0%} of the interval'}"
+                    f", bursts up to {burst_bytes} bytes")
+
+    def current_rate(self):
+        """Pacing rate in bytes/s, or 0 before the first frame when it follows the frames."""
+        if self.rate:
+            return self.rate
+        if self._average_frame_bytes is None:
+            return 0
+        return self._average_frame_bytes / (self.spread * self.frame_interval)
+
+    def _overrun(self, queue):
+        self.frames_dropped += 1
+
+    def _probe(self, pad, info):
+        buffer = info.get_buffer()
+        size = buffer.get_size()
+        now = time.perf_counter()
+        rate = self.current_rate()
+        if rate:
+            if self._last is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * rate)
+            self._tokens -= size
+            if self._tokens < -0.001 * rate:
+                time.sleep(-self._tokens / rate)
+                now = time.perf_counter()
+                self._tokens = 0
+        self._last = now
+
+        if self._frame_start is None:
+            self._frame_start = now
+        self._frame_bytes += size
+        if size > 1 and buffer.extract_dup(1, 1)[0] & 0x80:
+            # RTP marker: last packet of the frame
+            self.send_seconds.observe(now - self._frame_start)
+            self._average_frame_bytes = self._frame_bytes if self._average_frame_bytes is None else \
+                0.9 * self._average_frame_bytes + 0.1 * self._frame_bytes
+            self._frame_start = None
+            self._frame_bytes = 0
+        return Gst.PadProbeReturn.OK
+
+def attach_pacer(gst_pipe, framerate):
+    """Start pacing a pipeline built with PACING=true; returns the Pacer or None."""
+    if gst_pipe.get_by_name("pace_queue") is None:
+        return None
+    return Pacer(gst_pipe, framerate, int(os.getenv("PACING_RATE", 0)), int(os.getenv("PACING_BURST", 15000)))
+
+def udp_send_buffer_errors():
+    """UDP datagrams the kernel dropped for a full send buffer (SndbufErrors), for the whole network namespace."""
+    try:
+        with open("/proc/net/snmp") as f:
+            rows = [line.split() for line in f if line.startswith("Udp:")]
+        return int(dict(zip(rows[0][1:], rows[1][1:]))["SndbufErrors"])
+    except (OSError, IndexError, KeyError, ValueError):
+        return None
+
+# RTCP payload-specific feedback (RFC 4585, RFC 5104)
+RTCP_PSFB = 206
+PSFB_PLI = 1
+PSFB_FIR = 4
+
+def keyframe_requests(packet):
+    """Yield 'pli' / 'fir' for each keyframe request in a (compound) RTCP packet."""
+    offset = 0
+    while offset + 4 <= len(packet):
+        first, packet_type, length = struct.unpack_from("!BBH", packet, offset)
+        if first >> 6 != 2:
+            return
+        if packet_type == RTCP_PSFB and first & 0x1F in (PSFB_PLI, PSFB_FIR):
+            yield "pli" if first & 0x1F == PSFB_PLI else "fir"
+        offset += (length + 1) * 4
+
+def force_keyframe(encoder):
+    """Ask a running encoder for an immediate keyframe with SPS/PPS."""
+    event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+    return encoder.get_static_pad("src").send_event(event)
+
+class KeyframeRequestListener(threading.Thread):
+    """Forces an encoder keyframe when the receiver sends an RTCP PLI or FIR.
+
+    Used without RTP_PROTECTION=rtx; with rtx, rtpbin already listens on the
+    feedback port and turns PLI/FIR into force-key-unit events itself.
+    Requests within min_interval of a forced keyframe are merged into it: one
+    keyframe repairs every loss before it, and a burst of requests would
+    otherwise send a burst of large frames.
+    """
+
+    def __init__(self, encoder, port, min_interval=0.5):
+        super().__init__(name="keyframe-requests", daemon=True)
+        self.encoder = encoder
+        self.min_interval = min_interval
+        self._last = 0.0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", port))
+        logger.info(f"Listening for keyframe requests (RTCP PLI/FIR) on UDP port {port}")
+
+    def run(self):
+        while True:
+            try:
+                packet, _ = self.sock.recvfrom(1500)
+            except OSError:
+                return
+            for kind in keyframe_requests(packet):
+                stream_metrics.keyframe_requests[kind] += 1
+                now = time.monotonic()
+                if now - self._last >= self.min_interval and force_keyframe(self.encoder):
+                    self._last = now
+                    stream_metrics.keyframes_forced += 1
+                    logger.info(f"Keyframe forced ({kind.upper()} from the receiver).")
+
+def listen_for_keyframe_requests(gst_pipe, port):
+    """Serve the receiver's keyframe requests for an in-process H.264 pipeline."""
+    min_interval = float(os.getenv("KEYFRAME_MIN_INTERVAL_MS", 500)) / 1000
+    rtpbin = gst_pipe.get_by_name("rtpbin")
+    if rtpbin is None:
+        listener = KeyframeRequestListener(gst_pipe.get_by_name("encoder"), rtcp_feedback_port(port), min_interval)
+        listener.start()
+        return listener
+
+    # rtpbin forces the keyframe; only count the requests
+    def on_feedback(session, rtcp_type, fbtype, sender_ssrc, media_ssrc, fci):
+        if rtcp_type == RTCP_PSFB and fbtype in (PSFB_PLI, PSFB_FIR):
+            stream_metrics.keyframe_requests["pli" if fbtype == PSFB_PLI else "fir"] += 1
+
+    rtpbin.emit("get-internal-session", 0).connect("on-feedback-rtcp", on_feedback)
+    return None
+
+# Congestion feedback from the receiver: magic, sequence, delay-based estimate (kbps),
+# received rate (kbps), jitter (us), loss (1/1000), overuse signal (must match the receiver)
+CC_REPORT = struct.Struct("!4sIIIIHB")
+CC_SIGNALS = ("normal", "overuse", "underuse")
+
+class CongestionController(threading.Thread):
+    """Sender side of a GCC-style congestion control loop.
+
+    The receiver's BandwidthEstimator reports every ~200 ms: its delay-based
+    estimate of the available bandwidth, the rate it receives, the loss
+    fraction and the jitter. The loss-based rate kept here drops by half the
+    loss fraction (per second) above 10% loss, holds between 2% and 10%, and
+    grows by about 8% per second below 2%. The target is the lower of the two,
+    kept between min_kbps and max_kbps, and drives one actuator:
+
+    - H.264: the encoder bitrate, changed live.
+    - MJPEG with ADAPTIVE_JPEG: the JpegRateController target (quality, then size).
+    - other MJPEG: the framerate, by dropping whole frames before the payloader.
+
+    With several receivers (DESTINATIONS, multicast), the last report of
+    each sender address is kept until it is `timeout` seconds old. The
+    lowest estimate and received rate and the highest loss and jitter among
+    them drive the target, so the weakest receiver sets the rate instead
+    of the reports taking turns.
+
+    When reports stop for `timeout` seconds, the target is halved every second.
+    Feedback that no longer arrives usually means the link is congested.
+    """
+
+    INCREASE_PER_S = 1.08
+
+    def __init__(self, port, max_kbps, min_kbps, framerate, timeout=2.0):
+        super().__init__(name="congestion-control", daemon=True)
+        self.max_kbps = max_kbps
+        self.min_kbps = min(min_kbps, max_kbps) if max_kbps else min_kbps
+        self.framerate = framerate
+        self.timeout = timeout
+        self.target_kbps = max_kbps
+        self.loss_based_kbps = max_kbps
+        self.receiver_estimate_kbps = None
+        self.received_kbps = 0
+        self.loss = 0.0
+        self.jitter_ms = 0.0
+        self.signal = "normal"
+        self.reports = 0
+        self.frames_dropped = 0
+        self.actuator = None
+        self._apply = None
+        self._gating = False
+        self._frame_bytes = None
+        self._credit = 1.0
+        self._last_report = None
+        self._last_cut = 0.0
+        self._receivers = {}  # sender address -> (time, estimate, received, jitter_ms, loss, signal)
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", port))
+        self.sock.settimeout(0.5)
+        logger.info(f"Congestion control: feedback on UDP port {port}, "
+                    f"{self.min_kbps}-{max_kbps or 'unlimited'} kbps")
+
+    def control_encoder(self, encoder):
+        self.actuator = "encoder_bitrate"
+        self._apply = lambda kbps: set_encoder_bitrate(encoder, kbps)
+
+    def control_jpeg(self, rate_controller):
+        self.actuator = "jpeg_quality"
+        self._apply = rate_controller.set_target
+
+    def gate_frames(self, payloader=None):
+        """Limit the framerate to the target; frames are dropped at the payloader's sink, or by admit()."""
+        self.actuator = "framerate"
+        self._gating = True
+        if payloader:
+            payloader.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._gate_probe)
+
+    def admit(self, size):
+        """True if a frame of `size` bytes fits the target rate; always True unless gating frames."""
+        if not self._gating:
+            return True
+        with self._lock:
+            self._frame_bytes = size if self._frame_bytes is None else 0.9 * self._frame_bytes + 0.1 * size
+            if self.target_kbps is None:
+                return True
+            fps = min(self.framerate, max(1.0, self.target_kbps * 125 / self._frame_bytes))
+            self._credit = min(self._credit + fps / self.framerate, 2.0)
+            if self._credit >= 1.0:
+                self._credit -= 1.0
+                return True
+        self.frames_dropped += 1
+        return False
+
+    def _gate_probe(self, pad, info):
+        return Gst.PadProbeReturn.OK if self.admit(info.get_buffer().get_size()) else Gst.PadProbeReturn.DROP
+
+    def run(self):
+        while True:
+            try:
+                packet, address = self.sock.recvfrom(64)
+            except socket.timeout:
+                self._check_feedback()
+                continue
+            except OSError:
+                return
+            if len(packet) != CC_REPORT.size:
+                continue
+            magic, _, estimate, received, jitter_us, loss_permille, signal = CC_REPORT.unpack(packet)
+            if magic == b"RATE":
+                self._on_report(address[0], estimate, received, jitter_us / 1000, loss_permille / 1000, signal)
+
+    def _on_report(self, sender, estimate, received, jitter_ms, loss, signal):
+        now = time.monotonic()
+        elapsed = min(1.0, now - self._last_report) if self._last_report else 0.0
+        self._last_report = now
+        self.reports += 1
+        self._receivers[sender] = (now, estimate, received, jitter_ms, loss, signal)
+        for address, report in list(self._receivers.items()):
+            if now - report[0] > self.timeout:
+                del self._receivers[address]
+        # The receiver with the lowest estimate is the bottleneck
+        _, estimate, _, _, _, signal = min(self._receivers.values(), key=lambda report: report[1])
+        received = min(report[2] for report in self._receivers.values())
+        jitter_ms = max(report[3] for report in self._receivers.values())
+        loss = max(report[4] for report in self._receivers.values())
+        self.receiver_estimate_kbps, self.received_kbps = estimate, received
+        self.jitter_ms, self.loss = jitter_ms, loss
+        self.signal = CC_SIGNALS[signal] if signal < len(CC_SIGNALS) else "normal"
+
+        if self.loss_based_kbps is None:
+            # No BITRATE ceiling (camera MJPEG): start from what the receiver gets
+            self.loss_based_kbps = max(received, self.min_kbps)
+        if loss > 0.10:
+            self.loss_based_kbps *= (1 - 0.5 * loss) ** elapsed
+        elif loss < 0.02:
+            self.loss_based_kbps *= self.INCREASE_PER_S ** elapsed
+        self.loss_based_kbps = self._clamp(self.loss_based_kbps)
+        self._set_target(min(self.loss_based_kbps, estimate))
+
+    def _check_feedback(self):
+        now = time.monotonic()
+        if self._last_report is None or now - self._last_report < self.timeout or now - self._last_cut < 1.0:
+            return
+        self._last_cut = now
+        if self.target_kbps is not None and self.target_kbps > self.min_kbps:
+            logger.warning(f"No congestion feedback for {now - self._last_report:.1f} s, halving the send rate.")
+            self.loss_based_kbps = self._clamp(self.target_kbps / 2)
+            self._set_target(self.loss_based_kbps)
+
+    def _clamp(self, kbps):
+        kbps = max(self.min_kbps, kbps)
+        return min(self.max_kbps, kbps) if self.max_kbps else kbps
+
+    def _set_target(self, kbps):
+        kbps = int(self._clamp(kbps))
+        previous = self.target_kbps
+        # Small steps would only churn the encoder
+        if previous and abs(kbps - previous) < 0.05 * previous and kbps not in (self.min_kbps, self.max_kbps):
+            return
+        if kbps == previous:
+            return
+        self.target_kbps = kbps
+        logger.info(f"Congestion control: target {previous} -> {kbps} kbps ({self.actuator}; "
+                    f"receiver estimate {self.receiver_estimate_kbps} kbps, received {self.received_kbps} kbps, "
+                    f"loss {self.loss:.1%}, jitter {self.jitter_ms:.1f} ms, {self.signal})")
+        if self._apply:
+            self._apply(kbps)
+
 # Global variables to track streaming state
 pipeline = None
 gst_process = None
+gst_pipeline = None
 
 def shutdown_handler(signum, frame):
     """Handles graceful shutdown of RealSense and GStreamer."""
-    global pipeline, gst_process
+    global pipeline, gst_process, gst_pipeline
 
     logger.info("Stopping RealSense streaming and GStreamer.")
 
@@ -96,6 +735,10 @@ def shutdown_handler(signum, frame):
         gst_process.terminate()
         gst_process.wait()
 
+    # Stop in-process GStreamer pipeline if running
+    if gst_pipeline:
+        gst_pipeline.set_state(Gst.State.NULL)
+
     # Stop RealSense pipeline if running
     if pipeline:
         try:
@@ -106,9 +749,1039 @@ def shutdown_handler(signum, frame):
     logger.info("Streaming stopped cleanly.")
     sys.exit(0)  # Properly exit without raising SystemExit exception
 
-def start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrate):
-    """Uses RealSense SDK and GStreamer Subprocess for stable streaming."""
-    global pipeline, gst_process
+def build_appsrc_pipeline(width, height, framerate, host, port, use_h264, bitrate, fixed_size=True):
+    """Build the in-process D435i PipelineGraph fed through an appsrc named 'frame_src'."""
+    graph = PipelineGraph("d435i")
+    appsrc = graph.add("appsrc", "frame_src", is_live=True, format="time", do_timestamp=False, block=False)
+    if use_h264:
+        # Raw BGR frames go straight to the encoder, skipping the JPEG round trip
+        caps = f"video/x-raw, format=BGR, width={width}, height={height}, framerate={framerate}/1"
+        encoder_factory, encoder_props = h264_encoder_props(bitrate, keyframe_interval(framerate))
+        payloader = graph.chain(
+            appsrc,
+            graph.add("queue", "queue", max_size_buffers=2, leaky="downstream"),
+            graph.add("videoconvert"),
+            graph.add(encoder_factory, "encoder", encoder_props),
+            graph.add("h264parse"),
+            graph.add("rtph264pay", "pay", config_interval=1, pt=96, mtu=rtp_mtu(host)),
+        )
+        add_rtp_sink(graph, payloader, host, port, 96, framerate)
+    else:
+        caps = f"image/jpeg, width={width}, height={height}, framerate={framerate}/1"
+        if not fixed_size:
+            # rtpjpegpay reads dimensions from the JPEG headers, so leave them open for downscaling
+            caps = f"image/jpeg, framerate={framerate}/1"
+        payloader = graph.chain(
+            appsrc,
+            graph.add("queue", "queue", max_size_buffers=5, leaky="downstream"),
+            graph.add("rtpjpegpay", "pay", mtu=rtp_mtu(host)),
+        )
+        add_rtp_sink(graph, payloader, host, port, 26, framerate)
+
+    graph.set_properties(appsrc, {"caps": caps})
+    # Keep at most a couple of frames queued so a stalled sink never grows memory
+    appsrc.set_property("max-bytes", width * height * 3 * 2)
+    logger.info(f"Starting in-process GStreamer pipeline:\n{graph.describe()}")
+    return graph, appsrc
+
+def push_frame(appsrc, data, pts, duration):
+    """Push one encoded (or raw) frame into appsrc with explicit timestamps.
+
+    `data` is bytes or a numpy array (JPEG and raw frames are passed as arrays).
+    It is copied once, straight into the memory of a new GstBuffer: no
+    tobytes(), no pipe write and no jpegparse rescan. PyGObject without the
+    gst-python overrides maps buffers read-only; there the frame is wrapped
+    with new_wrapped(), which costs a tobytes() copy and a second one inside PyGObject.
+    """
+    source = np.frombuffer(data, np.uint8) if isinstance(data, bytes) else \
+        np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+    buffer = Gst.Buffer.new_allocate(None, source.nbytes, None)
+    mapped, info = buffer.map(Gst.MapFlags.WRITE)
+    try:
+        if not mapped:
+            raise ValueError("buffer not mapped")
+        try:
+            np.frombuffer(info.data, np.uint8)[:] = source
+        finally:
+            buffer.unmap(info)
+    except (ValueError, TypeError):
+        buffer = Gst.Buffer.new_wrapped(source.tobytes())
+    buffer.pts = pts
+    buffer.dts = pts
+    buffer.duration = duration
+    return appsrc.emit("push-buffer", buffer)
+
+def check_bus(gst_pipe):
+    """Poll the pipeline bus without blocking; return False on EOS or ERROR."""
+    bus = gst_pipe.get_bus()
+    while True:
+        message = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.EOS | Gst.MessageType.WARNING)
+        if message is None:
+            return True
+        if message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            logger.error(f"{err.message} ({debug})")
+            return False
+        if message.type == Gst.MessageType.EOS:
+            logger.info("End of stream")
+            return False
+        warn, debug = message.parse_warning()
+        logger.warning(f"{warn.message} ({debug})")
+
+class Backoff:
+    """Exponential restart delay plus the bookkeeping for recovery time.
+
+    The delay doubles on every failure up to max_delay and starts over once
+    streaming has run for reset_after seconds without failing.
+    """
+
+    def __init__(self, initial_delay=0.25, max_delay=10.0, reset_after=30.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.restarts = 0
+        self.last_recovery_s = None
+        self.failed_at = None
+        self._delay = initial_delay
+        self._last_failure = 0.0
+
+    def next_delay(self):
+        """Record a failure and return how long to wait before restarting."""
+        now = time.monotonic()
+        if now - self._last_failure > self.reset_after:
+            self._delay = self.initial_delay
+        self._last_failure = now
+        if self.failed_at is None:
+            self.failed_at = now
+        delay = self._delay
+        self._delay = min(self.max_delay, self._delay * 2)
+        self.restarts += 1
+        return delay
+
+    def recovered(self):
+        """Mark streaming as flowing again; return the seconds since the failure, or None."""
+        if self.failed_at is None:
+            return None
+        self.last_recovery_s = time.monotonic() - self.failed_at
+        self.failed_at = None
+        logger.info(f"Streaming recovered in {self.last_recovery_s:.2f} s (restart #{self.restarts}).")
+        return self.last_recovery_s
+
+class PipelineSupervisor:
+    """Restarts a failed in-process pipeline in place with exponential backoff.
+
+    The pipeline and its elements, the plugin registry and the camera handle
+    stay alive; only the pipeline state is cycled through NULL. Recovery time
+    runs from the error to the first buffer leaving `watch_element` again.
+    """
+
+    def __init__(self, gst_pipe, watch_element="pay", backoff=None):
+        self.gst_pipe = gst_pipe
+        self.watch_element = watch_element
+        self.backoff = backoff or Backoff()
+        self._pending = False
+
+    def _restart(self):
+        self.gst_pipe.set_state(Gst.State.NULL)
+        # Errors queued by the failed run must not trigger another restart
+        bus = self.gst_pipe.get_bus()
+        bus.set_flushing(True)
+        bus.set_flushing(False)
+        watch = self.gst_pipe.get_by_name(self.watch_element)
+        if watch:
+            watch.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._first_buffer)
+        return self.gst_pipe.set_state(Gst.State.PLAYING) != Gst.StateChangeReturn.FAILURE
+
+    def _first_buffer(self, pad, info):
+        self.backoff.recovered()
+        return Gst.PadProbeReturn.REMOVE
+
+    def _schedule(self):
+        if self._pending:
+            return
+        self._pending = True
+        delay = self.backoff.next_delay()
+        logger.warning(f"Restarting pipeline in {delay:.2f} s (restart #{self.backoff.restarts}).")
+        GLib.timeout_add(int(delay * 1000), self._restart_from_loop)
+
+    def _restart_from_loop(self):
+        self._pending = False
+        if not self._restart():
+            self._schedule()
+        return GLib.SOURCE_REMOVE
+
+    def on_message(self, bus, message, loop):
+        """Bus callback for GLib main loop pipelines: restart on ERROR, otherwise behave like on_message."""
+        if message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            logger.error(f"{err.message} ({debug})")
+            self._schedule()
+        else:
+            on_message(bus, message, loop)
+
+    def restart_blocking(self):
+        """Restart from a capture thread after check_bus() failed; returns once the pipeline is PLAYING."""
+        while True:
+            delay = self.backoff.next_delay()
+            logger.warning(f"Restarting pipeline in {delay:.2f} s (restart #{self.backoff.restarts}).")
+            time.sleep(delay)
+            if self._restart():
+                return
+
+class FrameRing:
+    """Bounded frame buffer between capture and encoders that drops the oldest frame when full."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped = 0
+        self._frames = collections.deque()
+        self._cond = threading.Condition()
+        self._next_seq = 0
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            if len(self._frames) >= self.capacity:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append(item)
+            self._cond.notify()
+
+    def get(self):
+        """Return (seq, item), or None once closed. Sequence numbers are assigned
+        on dequeue so frames dropped from the ring never leave gaps downstream."""
+        with self._cond:
+            while not self._frames and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            seq = self._next_seq
+            self._next_seq += 1
+            return seq, self._frames.popleft()
+
+    def depth(self):
+        return len(self._frames)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class FrameReorderBuffer:
+    """Collects encoder output by sequence number and releases it in capture order."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._pending = {}
+        self._next_seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, seq, item):
+        with self._cond:
+            # The frame the sender is waiting for is always accepted, so a full buffer cannot deadlock
+            while len(self._pending) >= self.capacity and seq != self._next_seq and not self._closed:
+                self._cond.wait()
+            self._pending[seq] = item
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while self._next_seq not in self._pending and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            item = self._pending.pop(self._next_seq)
+            self._next_seq += 1
+            self._cond.notify_all()
+            return item
+
+    def depth(self):
+        return len(self._pending)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class JpegRateController:
+    """Closed-loop JPEG quality (and optional downscale) control towards a target bitrate.
+
+    Encoded frame sizes are tracked over a sliding window of about one second;
+    a few times per second the average is compared with the per-frame budget
+    and quality is stepped down or up. When quality bottoms out and downscaling
+    is allowed, the frame is shrunk instead, and restored once there is headroom.
+    """
+
+    SCALE_STEPS = (1.0, 0.75, 0.5)
+
+    def __init__(self, target_kbps, framerate, min_quality=30, max_quality=90, initial_quality=75,
+                 allow_downscale=False):
+        self.target_kbps = target_kbps
+        self.framerate = framerate
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.allow_downscale = allow_downscale
+        self.quality = max(min_quality, min(max_quality, initial_quality))
+        self.scale_index = 0
+        self.measured_kbps = 0.0
+        self._target_bits = target_kbps * 1000 / framerate
+        self._window = collections.deque(maxlen=max(1, framerate))
+        self._adjust_every = max(1, framerate // 4)
+        self._since_adjust = 0
+        self._lock = threading.Lock()
+
+    @property
+    def scale(self):
+        return self.SCALE_STEPS[self.scale_index]
+
+    def settings(self):
+        """Return the (quality, scale) to use for the next frame."""
+        with self._lock:
+            return self.quality, self.scale
+
+    def update(self, size_bytes):
+        """Record the size of one encoded frame and adjust the settings if due."""
+        with self._lock:
+            self._window.append(size_bytes * 8)
+            self._since_adjust += 1
+            if self._since_adjust < self._adjust_every:
+                return
+            self._since_adjust = 0
+
+            avg_bits = sum(self._window) / len(self._window)
+            self.measured_kbps = avg_bits * self.framerate / 1000
+            ratio = avg_bits / self._target_bits
+            previous = (self.quality, self.scale_index)
+
+            if ratio > 1.05:
+                step = min(10, max(1, round((ratio - 1) * 20)))
+                if self.quality > self.min_quality:
+                    self.quality = max(self.min_quality, self.quality - step)
+                elif self.allow_downscale and self.scale_index < len(self.SCALE_STEPS) - 1:
+                    self.scale_index += 1
+            elif ratio < 0.85:
+                # Upscaling roughly doubles the bits per frame, so only restore size with ample headroom
+                if self.scale_index > 0 and ratio < 0.5:
+                    self.scale_index -= 1
+                elif self.quality < self.max_quality:
+                    step = min(5, max(1, round((1 - ratio) * 10)))
+                    self.quality = min(self.max_quality, self.quality + step)
+
+            if (self.quality, self.scale_index) != previous:
+                if self.scale_index != previous[1]:
+                    self._window.clear()
+                logger.info(f"JPEG rate control: {self.state()}")
+
+    def set_target(self, target_kbps):
+        """Move the bitrate target (e.g. from congestion control); used from the next adjustment."""
+        with self._lock:
+            self.target_kbps = target_kbps
+            self._target_bits = target_kbps * 1000 / self.framerate
+
+    def state(self):
+        return (f"measured={self.measured_kbps / 1000:.2f} Mbps target={self.target_kbps / 1000:.2f} Mbps "
+                f"quality={self.quality} scale={self.scale}")
+
+class MotionGate:
+    """Lowers framerate and JPEG quality while the scene is static.
+
+    Each frame is subsampled to a small grayscale thumbnail and compared with
+    the thumbnail of the last frame sent; the mean absolute difference (0-255)
+    is the motion score. Above `threshold` every frame is sent at full quality.
+    Below it, frames go out at `idle_fps` with quality lowered by
+    `quality_drop`, and near-identical frames (under `duplicate_threshold`)
+    only once a second. Motion is picked up on the very next frame; the scene
+    must stay still for `hold_s` before the rate drops again.
+    """
+
+    THUMB_WIDTH = 80
+
+    def __init__(self, framerate, threshold=2.0, idle_fps=2, quality_drop=25, duplicate_threshold=0.5, hold_s=0.5):
+        self.framerate = framerate
+        self.threshold = threshold
+        self.idle_interval = 1.0 / max(idle_fps, 0.1)
+        self.quality_drop = quality_drop
+        self.duplicate_threshold = duplicate_threshold
+        self.hold_s = hold_s
+        self.static = False
+        self.score = 0.0
+        self.sent = 0
+        self.skipped = 0
+        self._reference = None
+        self._last_sent = 0.0
+        self._last_motion = 0.0
+
+    def _thumbnail(self, frame):
+        step = max(1, frame.shape[1] // self.THUMB_WIDTH)
+        small = frame[::step, ::step]
+        if small.ndim == 3:
+            small = small.mean(axis=2)
+        return small.astype(np.int16)
+
+    def check(self, frame):
+        """Return (send, static) for a captured frame."""
+        now = time.monotonic()
+        thumb = self._thumbnail(frame)
+        if self._reference is None or self._reference.shape != thumb.shape:
+            self.score = 255.0
+        else:
+            self.score = float(np.abs(thumb - self._reference).mean())
+
+        if self.score >= self.threshold:
+            self._last_motion = now
+        static = now - self._last_motion >= self.hold_s
+        if static != self.static:
+            self.static = static
+            logger.info(f"Motion gate: {'static' if static else 'motion'} (score {self.score:.2f})")
+
+        if static:
+            interval = 1.0 if self.score < self.duplicate_threshold else self.idle_interval
+            if now - self._last_sent < interval:
+                self.skipped += 1
+                return False, True
+
+        self._reference = thumb
+        self._last_sent = now
+        self.sent += 1
+        return True, static
+
+    def state(self):
+        return (f"{'static' if self.static else 'motion'} score={self.score:.2f} "
+                f"sent={self.sent} skipped={self.skipped}")
+
+class RoiMap:
+    """Static region of interest: everything outside the rectangle is low-passed.
+
+    JPEG and the H.264 encoders spend far fewer bits on smooth areas, so
+    blurring the background by downscaling it by `background_scale` and back
+    moves bits to the region of interest at the same quality setting.
+    `rect` is (left, top, right, bottom) as fractions of the frame.
+    """
+
+    def __init__(self, rect=(0.25, 0.25, 0.75, 0.75), background_scale=4):
+        self.rect = rect
+        self.background_scale = background_scale
+
+    def apply(self, frame):
+        height, width = frame.shape[:2]
+        left, top, right, bottom = self.rect
+        x0, x1 = int(left * width), int(right * width)
+        y0, y1 = int(top * height), int(bottom * height)
+        small = cv2.resize(frame, (max(1, width // self.background_scale), max(1, height // self.background_scale)),
+                           interpolation=cv2.INTER_AREA)
+        out = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+        out[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+        return out
+
+def parse_roi(value):
+    """Parse ROI="left,top,right,bottom" (fractions of the frame); empty disables it."""
+    if not value:
+        return None
+    rect = tuple(float(v) for v in value.split(","))
+    if len(rect) != 4 or not (0 <= rect[0] < rect[2] <= 1 and 0 <= rect[1] < rect[3] <= 1):
+        raise ValueError(f"ROI must be left,top,right,bottom fractions, got '{value}'")
+    return rect
+
+def roi_encoder(encode, roi):
+    """Wrap an encode function so frames pass through the ROI map first."""
+    if roi is None:
+        return encode
+    def encode_roi(frame, static=False):
+        return encode(roi.apply(frame), static)
+    return encode_roi
+
+def make_jpeg_encoder(quality=75, rate_controller=None, static_quality_drop=0):
+    """Return an encode function producing the JPEG as a flat uint8 array (or None on failure).
+
+    The array from cv2.imencode() is returned as a flat view; push_frame() copies it
+    into the GstBuffer and the gst-launch pipe writes it through the buffer
+    protocol, so no tobytes() copy is made.
+
+    Frames flagged static by the motion gate are encoded `static_quality_drop`
+    lower and left out of rate control, which assumes the full framerate.
+    """
+    def encode(frame, static=False):
+        jpeg_quality, scale = quality, 1.0
+        if rate_controller:
+            jpeg_quality, scale = rate_controller.settings()
+        if static:
+            jpeg_quality = max(10, jpeg_quality - static_quality_drop)
+        if scale < 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        success, encoded_frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        if not success:
+            return None
+        if rate_controller and not static:
+            rate_controller.update(encoded_frame.size)
+        return encoded_frame.reshape(-1)
+    return encode
+
+def encode_raw(frame, static=False):
+    """Pass raw BGR frames through for pipelines that encode in GStreamer; push_frame() copies them."""
+    return frame
+
+class CaptureEngine:
+    """Pipelined D435i capture: capture thread -> drop-oldest ring -> N encoder
+    threads -> in-order reassembly -> send() on the calling thread.
+
+    cv2.imencode releases the GIL, so encoder threads run in parallel and a slow
+    encode no longer stalls wait_for_frames().
+    """
+
+    def __init__(self, rs_pipeline, encode, send, workers=2, queue_size=4, stats_interval=5.0, epoch_ns=None,
+                 motion_gate=None):
+        self.rs_pipeline = rs_pipeline
+        self.epoch_ns = epoch_ns
+        self.motion_gate = motion_gate
+        self.encode = encode
+        self.send = send
+        self.workers = workers
+        self.stats_interval = stats_interval
+        self.ring = FrameRing(queue_size)
+        self.reorder = FrameReorderBuffer(queue_size + workers)
+        self.captured = 0
+        self.encoded = 0
+        self.encode_failed = 0
+        self.sent = 0
+        self._running = False
+        self._threads = []
+
+    def _capture_loop(self):
+        start_ns = self.epoch_ns
+        while self._running:
+            try:
+                frames = self.rs_pipeline.wait_for_frames()
+            except RuntimeError as e:
+                logger.warning(f"RealSense wait_for_frames failed: {e}")
+                continue
+            color_frame = frames.get_color_frame()
+            if not color_frame:
+                continue
+
+            now_ns = time.monotonic_ns()
+            if start_ns is None:
+                start_ns = now_ns
+            self.captured += 1
+            stream_metrics.frames_captured += 1
+
+            static = False
+            if self.motion_gate:
+                send, static = self.motion_gate.check(np.asanyarray(color_frame.get_data()))
+                if not send:
+                    continue
+
+            # Copy out of the librealsense frame pool so queued frames never starve the SDK. With raw H.264
+            # frames this and push_frame()'s copy into the GstBuffer are the only two.
+            frame = np.array(color_frame.get_data(), copy=True)
+            self.ring.put((now_ns - start_ns, frame, static))
+
+    def _encode_loop(self):
+        while self._running:
+            entry = self.ring.get()
+            if entry is None:
+                return
+            seq, (pts, frame, static) = entry
+            data = self.encode(frame, static)
+            if data is None:
+                self.encode_failed += 1
+            else:
+                self.encoded += 1
+            self.reorder.put(seq, (pts, data))
+
+    def log_stats(self):
+        logger.info(
+            f"Capture engine: captured={self.captured} ring={self.ring.depth()}/{self.ring.capacity} "
+            f"ring_drops={self.ring.dropped} reorder={self.reorder.depth()} encoded={self.encoded} "
+            f"encode_failed={self.encode_failed} sent={self.sent}"
+            + (f" | motion gate: {self.motion_gate.state()}" if self.motion_gate else "")
+        )
+
+    def run(self):
+        """Start capture and encoder threads and send frames until send() returns False."""
+        self._running = True
+        self._threads = [threading.Thread(target=self._capture_loop, name="capture", daemon=True)]
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._encode_loop, name=f"encoder-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+        logger.info(f"Capture engine started with {self.workers} encoder threads, ring size {self.ring.capacity}.")
+        last_stats = time.perf_counter()
+        try:
+            while self._running:
+                item = self.reorder.get()
+                if item is None:
+                    break
+                pts, data = item
+                if data is not None:
+                    if not self.send(pts, data):
+                        break
+                    self.sent += 1
+
+                now = time.perf_counter()
+                if now - last_stats >= self.stats_interval:
+                    self.log_stats()
+                    last_stats = now
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._running = False
+        self.ring.close()
+        self.reorder.close()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=1.0)
+        self._threads = []
+
+# Latency side channel: per-frame timing and clock-offset ping/pong (big-endian)
+LATENCY_TIMING = struct.Struct("!4sIIQ")  # b"TIME", frame seq, RTP timestamp, capture time (ns, wall clock)
+LATENCY_PING = struct.Struct("!4sQ")      # b"PING", t0 (receiver clock)
+LATENCY_PONG = struct.Struct("!4sQQQ")    # b"PONG", t0, t1 (streamer receive), t2 (streamer send)
+
+class LatencyTagger:
+    """Sends the capture timestamp of every frame to the receiver for glass-to-glass latency.
+
+    A probe on the RTP payloader src pad reads the RTP timestamp of each packet
+    (read-only, 12 header bytes), or of the first packet of a buffer list,
+    which is how the payloaders push a fragmented frame. On the first packet of each frame it sends a
+    timing message with a sequence number, that RTP timestamp and the frame's
+    capture time to the receiver's latency port. The same socket answers the
+    receiver's PING messages so it can estimate the clock offset between hosts.
+    """
+
+    def __init__(self, host, port, capture_time_fn):
+        self.address = (host, port)
+        self.capture_time_fn = capture_time_fn
+        self.seq = 0
+        self._last_rtp_ts = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("0.0.0.0", 0))
+        self._thread = threading.Thread(target=self._serve_pings, name="latency-pong", daemon=True)
+        self._thread.start()
+
+    def attach(self, payloader):
+        payloader.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                                                  self._probe)
+        logger.info(f"Latency mode: sending capture timestamps to {self.address[0]}:{self.address[1]}")
+
+    def _probe(self, pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffers = info.get_buffer_list()
+            buffer = buffers.get(0) if buffers and buffers.length() else None
+        else:
+            buffer = info.get_buffer()
+        if not buffer or buffer.get_size() < 12:
+            return Gst.PadProbeReturn.OK
+        rtp_ts = struct.unpack_from("!I", buffer.extract_dup(4, 4))[0]
+        if rtp_ts == self._last_rtp_ts:
+            return Gst.PadProbeReturn.OK
+        self._last_rtp_ts = rtp_ts
+
+        capture_ns = self.capture_time_fn(buffer)
+        if capture_ns is not None:
+            try:
+                self._sock.sendto(LATENCY_TIMING.pack(b"TIME", self.seq & 0xFFFFFFFF, rtp_ts, capture_ns), self.address)
+            except OSError:
+                pass
+            self.seq += 1
+        return Gst.PadProbeReturn.OK
+
+    def _serve_pings(self):
+        while True:
+            try:
+                data, address = self._sock.recvfrom(64)
+            except OSError:
+                return
+            t1 = time.time_ns()
+            if len(data) == LATENCY_PING.size and data[:4] == b"PING":
+                _, t0 = LATENCY_PING.unpack(data)
+                self._sock.sendto(LATENCY_PONG.pack(b"PONG", t0, t1, time.time_ns()), address)
+
+def running_time_capture_fn(gst_pipe):
+    """Map a buffer PTS (pipeline running time) to a wall-clock capture time."""
+    def capture_time(buffer):
+        clock = gst_pipe.get_clock()
+        if clock is None or buffer.pts == Gst.CLOCK_TIME_NONE:
+            return None
+        age_ns = clock.get_time() - (gst_pipe.get_base_time() + buffer.pts)
+        return time.time_ns() - age_ns
+    return capture_time
+
+# Prometheus encode-time histogram bounds in seconds
+ENCODE_BUCKETS = (0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.1, 0.25)
+
+class PrometheusHistogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions under a lock."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+class StreamerMetrics:
+    """Process-wide counters behind the Prometheus endpoint.
+
+    Capture, encode and send paths only add to integers here. The running
+    pipeline, capture engine, motion gate and restart backoff are registered
+    so a scrape can read their depths and state. Rendering never waits on a
+    capture thread. Per-destination stats come from Destinations' cache,
+    because multiudpsink's get-stats shares a lock with its streaming thread.
+    The GStreamer queue depth is the one read that briefly takes such a lock.
+    """
+
+    def __init__(self):
+        self.frames_captured = 0
+        self.encode_failures = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.send_failures = 0
+        self.encode_seconds = PrometheusHistogram(ENCODE_BUCKETS)
+        self.keyframe_requests = collections.Counter()
+        self.keyframes_forced = 0
+        self.congestion = None
+        self.pacer = None
+        self.destinations = None
+        self.gst_pipe = None
+        self.engine = None
+        self.motion_gate = None
+        self.backoff = None
+
+    def count_payloader_input(self, gst_pipe, payloader="pay"):
+        """Count frames and bytes entering the RTP payloader of an in-process pipeline."""
+        self.gst_pipe = gst_pipe
+        gst_pipe.get_by_name(payloader).get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._sent_probe)
+
+    def _sent_probe(self, pad, info):
+        self.frames_sent += 1
+        self.bytes_sent += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def count_source_output(self, element):
+        """Count frames leaving a GStreamer capture source."""
+        element.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._captured_probe)
+
+    def _captured_probe(self, pad, info):
+        self.frames_captured += 1
+        return Gst.PadProbeReturn.OK
+
+    def time_encoder(self, encoder, max_pending=64):
+        """Time a GStreamer encoder from sink to src pad, matching buffers by PTS."""
+        pending = collections.OrderedDict()
+
+        def sink_probe(pad, info):
+            pending[info.get_buffer().pts] = time.perf_counter()
+            if len(pending) > max_pending:
+                pending.popitem(last=False)
+            return Gst.PadProbeReturn.OK
+
+        def src_probe(pad, info):
+            start = pending.pop(info.get_buffer().pts, None)
+            if start is not None:
+                self.encode_seconds.observe(time.perf_counter() - start)
+            return Gst.PadProbeReturn.OK
+
+        encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, sink_probe)
+        encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, src_probe)
+
+    def timed_encoder(self, encode):
+        """Wrap an encode function so its duration and failures are recorded."""
+        def encode_timed(frame, static=False):
+            start = time.perf_counter()
+            data = encode(frame, static)
+            if data is None:
+                self.encode_failures += 1
+            else:
+                self.encode_seconds.observe(time.perf_counter() - start)
+            return data
+        return encode_timed
+
+    def _pipeline_playing(self):
+        if self.gst_pipe:
+            _, state, _ = self.gst_pipe.get_state(0)
+            return int(state == Gst.State.PLAYING)
+        return int(gst_process is not None and gst_process.poll() is None)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        def histogram(name, help_text, observed):
+            counts, total = observed.snapshot()
+            running = 0
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(observed.bounds + ("+Inf",), counts):
+                running += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {running}')
+            lines.append(f"{name}_sum {total}")
+            lines.append(f"{name}_count {running}")
+            return running
+
+        dropped = [('{reason="encode_failed"}', self.encode_failures), ('{reason="send_failed"}', self.send_failures)]
+        depths = []
+        if self.engine:
+            dropped.append(('{reason="ring"}', self.engine.ring.dropped))
+            depths += [('{queue="ring"}', self.engine.ring.depth()), ('{queue="reorder"}', self.engine.reorder.depth())]
+        if self.motion_gate:
+            dropped.append(('{reason="motion_gate"}', self.motion_gate.skipped))
+        if self.congestion and self.congestion.actuator == "framerate":
+            dropped.append(('{reason="congestion"}', self.congestion.frames_dropped))
+        if self.pacer:
+            dropped.append(('{reason="pacing"}', self.pacer.frames_dropped))
+        queue = self.gst_pipe.get_by_name("queue") if self.gst_pipe else None
+        if queue:
+            depths.append(('{queue="gst_queue"}', queue.get_property("current-level-buffers")))
+
+        family("streamer_frames_captured_total", "counter", "Frames read from the camera.",
+               [("", self.frames_captured)])
+        family("streamer_frames_encoded_total", "counter", "Frames encoded.",
+               [("", sum(self.encode_seconds.snapshot()[0]))])
+        family("streamer_frames_sent_total", "counter", "Frames handed to the RTP payloader.",
+               [("", self.frames_sent)])
+        family("streamer_bytes_sent_total", "counter", "Encoded bytes handed to the RTP payloader.",
+               [("", self.bytes_sent)])
+        family("streamer_frames_dropped_total", "counter", "Frames dropped before sending, by reason.", dropped)
+        histogram("streamer_encode_seconds", "Time to encode one frame.", self.encode_seconds)
+        if self.pacer:
+            histogram("streamer_frame_send_seconds", "Time from a frame's first to its last RTP packet.",
+                      self.pacer.send_seconds)
+            family("streamer_pacing_rate_bps", "gauge", "Rate RTP packets are paced at.",
+                   [("", round(self.pacer.current_rate() * 8))])
+        if self.destinations:
+            sent = self.destinations.last_stats
+            family("streamer_destination_packets_sent_total", "counter", "RTP packets sent to each receiver.",
+                   [(f'{{destination="{d["destination"]}"}}', d["packets_sent"]) for d in sent])
+            family("streamer_destination_bytes_sent_total", "counter", "RTP bytes sent to each receiver.",
+                   [(f'{{destination="{d["destination"]}"}}', d["bytes_sent"]) for d in sent])
+        sndbuf_errors = udp_send_buffer_errors()
+        if sndbuf_errors is not None:
+            family("streamer_udp_sndbuf_errors_total", "counter",
+                   "UDP datagrams dropped for a full socket send buffer (whole network namespace).",
+                   [("", sndbuf_errors)])
+        if depths:
+            family("streamer_queue_depth", "gauge", "Frames waiting in each queue.", depths)
+        congestion = self.congestion
+        if congestion and congestion.target_kbps is not None:
+            family("streamer_target_bitrate_bps", "gauge", "Send rate set by congestion control.",
+                   [("", congestion.target_kbps * 1000)])
+        if congestion and congestion.receiver_estimate_kbps is not None:
+            family("streamer_receiver_estimate_bps", "gauge", "Receiver's delay-based bandwidth estimate.",
+                   [("", congestion.receiver_estimate_kbps * 1000)])
+            family("streamer_feedback_loss_ratio", "gauge", "Packet loss in the last receiver report.",
+                   [("", congestion.loss)])
+            family("streamer_congestion_reports_total", "counter", "Congestion reports from the receiver.",
+                   [("", congestion.reports)])
+        if self.keyframe_requests:
+            family("streamer_keyframe_requests_total", "counter", "RTCP keyframe requests from the receiver.",
+                   [(f'{{kind="{kind}"}}', count) for kind, count in self.keyframe_requests.items()])
+        if self.keyframes_forced:
+            family("streamer_keyframes_forced_total", "counter", "Keyframes forced on request.",
+                   [("", self.keyframes_forced)])
+        family("streamer_pipeline_playing", "gauge", "1 while the GStreamer pipeline is running.",
+               [("", self._pipeline_playing())])
+        if self.backoff:
+            family("streamer_restarts_total", "counter", "In-process pipeline restarts.",
+                   [("", self.backoff.restarts)])
+            if self.backoff.last_recovery_s is not None:
+                family("streamer_last_recovery_seconds", "gauge", "Duration of the last recovery.",
+                       [("", self.backoff.last_recovery_s)])
+        return "\n".join(lines) + "\n"
+
+stream_metrics = StreamerMetrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = stream_metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host, port):
+    """Serve Prometheus metrics in a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Prometheus metrics on http://{host}:{port}/metrics")
+    return server
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """Local HTTP control API for the receivers the stream is sent to.
+
+    GET    /destinations                list receivers with packets and bytes sent
+    POST   /destinations                {"host": h, "port": p} starts sending to a receiver
+    DELETE /destinations/<host>:<port>  stops sending to it
+    There is no authentication, so it listens on CONTROL_HOST (default 127.0.0.1) only.
+    """
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if not parts or parts[0] != "destinations":
+            return self._reply(404, {"error": "not found"})
+        destinations = stream_metrics.destinations
+        if destinations is None:
+            return self._reply(409, {"error": "destinations are fixed in the gst-launch pipeline; "
+                                              "use DEVICE or USE_APPSRC=true to change them at runtime"})
+        try:
+            if parts == ["destinations"] and method == "POST":
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                destinations.add(str(body["host"]), int(body["port"]))
+                return self._reply(201, destinations.stats())
+            if len(parts) == 2 and method == "DELETE":
+                destinations.remove(*parse_destination(parts[1]))
+                return self._reply(200, destinations.stats())
+            if parts == ["destinations"] and method == "GET":
+                return self._reply(200, destinations.stats())
+            self._reply(404, {"error": "not found"})
+        except KeyError as e:
+            self._reply(404, {"error": f"unknown destination or missing field {e}"})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+def start_control_server(host, port):
+    """Serve the destination control API in a background thread."""
+    server = ThreadingHTTPServer((host, port), ControlHandler)
+    threading.Thread(target=server.serve_forever, name="control-api", daemon=True).start()
+    logger.info(f"Control API listening on http://{host}:{port}")
+    return server
+
+def stream_d435i_appsrc(width, height, framerate, host, port, use_h264, bitrate, jpeg_encode,
+                        encoder_threads=0, frame_queue_size=4, fixed_size=True, latency_port=None,
+                        motion_gate=None, roi=None, congestion=None):
+    """Push RealSense frames into an in-process GStreamer pipeline via appsrc."""
+    global pipeline, gst_pipeline
+
+    Gst.init(None)
+    graph, appsrc = build_appsrc_pipeline(width, height, framerate, host, port, use_h264, bitrate, fixed_size)
+    gst_pipeline = graph.pipeline
+    encode = roi_encoder(encode_raw if use_h264 else stream_metrics.timed_encoder(jpeg_encode), roi)
+    stream_metrics.count_payloader_input(gst_pipeline)
+    if use_h264:
+        stream_metrics.time_encoder(gst_pipeline.get_by_name("encoder"))
+        listen_for_keyframe_requests(gst_pipeline, port)
+    stream_metrics.pacer = attach_pacer(gst_pipeline, framerate)
+    stream_metrics.destinations = Destinations(gst_pipeline)
+    if congestion and use_h264:
+        congestion.control_encoder(gst_pipeline.get_by_name("encoder"))
+    elif congestion and not congestion.actuator:
+        congestion.gate_frames(gst_pipeline.get_by_name("pay"))
+
+    # PTS are monotonic-clock offsets from epoch_ns, so capture time is wall_epoch_ns + PTS
+    epoch_ns = time.monotonic_ns()
+    wall_epoch_ns = time.time_ns()
+    if latency_port:
+        LatencyTagger(host, latency_port, lambda buffer: wall_epoch_ns + buffer.pts).attach(
+            gst_pipeline.get_by_name("pay"))
+
+    gst_pipeline.set_state(Gst.State.PLAYING)
+    supervisor = PipelineSupervisor(gst_pipeline)
+    stream_metrics.backoff = supervisor.backoff
+    stream_metrics.motion_gate = motion_gate
+
+    frame_duration = Gst.SECOND // framerate
+
+    # Raw H.264 frames need no encoding in Python, so only JPEG uses the encoder threads
+    if encoder_threads > 0 and not use_h264:
+        def send(pts, data):
+            if not check_bus(gst_pipeline):
+                # Frames captured meanwhile are dropped by the ring; the camera keeps running
+                supervisor.restart_blocking()
+            ret = push_frame(appsrc, data, pts, frame_duration)
+            if ret not in (Gst.FlowReturn.OK, Gst.FlowReturn.FLUSHING):
+                logger.error(f"appsrc push-buffer failed: {ret.value_name}.")
+                stream_metrics.send_failures += 1
+                supervisor.restart_blocking()
+            return True
+
+        stream_metrics.engine = CaptureEngine(pipeline, encode, send, encoder_threads, frame_queue_size,
+                                              epoch_ns=epoch_ns, motion_gate=motion_gate)
+        stream_metrics.engine.run()
+        return
+
+
+    while True:
+        if not check_bus(gst_pipeline):
+            supervisor.restart_blocking()
+        frames = pipeline.wait_for_frames()
+        color_frame = frames.get_color_frame()
+        if not color_frame:
+            continue
+        stream_metrics.frames_captured += 1
+
+        # PTS follows the capture clock, so gaps from dropped frames stay visible downstream
+        pts = time.monotonic_ns() - epoch_ns
+
+        frame = np.asanyarray(color_frame.get_data())
+        static = False
+        if motion_gate:
+            send_frame, static = motion_gate.check(frame)
+            if not send_frame:
+                continue
+
+        data = encode(frame, static)
+        if data is None:
+            continue
+
+        ret = push_frame(appsrc, data, pts, frame_duration)
+        if ret not in (Gst.FlowReturn.OK, Gst.FlowReturn.FLUSHING):
+            logger.error(f"appsrc push-buffer failed: {ret.value_name}.")
+            stream_metrics.send_failures += 1
+            supervisor.restart_blocking()
+
+def start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrate, use_appsrc=False,
+                          encoder_threads=0, frame_queue_size=4, rate_controller=None, latency_port=None,
+                          motion_gate=None, roi=None, congestion=None):
+    """Uses RealSense SDK and GStreamer (subprocess or in-process appsrc) for stable streaming."""
+    global pipeline, gst_process, gst_pipeline
 
     logger.info("Starting D435i streaming with RealSense SDK.")
 
@@ -124,30 +1797,76 @@ def start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrat
     logger.info(f"Serial number: {device.get_info(rs.camera_info.serial_number)}")
     logger.info(f"Firmware version: {device.get_info(rs.camera_info.firmware_version)}")
 
+    jpeg_encode = make_jpeg_encoder(rate_controller=rate_controller,
+                                    static_quality_drop=motion_gate.quality_drop if motion_gate else 0)
+    downscale = rate_controller is not None and rate_controller.allow_downscale
+    if congestion and rate_controller:
+        congestion.control_jpeg(rate_controller)
+
+    if use_appsrc:
+        signal.signal(signal.SIGINT, shutdown_handler)
+        try:
+            stream_d435i_appsrc(width, height, framerate, host, port, use_h264, bitrate, jpeg_encode,
+                                encoder_threads, frame_queue_size, not downscale, latency_port, motion_gate, roi,
+                                congestion)
+        except KeyboardInterrupt:
+            shutdown_handler(None, None)
+        finally:
+            if gst_pipeline:
+                gst_pipeline.set_state(Gst.State.NULL)
+
+            if pipeline:
+                try:
+                    pipeline.stop()
+                except RuntimeError as e:
+                    logger.warning(f"RealSense pipeline already stopped: {e}")
+
+            logger.info("Pipeline shut down successfully.")
+        return
+
+    if latency_port:
+        logger.warning("Latency mode needs the in-process pipeline (USE_APPSRC=true); timestamps are not sent.")
+
     # Choose encoding method
     if use_h264:
-        logger.info("Using H.264 encoding (x264enc)")
-        gst_command = (
-            f"gst-launch-1.0 -v fdsrc ! image/jpeg, width={width}, height={height}, framerate={framerate}/1 ! "
-            "jpegparse ! jpegdec ! video/x-raw,format=I420 ! queue ! "
-            f"x264enc bframes=0 tune=zerolatency byte-stream=true bitrate={bitrate} speed-preset=ultrafast key-int-max=10 ! "
-            "h264parse ! rtph264pay config-interval=1 pt=96 ! "
-            f"udpsink host={host} port={port} sync=false"
+        # Only rtpbin (rtx) answers keyframe requests in gst-launch; otherwise keep the short GOP
+        on_request = os.getenv("RTP_PROTECTION", "none").lower() == "rtx"
+        encoder_desc = h264_encoder_desc(bitrate, keyframe_interval(framerate, on_request))
+        logger.info(f"Using H.264 encoding ({encoder_desc.split()[0]})")
+        if not on_request:
+            logger.warning("Keyframe requests from the receiver need USE_APPSRC=true or RTP_PROTECTION=rtx; "
+                           f"keyframes come every {SHORT_KEY_INT} frames instead of every KEY_INT_S seconds.")
+        pipeline_desc = (
+            f"fdsrc ! image/jpeg, width={width}, height={height}, framerate={framerate}/1 ! "
+            "jpegparse ! jpegdec ! queue ! videoconvert ! "
+            f"{encoder_desc} ! "
+            f"h264parse ! rtph264pay config-interval=1 pt=96 mtu={rtp_mtu(host)} ! "
+            f"{rtp_sink_desc(host, port, 96)}"
         )
     else:
         logger.info("Using MJPEG encoding (default)")
-        gst_command = (
-            f"gst-launch-1.0 -v fdsrc ! image/jpeg, width={width}, height={height}, framerate={framerate}/1 ! "
-            f"jpegparse ! queue max-size-buffers=5 max-size-bytes=500000 max-size-time=2000000000 ! rtpjpegpay ! "
-            f"udpsink host={host} port={port} sync=false"
+        jpeg_caps = f"image/jpeg, framerate={framerate}/1" if downscale else f"image/jpeg, width={width}, height={height}, framerate={framerate}/1"
+        pipeline_desc = (
+            f"fdsrc ! {jpeg_caps} ! "
+            f"jpegparse ! queue max-size-buffers=5 max-size-bytes=500000 max-size-time=2000000000 ! rtpjpegpay mtu={rtp_mtu(host)} ! "
+            f"{rtp_sink_desc(host, port, 26)}"
         )
 
-    logger.info(f"Starting GStreamer pipeline:\n{gst_command}")
+    if os.getenv("PACING", "False").lower() == "true":
+        logger.warning("Packet pacing needs the in-process pipeline (USE_APPSRC=true); sending at line rate.")
+
+    # gst-launch joins its arguments back into one description; no shell is involved
+    gst_command = ["gst-launch-1.0", "-v", *shlex.split(pipeline_desc)]
+    logger.info(f"Starting GStreamer pipeline:\n{pipeline_desc}")
+
+    def spawn_gst():
+        global gst_process
+        # Start GStreamer as a subprocess (binary mode, capture stderr)
+        gst_process = subprocess.Popen(
+            gst_command, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE
+        )
 
-    # Start GStreamer as a subprocess (binary mode, capture stderr)
-    gst_process = subprocess.Popen(
-        gst_command, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE
-    )
+    spawn_gst()
 
     # Allow GStreamer to initialize fully
     time.sleep(1)
@@ -155,28 +1874,65 @@ def start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrat
     # Register SIGINT handler
     signal.signal(signal.SIGINT, shutdown_handler)
 
-    try:
-        while True:
-            frames = pipeline.wait_for_frames()
-            color_frame = frames.get_color_frame()
-            if not color_frame:
-                continue
+    backoff = Backoff()
+    stream_metrics.backoff = backoff
+    stream_metrics.motion_gate = motion_gate
+    if congestion and use_h264:
+        logger.warning("Congestion control cannot change the gst-launch encoder's bitrate; use --use-appsrc.")
+    elif congestion and not congestion.actuator:
+        congestion.gate_frames()
 
-            # Convert to numpy array
-            frame = np.asanyarray(color_frame.get_data())
+    def send(pts, data):
+        if congestion and not congestion.admit(len(data)):
+            return True
+        try:
+            gst_process.stdin.write(data)
+            gst_process.stdin.flush()
+            stream_metrics.frames_sent += 1
+            stream_metrics.bytes_sent += len(data)
+            if backoff.failed_at is not None:
+                backoff.recovered()
+            return True
+        except BrokenPipeError:
+            stream_metrics.send_failures += 1
+            # Only gst-launch is restarted; the RealSense pipeline keeps streaming
+            delay = backoff.next_delay()
+            logger.error(f"GStreamer pipeline broke (Broken pipe). Restarting it in {delay:.2f} s "
+                         f"(restart #{backoff.restarts}).")
+            gst_process.wait()
+            time.sleep(delay)
+            spawn_gst()
+            return True
 
-            # Encode as JPEG
-            success, encoded_frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 75])
-            if not success:
-                continue
+    jpeg_encode = roi_encoder(stream_metrics.timed_encoder(jpeg_encode), roi)
 
-            # Write to GStreamer's stdin in BINARY mode
-            try:
-                gst_process.stdin.write(encoded_frame.tobytes())  # Ensure binary write
-                gst_process.stdin.flush()
-            except BrokenPipeError:
-                logger.error("GStreamer pipeline broke (Broken pipe). Exiting.")
-                break
+    try:
+        if encoder_threads > 0:
+            stream_metrics.engine = CaptureEngine(pipeline, jpeg_encode, send, encoder_threads, frame_queue_size,
+                                                  motion_gate=motion_gate)
+            stream_metrics.engine.run()
+        else:
+            while True:
+                frames = pipeline.wait_for_frames()
+                color_frame = frames.get_color_frame()
+                if not color_frame:
+                    continue
+                stream_metrics.frames_captured += 1
+
+                # Convert to numpy array and encode as JPEG
+                frame = np.asanyarray(color_frame.get_data())
+                static = False
+                if motion_gate:
+                    send_frame, static = motion_gate.check(frame)
+                    if not send_frame:
+                        continue
+                data = jpeg_encode(frame, static)
+                if data is None:
+                    continue
+
+                # Write to GStreamer's stdin in BINARY mode
+                if not send(None, data):
+                    break
 
     except KeyboardInterrupt:
         shutdown_handler(None, None)
@@ -195,40 +1951,152 @@ def start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrat
 
         logger.info("Pipeline shut down successfully.")
 
-def start_streaming(device, width, height, framerate, host, port, use_h264, bitrate):
+def set_min_pool_buffers(element, min_buffers):
+    """Make the buffer pool negotiated on element's src pad hold at least min_buffers.
+
+    v4l2src sizes its capture queue from the downstream ALLOCATION answer; the
+    probe raises the minimum in that answer before v4l2src reads it.
+    """
+    def probe(pad, info):
+        query = info.get_query()
+        if query.type != Gst.QueryType.ALLOCATION:
+            return Gst.PadProbeReturn.OK
+        if query.get_n_allocation_pools() == 0:
+            query.add_allocation_pool(None, 0, min_buffers, 0)
+        for i in range(query.get_n_allocation_pools()):
+            pool, size, min_count, max_count = query.parse_nth_allocation_pool(i)
+            if max_count:
+                max_count = max(max_count, min_buffers)
+            query.set_nth_allocation_pool(i, pool, size, max(min_count, min_buffers), max_count)
+        return Gst.PadProbeReturn.OK
+
+    element.get_static_pad("src").add_probe(Gst.PadProbeType.QUERY_DOWNSTREAM | Gst.PadProbeType.PULL, probe)
+
+def memory_type(buffer):
+    """Allocator type of a buffer's first memory, e.g. SystemMemory, dmabuf or V4l2Memory."""
+    if buffer.n_memory() == 0:
+        return None
+    allocator = buffer.peek_memory(0).allocator
+    return allocator.mem_type if allocator else None
+
+class CopyCounter:
+    """Counts, per pipeline stage, buffers that were copied instead of passed through.
+
+    A stage copies when it is a GstBaseTransform that is not in passthrough
+    (videoconvert/videoscale touching every pixel) or when its output memory
+    type differs from its input, e.g. dmabuf downloaded into system memory.
+    Decoders and encoders always produce new buffers and are not counted.
+    """
+
+    def __init__(self, gst_pipe, stages):
+        self.stages = {}
+        for name in stages:
+            element = gst_pipe.get_by_name(name)
+            if element is None:
+                continue
+            stats = {"buffers": 0, "copies": 0, "in": None, "out": None}
+            self.stages[name] = stats
+            if element.get_static_pad("sink"):
+                element.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._sink_probe, stats)
+            element.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self._src_probe, element, stats)
+
+    def _sink_probe(self, pad, info, stats):
+        stats["in"] = memory_type(info.get_buffer())
+        return Gst.PadProbeReturn.OK
+
+    def _src_probe(self, pad, info, element, stats):
+        stats["out"] = memory_type(info.get_buffer())
+        stats["buffers"] += 1
+        transform_copy = isinstance(element, GstBase.BaseTransform) and not element.is_passthrough()
+        if transform_copy or (stats["in"] is not None and stats["in"] != stats["out"]):
+            stats["copies"] += 1
+        return Gst.PadProbeReturn.OK
+
+    def log_stats(self):
+        parts = [f"{name} {stats['copies']}/{stats['buffers']} ({stats['in'] or '-'} -> {stats['out']})"
+                 for name, stats in self.stages.items()]
+        logger.info(f"Copies per stage: {', '.join(parts)}")
+        return GLib.SOURCE_CONTINUE
+
+def start_streaming(device, width, height, framerate, host, port, use_h264, bitrate, latency_port=None,
+                    io_mode="auto", pool_buffers=0, congestion=None):
     """Start streaming video over UDP."""
     Gst.init(None)
+    # Hardware decoder and encoder exchange frames in device memory; a videoconvert between them
+    # would force a download, so it is left out and they negotiate a common format directly.
+    decoder = select_jpeg_decoder() if use_h264 else "jpegdec"
+    decoder_props = {}
+    encoder_factory, encoder_props = h264_encoder_props(bitrate, keyframe_interval(framerate)) if use_h264 \
+        else ("", {})
+    hardware_chain = decoder.startswith(HARDWARE_PREFIXES) and encoder_factory.startswith(HARDWARE_PREFIXES)
+    zero_copy = io_mode.startswith("dmabuf")
+    if zero_copy and decoder == "v4l2jpegdec":
+        decoder_props.update({"output-io-mode": "dmabuf-import", "capture-io-mode": "dmabuf"})
+    if zero_copy and encoder_factory == "v4l2h264enc" and decoder.startswith("v4l2"):
+        encoder_props["output-io-mode"] = "dmabuf-import"
+
+    graph = PipelineGraph("streamer")
+    if device == "videotestsrc":
+        # Synthetic live source for benchmarks and CI; TEST_PATTERN selects the videotestsrc pattern
+        source = graph.add("videotestsrc", "src", is_live=True, pattern=os.getenv("TEST_PATTERN", "ball"))
+        raw = graph.chain(source, graph.capsfilter(f"video/x-raw, width={width}, height={height}, "
+                                                   f"framerate={framerate}/1"))
+        head = raw if use_h264 else graph.chain(raw, graph.add("jpegenc"))
+    else:
+        source = graph.add("v4l2src", "src", device=device, io_mode=io_mode)
+        head = graph.chain(source, graph.capsfilter(f"image/jpeg, width={width}, height={height}, "
+                                                    f"framerate={framerate}/1"))
+        if use_h264:
+            head = graph.chain(head, graph.add(decoder, "decoder", decoder_props))
+
     if use_h264:
-        pipeline_desc = (
-            f"v4l2src device={device} ! "
-            f"image/jpeg, width={width}, height={height}, framerate={framerate}/1 ! "
-            "jpegdec ! "
-            "queue ! "
-            f"x264enc bframes=0 tune=zerolatency bitrate={bitrate} speed-preset=ultrafast key-int-max=10 ! "
-            "h264parse ! "
-            "rtph264pay config-interval=1 pt=96 ! "
-            f"udpsink host={host} port={port} sync=false"
+        elements = [head, graph.add("queue", "queue")]
+        if not (hardware_chain and device != "videotestsrc"):
+            elements.append(graph.add("videoconvert", "convert"))
+        payloader = graph.chain(
+            *elements,
+            graph.add(encoder_factory, "encoder", encoder_props),
+            graph.add("h264parse"),
+            graph.add("rtph264pay", "pay", config_interval=1, pt=96, mtu=rtp_mtu(host)),
         )
-        
+        add_rtp_sink(graph, payloader, host, port, 96, framerate)
     else:
-        pipeline_desc = (
-            f"v4l2src device={device} ! "
-            f"image/jpeg, width={width}, height={height}, framerate={framerate}/1 ! "
-            "queue ! "
-            "rtpjpegpay ! "
-            f"udpsink host={host} port={port} sync=false"
-        )
-
+        payloader = graph.chain(head, graph.add("queue", "queue"), graph.add("rtpjpegpay", "pay", mtu=rtp_mtu(host)))
+        add_rtp_sink(graph, payloader, host, port, 26, framerate)
 
     logger.info("Pipeline description:")
-    print(pipeline_desc)
-    pipeline = Gst.parse_launch(pipeline_desc)
+    print(graph.describe())
+    pipeline = graph.pipeline
 
-    # Set up bus to handle messages
+    if latency_port:
+        LatencyTagger(host, latency_port, running_time_capture_fn(pipeline)).attach(pipeline.get_by_name("pay"))
+
+    source = pipeline.get_by_name("src")
+    if pool_buffers > 0 and device != "videotestsrc":
+        set_min_pool_buffers(source, pool_buffers)
+    copy_counter = CopyCounter(pipeline, ["src", "queue", "convert"])
+    stream_metrics.count_source_output(source)
+    stream_metrics.count_payloader_input(pipeline)
+    if use_h264:
+        stream_metrics.time_encoder(pipeline.get_by_name("encoder"))
+        listen_for_keyframe_requests(pipeline, port)
+    stream_metrics.pacer = attach_pacer(pipeline, framerate)
+    stream_metrics.destinations = Destinations(pipeline)
+    if congestion:
+        if use_h264:
+            congestion.control_encoder(pipeline.get_by_name("encoder"))
+        else:
+            # The camera's MJPEG is sent as is, so only its framerate can follow the target
+            congestion.gate_frames(pipeline.get_by_name("pay"))
+
+    # Set up bus to handle messages; errors restart the pipeline instead of ending the process
+    supervisor = PipelineSupervisor(pipeline)
+    stream_metrics.backoff = supervisor.backoff
     bus = pipeline.get_bus()
     bus.add_signal_watch()
     loop = GLib.MainLoop()
-    bus.connect("message", on_message, loop)
+    bus.connect("message", supervisor.on_message, loop)
+    GLib.timeout_add_seconds(COPY_STATS_INTERVAL, copy_counter.log_stats)
 
     try:
         # Start the pipeline
@@ -248,36 +2116,115 @@ def start_streaming(device, width, height, framerate, host, port, use_h264, bitr
 if __name__ == "__main__":
     use_d435i = os.getenv("USE_D435I", "False").lower() == "true"
     use_h264 = os.getenv("USE_H264", "False").lower() == "true"
+    use_appsrc = os.getenv("USE_APPSRC", "False").lower() == "true"
+    encoder_threads = int(os.getenv("ENCODER_THREADS", 0))
+    frame_queue_size = int(os.getenv("FRAME_QUEUE_SIZE", 4))
+    adaptive_jpeg = os.getenv("ADAPTIVE_JPEG", "False").lower() == "true"
+    jpeg_min_quality = int(os.getenv("JPEG_MIN_QUALITY", 30))
+    jpeg_max_quality = int(os.getenv("JPEG_MAX_QUALITY", 90))
+    jpeg_allow_downscale = os.getenv("JPEG_ALLOW_DOWNSCALE", "False").lower() == "true"
+    motion_adaptive = os.getenv("MOTION_ADAPTIVE", "False").lower() == "true"
+    motion_threshold = float(os.getenv("MOTION_THRESHOLD", 2.0))
+    motion_idle_fps = float(os.getenv("MOTION_IDLE_FPS", 2))
+    motion_quality_drop = int(os.getenv("MOTION_QUALITY_DROP", 25))
+    roi_rect = parse_roi(os.getenv("ROI", ""))
+    roi_background_scale = int(os.getenv("ROI_BACKGROUND_SCALE", 4))
+
+    # Read environment variables
+    width = int(os.getenv("WIDTH", 640))
+    height = int(os.getenv("HEIGHT", 480))
+    framerate = int(os.getenv("FRAMERATE", 30))
 
     device = None
     if use_d435i:
-        device = find_realsense_color_camera()
+        device = find_realsense_color_camera(width, height, framerate)
         if not device:
             logger.error("No suitable RealSense color camera found. Exiting.")
             exit(1)
     else:
         device = os.getenv("DEVICE", "/dev/video0")
-
-    # Read environment variables
-    width = int(os.getenv("WIDTH", 640))
-    height = int(os.getenv("HEIGHT", 480))
-    framerate = int(os.getenv("FRAMERATE", 30))
+        # v4l2src is asked for MJPEG, so warn early when the camera cannot deliver the requested mode
+        for info in camera_table() if device.startswith("/dev/") else []:
+            if info["device"] == device and info["formats"]:
+                mode = choose_mode(info["formats"], width, height, framerate, preferred=("MJPG",))
+                if mode and mode[1:] != (width, height, framerate):
+                    logger.warning(f"{device} does not offer MJPEG {width}x{height}@{framerate}; closest is "
+                                   f"{mode[1]}x{mode[2]}@{mode[3]}.")
     host = os.getenv("RECEIVER_IP", "127.0.0.1")
     port = int(os.getenv("RECEIVER_PORT", 5554))
     bitrate = int(os.getenv("BITRATE", 2000))
+    latency_mode = os.getenv("LATENCY_MODE", "False").lower() == "true"
+    latency_port = int(os.getenv("LATENCY_PORT", port + 2)) if latency_mode else None
+    io_mode = os.getenv("V4L2_IO_MODE", "auto").lower()
+    pool_buffers = int(os.getenv("V4L2_BUFFERS", 0))
+    metrics_host = os.getenv("METRICS_HOST", "0.0.0.0")
+    metrics_port = int(os.getenv("METRICS_PORT", 9101))
+    control_host = os.getenv("CONTROL_HOST", "127.0.0.1")
+    control_port = int(os.getenv("CONTROL_PORT", 8081))
+    congestion_control = os.getenv("CONGESTION_CONTROL", "False").lower() == "true"
+    cc_feedback_port = int(os.getenv("CC_FEEDBACK_PORT", port + 4))
+    cc_min_bitrate = int(os.getenv("CC_MIN_BITRATE", 300))
 
     logger.info("Starting MJPG video stream with the following properties:")
     print(f"  Device:     {device}")
     print(f"  Resolution: {width}x{height}")
     print(f"  Framerate:  {framerate}")
     print(f"  Receiver:   {host}:{port}")
+    for extra_host, extra_port in destinations(host, port)[1:]:
+        print(f"  Receiver:   {extra_host}:{extra_port}")
     print(f"  Use D435i:  {use_d435i}")
+    if latency_mode:
+        print(f"  Latency port: {host}:{latency_port}")
+    if not use_d435i:
+        print(f"  V4L2 IO mode: {io_mode}")
+        if pool_buffers:
+            print(f"  V4L2 buffers: {pool_buffers}")
+    print(f"  RTP protection: {os.getenv('RTP_PROTECTION', 'none')}")
+    if congestion_control:
+        print(f"  Congestion control: feedback on UDP port {cc_feedback_port}, min {cc_min_bitrate} kbps")
+    if metrics_port:
+        print(f"  Prometheus metrics: {metrics_host}:{metrics_port}/metrics")
+    if control_port:
+        print(f"  Control API: {control_host}:{control_port}")
+    if use_d435i:
+        print(f"  Use appsrc: {use_appsrc}")
+        print(f"  Encoder threads: {encoder_threads}")
+        print(f"  Frame queue size: {frame_queue_size}")
+        if not use_h264:
+            print(f"  Adaptive JPEG: {adaptive_jpeg}")
+        print(f"  Motion adaptive: {motion_adaptive}")
+        if roi_rect:
+            print(f"  ROI: {roi_rect} (background 1/{roi_background_scale})")
     if use_h264:
         print(f"  Use H264:  {use_h264}")
         print(f"  Bitrate:  {bitrate}")
 
+    if metrics_port:
+        start_metrics_server(metrics_host, metrics_port)
+    if control_port:
+        start_control_server(control_host, control_port)
+
+    congestion = None
+    if congestion_control:
+        # BITRATE caps H.264 and adaptive JPEG; camera MJPEG has no bitrate, only its framerate is limited
+        max_kbps = bitrate if use_h264 or (use_d435i and adaptive_jpeg) else None
+        congestion = CongestionController(cc_feedback_port, max_kbps, cc_min_bitrate, framerate)
+        congestion.start()
+        stream_metrics.congestion = congestion
 
     if use_d435i:
-        start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrate)
+        rate_controller = None
+        if adaptive_jpeg and not use_h264:
+            # In MJPEG mode BITRATE (kbps) becomes the target of the JPEG quality loop
+            rate_controller = JpegRateController(bitrate, framerate, jpeg_min_quality, jpeg_max_quality,
+                                                 allow_downscale=jpeg_allow_downscale)
+        motion_gate = None
+        if motion_adaptive:
+            motion_gate = MotionGate(framerate, motion_threshold, motion_idle_fps, motion_quality_drop)
+        roi = RoiMap(roi_rect, roi_background_scale) if roi_rect else None
+        start_streaming_d435i(width, height, framerate, host, port, use_h264, bitrate, use_appsrc,
+                              encoder_threads, frame_queue_size, rate_controller, latency_port, motion_gate, roi,
+                              congestion)
     else:
-        start_streaming(device, width, height, framerate, host, port, use_h264, bitrate)
+        start_streaming(device, width, height, framerate, host, port, use_h264, bitrate, latency_port,
+                        io_mode, pool_buffers, congestion)
@@ -10,6 +10,29 @@ DEVICE="/dev/video0"
 USE_D435I="false"
 USE_H264="false"
 BITRATE="2000"
+USE_APPSRC="false"
+ENCODER_THREADS="0"
+FRAME_QUEUE_SIZE="4"
+ADAPTIVE_JPEG="false"
+JPEG_ALLOW_DOWNSCALE="false"
+LATENCY_MODE="false"
+RTP_PROTECTION="none"
+MOTION_ADAPTIVE="false"
+ROI=""
+V4L2_IO_MODE="auto"
+V4L2_BUFFERS="0"
+FEC_PERCENTAGE="20"
+METRICS_PORT="9101"
+CONTROL_PORT="8081"
+KEY_INT_S="2"
+CONGESTION_CONTROL="false"
+PACING="false"
+PACING_RATE="0"
+UDP_SEND_BUFFER="0"
+RTP_MTU="1400"
+DESTINATIONS=""
+MULTICAST_TTL="1"
+MULTICAST_IFACE=""
 
 # Parse optional arguments
 while [[ "$#" -gt 0 ]]; do
@@ -41,6 +64,75 @@ while [[ "$#" -gt 0 ]]; do
     --bitrate)
       BITRATE="$2"
       shift 2;;      
+    --use-appsrc)
+      USE_APPSRC="true"
+      shift ;;
+    --encoder-threads)
+      ENCODER_THREADS="$2"
+      shift 2;;
+    --frame-queue-size)
+      FRAME_QUEUE_SIZE="$2"
+      shift 2;;
+    --adaptive-jpeg)
+      ADAPTIVE_JPEG="true"
+      shift ;;
+    --jpeg-allow-downscale)
+      JPEG_ALLOW_DOWNSCALE="true"
+      shift ;;
+    --latency-mode)
+      LATENCY_MODE="true"
+      shift ;;
+    --rtp-protection)
+      RTP_PROTECTION="$2"
+      shift 2;;
+    --fec-percentage)
+      FEC_PERCENTAGE="$2"
+      shift 2;;
+    --motion-adaptive)
+      MOTION_ADAPTIVE="true"
+      shift ;;
+    --roi)
+      ROI="$2"
+      shift 2;;
+    --io-mode)
+      V4L2_IO_MODE="$2"
+      shift 2;;
+    --v4l2-buffers)
+      V4L2_BUFFERS="$2"
+      shift 2;;
+    --metrics-port)
+      METRICS_PORT="$2"
+      shift 2;;
+    --control-port)
+      CONTROL_PORT="$2"
+      shift 2;;
+    --key-int-s)
+      KEY_INT_S="$2"
+      shift 2;;
+    --congestion-control)
+      CONGESTION_CONTROL="true"
+      shift ;;
+    --pacing)
+      PACING="true"
+      shift ;;
+    --pacing-rate)
+      PACING_RATE="$2"
+      shift 2;;
+    --udp-send-buffer)
+      UDP_SEND_BUFFER="$2"
+      shift 2;;
+    --rtp-mtu)
+      RTP_MTU="$2"
+      shift 2;;
+    --destinations)
+      DESTINATIONS="$2"
+      shift 2;;
+    --multicast-ttl)
+      MULTICAST_TTL="$2"
+      shift 2;;
+    --multicast-iface)
+      MULTICAST_IFACE="$2"
+      shift 2;;
     --)
       shift
       break;;
@@ -65,4 +157,27 @@ docker run --rm -d \
   -e USE_D435I="$USE_D435I" \
   -e USE_H264="$USE_H264" \
   -e BITRATE="$BITRATE" \
+  -e USE_APPSRC="$USE_APPSRC" \
+  -e ENCODER_THREADS="$ENCODER_THREADS" \
+  -e FRAME_QUEUE_SIZE="$FRAME_QUEUE_SIZE" \
+  -e ADAPTIVE_JPEG="$ADAPTIVE_JPEG" \
+  -e JPEG_ALLOW_DOWNSCALE="$JPEG_ALLOW_DOWNSCALE" \
+  -e LATENCY_MODE="$LATENCY_MODE" \
+  -e RTP_PROTECTION="$RTP_PROTECTION" \
+  -e FEC_PERCENTAGE="$FEC_PERCENTAGE" \
+  -e MOTION_ADAPTIVE="$MOTION_ADAPTIVE" \
+  -e ROI="$ROI" \
+  -e V4L2_IO_MODE="$V4L2_IO_MODE" \
+  -e V4L2_BUFFERS="$V4L2_BUFFERS" \
+  -e METRICS_PORT="$METRICS_PORT" \
+  -e CONTROL_PORT="$CONTROL_PORT" \
+  -e KEY_INT_S="$KEY_INT_S" \
+  -e CONGESTION_CONTROL="$CONGESTION_CONTROL" \
+  -e PACING="$PACING" \
+  -e PACING_RATE="$PACING_RATE" \
+  -e UDP_SEND_BUFFER="$UDP_SEND_BUFFER" \
+  -e RTP_MTU="$RTP_MTU" \
+  -e DESTINATIONS="$DESTINATIONS" \
+  -e MULTICAST_TTL="$MULTICAST_TTL" \
+  -e MULTICAST_IFACE="$MULTICAST_IFACE" \
   video-streamer